@@ -19,6 +19,9 @@
 
 @type TRACKED_FILES: C{list} of C{string}
 @var TRACKED_FILES: the file names of files that contain index information
+@type loadLock: L{twisted.internet.defer.DeferredLock}
+@var loadLock: only one mirror's cache can be loaded at a time, as apt's
+    configuration is shared by the whole process
 """
 
 # Disable the FutureWarning from the apt module
@@ -47,6 +50,30 @@ apt_pkg.init()
 
 TRACKED_FILES = ['release', 'sources', 'packages']
 
+loadLock = defer.DeferredLock()
+
+def releaseHashes(file_path):
+    """Read the hashes of the index files listed in a Release file.
+    
+    @type file_path: L{twisted.python.filepath.FilePath}
+    @param file_path: the location of the Release file in the file system
+    @rtype: C{dictionary}
+    @return: keys are the paths of the index files relative to the Release
+        file, values are dictionaries with keys the hash type and values
+        the hash and size
+    """
+    hashes = {}
+    f = file_path.open('r')
+    
+    # Use python-debian routines to parse the file for hashes
+    rel = deb822.Release(f, fields = ['MD5Sum', 'SHA1', 'SHA256'])
+    for hash_type in rel:
+        for file in rel[hash_type]:
+            hashes.setdefault(str(file['name']), {})[hash_type.upper()] = (str(file[hash_type]), file['size'])
+        
+    f.close()
+    return hashes
+
 class PackageFileList(DictMixin):
     """Manages a list of index files belonging to a mirror.
     
@@ -96,6 +123,19 @@ class PackageFileList(DictMixin):
             return True
         return False
 
+    def has_file(self, cache_path):
+        """Check if a file is already tracked and still exists.
+        
+        @type cache_path: C{string}
+        @param cache_path: the location of the file within the mirror
+        @rtype: C{boolean}
+        """
+        if not self.packages.has_key(cache_path):
+            return False
+        file_path = self.packages[cache_path]
+        file_path.restat(False)
+        return file_path.exists()
+
     def check_files(self):
         """Check all files in the database to remove any that don't exist."""
         files = self.packages.keys()
@@ -135,6 +175,9 @@ class AptPackages:
     @ivar loading_unload: whether there is an unload pending on the current load
     @type unload_later: L{twisted.internet.interfaces.IDelayedCall}
     @ivar unload_later: the delayed call to unload the apt cache
+    @type prewarm_later: L{twisted.internet.interfaces.IDelayedCall}
+    @ivar prewarm_later: the delayed call to load the apt cache in the
+        background after index files have been updated
     @type indexrecords: C{dictionary}
     @ivar indexrecords: the hashes of index files for the mirror, keys are
         mirror directories, values are dictionaries with keys the path to the
@@ -158,7 +201,7 @@ class AptPackages:
         #'Dir::State::cdroms' : 'cdroms.list',
         'Dir::State::userstatus' : 'status.user',
         'Dir::State::status': 'dpkg/status', # '/var/lib/dpkg/status'
-        'Dir::Cache' : '.apt/cache/', # var/cache/apt/
+        'Dir::Cache' : 'apt/cache/', # var/cache/apt/
         #'Dir::Cache::archives' : 'archives/',
         'Dir::Cache::srcpkgcache' : 'srcpkgcache.bin',
         'Dir::Cache::pkgcache' : 'pkgcache.bin',
@@ -209,6 +252,7 @@ class AptPackages:
         self.loading = None
         self.loading_unload = False
         self.unload_later = None
+        self.prewarm_later = None
         
     def __del__(self):
         self.cleanup()
@@ -219,27 +263,51 @@ class AptPackages:
         Dirty hack until python-apt supports apt-pkg/indexrecords.h
         (see Bug #456141)
         """
-        self.indexrecords[cache_path] = {}
+        self.indexrecords[cache_path] = releaseHashes(file_path)
 
-        read_packages = False
-        f = file_path.open('r')
+    def has_file(self, cache_path):
+        """Check if an index file is already tracked.
         
-        # Use python-debian routines to parse the file for hashes
-        rel = deb822.Release(f, fields = ['MD5Sum', 'SHA1', 'SHA256'])
-        for hash_type in rel:
-            for file in rel[hash_type]:
-                self.indexrecords[cache_path].setdefault(str(file['name']), {})[hash_type.upper()] = (str(file[hash_type]), file['size'])
-            
-        f.close()
+        @see: L{PackageFileList.has_file}
+        """
+        return self.packages.has_file(cache_path)
 
     def file_updated(self, cache_path, file_path):
         """A file in the mirror has changed or been added.
         
-        If this affects us, unload our apt database.
+        If this affects us, unload our apt database and schedule it to be
+        reloaded once the updates have stopped arriving.
         @see: L{PackageFileList.update_file}
         """
         if self.packages.update_file(cache_path, file_path):
             self.unload()
+            self.prewarm()
+
+    def prewarm(self):
+        """Schedule a background load of the cache after updates settle.
+        
+        Apt updates many index files at once, so the load is delayed until
+        no more updates have been received for a while.
+        """
+        delay = config.gettime('DEFAULT', 'PREWARM_PACKAGES_CACHE')
+        if delay <= 0:
+            return
+        if self.prewarm_later and self.prewarm_later.active():
+            self.prewarm_later.reset(delay)
+        else:
+            self.prewarm_later = reactor.callLater(delay, self._prewarm)
+            
+    def _prewarm(self):
+        """Load the cache now that the index file updates have settled."""
+        self.prewarm_later = None
+        log.msg('Pre-warming the packages cache for %s' % self.cache_dir.path)
+        d = self.load()
+        d.addErrback(self._prewarm_error)
+        
+    def _prewarm_error(self, failure):
+        """Loading the cache in the background failed, it will be retried on demand."""
+        log.msg('An error occurred while pre-warming the packages cache')
+        log.err(failure)
 
     def load(self):
         """Make sure the package cache is initialized and loaded."""
@@ -257,10 +325,15 @@ class AptPackages:
         if self.loading is None:
             log.msg('Loading the packages cache')
             self.loading_unload = False
-            self.loading = threads.deferToThread(self._load)
-            self.loading.addCallback(self.doneLoading)
+            self.loading = self._loadInThread()
         return self.loading
         
+    def _loadInThread(self):
+        """Load the cache in a thread, after any other mirrors' loads are done."""
+        d = loadLock.run(threads.deferToThread, self._load)
+        d.addCallback(self.doneLoading)
+        return d
+        
     def doneLoading(self, loadResult):
         """Cache is loaded."""
         self.loading = None
@@ -270,36 +343,77 @@ class AptPackages:
             log.msg('Re-loading the packages cache')
             self.unload()
             self.loading_unload = False
-            self.loading = threads.deferToThread(self._load)
-            self.loading.addCallback(self.doneLoading)
+            self.loading = self._loadInThread()
             return self.loading
             
         # Must pass on the result for the next callback
         return loadResult
         
+    def _indexSignature(self):
+        """Describe the current set of tracked index files.
+        
+        @rtype: C{string}
+        @return: the cache paths, locations, modification times and sizes of
+            all the tracked index files, which will change whenever apt's
+            binary caches need to be regenerated
+        """
+        lines = []
+        for f in self.packages:
+            file = self.packages[f]
+            file.restat(False)
+            lines.append('%s %s %d %d' % (f, file.path, file.getmtime(), file.getsize()))
+        lines.sort()
+        return '\n'.join(lines) + '\n'
+        
     def _load(self):
-        """Regenerates the fake configuration and loads the packages caches."""
+        """Regenerates the fake configuration and loads the packages caches.
+        
+        If the tracked index files have not changed since the last load, the
+        fake configuration and apt's binary caches from then are reused.
+        """
         if self.loaded: return True
         
-        # Modify the default configuration to create the fake one.
         apt_pkg.init_system()
-        self.cache_dir.preauthChild(self.apt_config['Dir::State']
-                     ).preauthChild(self.apt_config['Dir::State::Lists']).remove()
-        self.cache_dir.preauthChild(self.apt_config['Dir::State']
-                     ).preauthChild(self.apt_config['Dir::State::Lists']
-                     ).child('partial').makedirs()
+        self.packages.check_files()
+        self.indexrecords = {}
+        lists_dir = self.cache_dir.preauthChild(self.apt_config['Dir::State']
+                                  ).preauthChild(self.apt_config['Dir::State::Lists'])
         sources_file = self.cache_dir.preauthChild(self.apt_config['Dir::Etc']
                                ).preauthChild(self.apt_config['Dir::Etc::sourcelist'])
-        sources = sources_file.open('w')
+        bin_cache_dir = self.cache_dir.preauthChild(self.apt_config['Dir::Cache'])
+        signature_file = bin_cache_dir.child('lists.signature')
+        
+        # Check if the index files have changed since the last load
+        signature = self._indexSignature()
+        reuse = False
+        signature_file.restat(False)
+        sources_file.restat(False)
+        if signature_file.exists() and sources_file.exists():
+            f = signature_file.open('r')
+            reuse = (f.read() == signature)
+            f.close()
+        
+        if reuse:
+            log.msg("Index files are unchanged, reusing apt's caches for " + self.cache_dir.path)
+            sources = None
+        else:
+            # Modify the default configuration to create the fake one.
+            lists_dir.remove()
+            lists_dir.child('partial').makedirs()
+            if not bin_cache_dir.exists():
+                bin_cache_dir.makedirs()
+            for cache_file in (self.apt_config['Dir::Cache::pkgcache'],
+                               self.apt_config['Dir::Cache::srcpkgcache'],
+                               signature_file.basename()):
+                old_cache = bin_cache_dir.child(cache_file)
+                if old_cache.exists():
+                    old_cache.remove()
+            sources = sources_file.open('w')
         sources_count = 0
         deb_src_added = False
-        self.packages.check_files()
-        self.indexrecords = {}
         
         # Create an entry in sources.list for each needed index file
         for f in self.packages:
-            # we should probably clear old entries from self.packages and
-            # take into account the recorded mtime as optimization
             file = self.packages[f]
             if f.split('/')[-1] == "Release":
                 self.addRelease(f, file)
@@ -310,18 +424,20 @@ class AptPackages:
                 source_line='deb-src '+fake_dirname+'/ /'
             else:
                 source_line='deb '+fake_dirname+'/ /'
-            listpath = self.cache_dir.preauthChild(self.apt_config['Dir::State']
-                                    ).preauthChild(self.apt_config['Dir::State::Lists']
-                                    ).child(apt_pkg.uri_to_filename(fake_uri))
+            sources_count = sources_count + 1
+            if sources is None:
+                continue
+
+            listpath = lists_dir.child(apt_pkg.uri_to_filename(fake_uri))
             sources.write(source_line+'\n')
             log.msg("Sources line: " + source_line)
-            sources_count = sources_count + 1
 
             if listpath.exists():
                 #we should empty the directory instead
                 listpath.remove()
             os.symlink(file.path, listpath.path)
-        sources.close()
+        if sources is not None:
+            sources.close()
 
         if sources_count == 0:
             log.msg("No Packages files available for %s backend"%(self.cache_dir.path))
@@ -337,6 +453,12 @@ class AptPackages:
             self.srcrecords = apt_pkg.SourceRecords()
         else:
             self.srcrecords = None
+        
+        # Apt has now written its binary caches for these index files
+        if not reuse:
+            f = signature_file.open('w')
+            f.write(signature)
+            f.close()
 
         self.loaded = True
         return True
@@ -359,6 +481,9 @@ class AptPackages:
 
     def cleanup(self):
         """Cleanup and close any loaded caches."""
+        if self.prewarm_later and self.prewarm_later.active():
+            self.prewarm_later.cancel()
+        self.prewarm_later = None
         self.unload()
         if self.unload_later and self.unload_later.active():
             self.unload_later.cancel()
@@ -519,6 +644,67 @@ class TestAptPackages(unittest.TestCase):
         self.failUnless(found_hash.hexexpected() == true_hash, 
                     "%s hashes don't match: %s != %s" % (path, found_hash.hexexpected(), true_hash))
 
+    def test_prewarm(self):
+        """Tests that updating index files schedules a background load of the cache."""
+        self.failUnless(self.client.prewarm_later and self.client.prewarm_later.active())
+        self.failIf(self.client.loaded)
+        
+        self.client.prewarm_later.cancel()
+        self.client._prewarm()
+        self.failUnless(self.client.prewarm_later is None)
+        
+        d = self.client.load()
+        d.addCallback(lambda result: self.failUnless(self.client.loaded))
+        return d
+
+    def test_prewarm_together(self):
+        """Tests that mirrors loaded at the same time each get their own packages."""
+        other_dir = FilePath('/tmp/.apt-p2p-other')
+        if other_dir.exists():
+            other_dir.remove()
+        other_dir.makedirs()
+        packages = other_dir.child('Packages')
+        packages.setContent('Package: apt-p2p-test-only\nVersion: 1.0\n' +
+                            'Architecture: all\nFilename: pool/apt-p2p-test-only_1.0_all.deb\n' +
+                            'Size: 1000\nSHA1: ' + '0' * 40 + '\n\n')
+        other = AptPackages(other_dir)
+        other.file_updated('/dists/other/main/binary-i386/Packages', packages)
+        
+        for client in (self.client, other):
+            client.prewarm_later.cancel()
+            client._prewarm()
+        d = defer.DeferredList([self.client.load(), other.load()], fireOnOneErrback = True)
+        
+        def checkPackages(result):
+            self.failUnless(self.client.cache['dpkg'])
+            self.failUnlessRaises(KeyError, self.client.cache.__getitem__, 'apt-p2p-test-only')
+            self.failUnless(other.cache['apt-p2p-test-only'])
+            self.failUnlessRaises(KeyError, other.cache.__getitem__, 'dpkg')
+        
+        d.addCallback(checkPackages)
+        d.addBoth(lambda result: other.cleanup() or result)
+        return d
+
+    def test_reuse_cache(self):
+        """Tests that reloading unchanged index files reuses apt's binary caches."""
+        self.client._load()
+        pkgcache = self.client.cache_dir.preauthChild('apt/cache/pkgcache.bin')
+        self.failUnless(pkgcache.exists())
+        stat = os.stat(pkgcache.path)
+        
+        # Regenerating the caches would recreate the lists directory
+        marker = self.client.cache_dir.preauthChild(self.client.apt_config['Dir::State']
+                    ).preauthChild(self.client.apt_config['Dir::State::Lists']).child('reused')
+        marker.setContent('')
+        
+        self.client.unload()
+        self.failIf(self.client.loaded)
+        self.client._load()
+        self.failUnless(os.path.exists(marker.path))
+        newStat = os.stat(pkgcache.path)
+        self.failUnlessEqual((newStat.st_ino, newStat.st_mtime), (stat.st_ino, stat.st_mtime))
+        self.failUnless(self.client.cache['dpkg'])
+
     def test_findIndexHash(self):
         """Tests finding the hash of a single index file."""
         lastDefer = defer.Deferred()
@@ -12,9 +12,11 @@ from twisted.python import log
 from twisted.python.filepath import FilePath
 from twisted.internet import defer, reactor
 from twisted.trial import unittest
+from twisted.web2 import http
 from twisted.web2.http import splitHostPort
 
 from Streams import GrowingFileStream, StreamToFile
+from DiskWriter import DiskWriter
 from Hash import HashObject
 from apt_p2p_conf import config
 
@@ -39,6 +41,10 @@ class CacheManager:
     @ivar manager: the main program object to send requests to
     @type scanning: C{list} of L{twisted.python.filepath.FilePath}
     @ivar scanning: all the directories that are currectly being scanned or waiting to be scanned
+    @type downloading: C{dictionary}
+    @ivar downloading: the files that are being downloaded to the cache,
+        keys are the URLs, values are the response code, the list of raw
+        headers, and the L{Streams.GrowingFileStream} of the file
     """
     
     def __init__(self, cache_dir, db, manager = None):
@@ -59,6 +65,7 @@ class CacheManager:
         self.db = db
         self.manager = manager
         self.scanning = []
+        self.downloading = {}
         
         # Init the database, remove old files
         self.db.removeUntrackedFiles(self.all_dirs)
@@ -198,17 +205,55 @@ class CacheManager:
         orig_stream = response.stream
         f = destFile.open('w+')
         new_stream = GrowingFileStream(f, orig_stream.length)
+        writer = DiskWriter(f, orig_stream.length)
         hash.new()
         df = StreamToFile(hash, orig_stream, f, notify = new_stream.updateAvailable,
-                          decompress = ext, decFile = decFile).run()
+                          decompress = ext, decFile = decFile, writer = writer).run()
+        df.addBoth(self._save_written, writer)
         df.addCallback(self._save_complete, url, destFile, new_stream,
                        response.headers.getHeader('Last-Modified'), decFile)
         df.addErrback(self._save_error, url, destFile, new_stream, decFile)
-        response.stream = new_stream
+
+        # Other requests for the file can read it while it's downloaded
+        headers = [(name, values[:]) for name, values in response.headers.getAllRawHeaders()]
+        self.downloading[url] = (response.code, headers, new_stream)
+        response.stream = self.get_downloading(url).stream
+        new_stream.detach()
 
         # Return the modified response with the new stream
         return response
 
+    def get_downloading(self, url):
+        """Get a response that streams a file that is being downloaded.
+        
+        The response reads the file from the start, waiting for the data
+        as it is downloaded, and so can also be split to send ranges of the
+        file before all of it is available.
+        
+        @param url: the URI of the actual mirror request
+        @rtype: L{twisted.web2.http.Response}
+        @return: the response to send, or None if the file is not being
+            downloaded
+        """
+        if url not in self.downloading:
+            return None
+        
+        code, headers, destStream = self.downloading[url]
+        response = http.Response(code, stream = destStream.reader(0L, destStream.length))
+        for name, values in headers:
+            response.headers.setRawHeaders(name, values[:])
+        return response
+
+    def _save_written(self, result, writer):
+        """Close the writer, all the data has been written to the file."""
+        writer.close()
+        return result
+
+    def _save_done(self, url, destStream):
+        """The file is no longer being downloaded, so can't be streamed any more."""
+        if destStream and self.downloading.get(url, (None, None, None))[2] is destStream:
+            del self.downloading[url]
+
     def _save_complete(self, hash, url, destFile, destStream = None,
                        modtime = None, decFile = None):
         """Update the modification time and inform the main program.
@@ -227,6 +272,7 @@ class CacheManager:
         @param decFile: the file where the decompressed download was written to
             (optional, defaults to the file not having been compressed)
         """
+        self._save_done(url, destStream)
         result = hash.verify()
         if result or result is None:
             if destStream:
@@ -265,6 +311,7 @@ class CacheManager:
         """Remove the destination files."""
         log.msg('Error occurred downloading %s' % url)
         log.err(failure)
+        self._save_done(url, destStream)
         if destStream:
             destStream.allAvailable(remove = True)
         else:
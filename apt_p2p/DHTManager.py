@@ -8,6 +8,7 @@
 """
 
 import sha
+from binascii import b2a_hex
 
 from twisted.internet import reactor
 from twisted.python import log
@@ -36,6 +37,9 @@ class DHT:
     @ivar nextRefresh: the next delayed call to refreshFiles
     @type refreshingHashes: C{list} of C{dictionary}
     @ivar refreshingHashes: the list of hashes that still need to be refreshed
+    @type partialStores: C{dictionary}
+    @ivar partialStores: the keys of the downloads in progress that are
+        being added to the DHT
     """
     
     def __init__(self, dhtClass, db):
@@ -49,6 +53,7 @@ class DHT:
         self.my_contact = None
         self.nextRefresh = None
         self.refreshingHashes = []
+        self.partialStores = {}
         
     def start(self):
         self.dht = self.dhtClass()
@@ -114,9 +119,14 @@ class DHT:
             return self.dht.getStats()
         return "<p>DHT doesn't support statistics\n"
 
-    def get(self, key):
-        """Retrieve a hash's value from the DHT."""
-        return self.dht.getValue(key)
+    def get(self, key, callback = None):
+        """Retrieve a hash's value from the DHT.
+        
+        @type callback: C{method}
+        @param callback: the method to call with each list of new values as
+            they are found (optional)
+        """
+        return self.dht.getValue(key, callback)
     
     def store(self, hash):
         """Add a hash for a file to the DHT.
@@ -125,8 +135,65 @@ class DHT:
         it to the DHT.
         """
         key = hash.digest()
-        value = {'c': self.my_contact}
         pieces = hash.pieceDigests()
+        value = self._value(pieces)
+
+        storeDefer = self.dht.storeValue(key, value)
+        storeDefer.addCallbacks(self._store_done, self._store_error,
+                                callbackArgs = (key, pieces), errbackArgs = (key, ))
+        return storeDefer
+
+    def storePartial(self, hash, pieces):
+        """Add a hash for a file that is still being downloaded to the DHT.
+        
+        The value is marked as partial ('p'), so peers that find it only
+        request the pieces that have been verified so far. The piece hashes
+        of large files are served by our peer HTTP server from the download.
+        
+        @type hash: L{Hash.HashObject}
+        @param hash: the hash object containing the expected hash for the file
+        @type pieces: C{list} of C{string}
+        @param pieces: the expected hashes of the file's pieces
+        @rtype: L{twisted.internet.defer.Deferred}
+        @return: the deferred of the store, or None if the DHT hasn't
+            been joined yet
+        """
+        if self.my_contact is None:
+            return None
+        key = hash.expected()
+        value = self._value(pieces)
+        value['p'] = 1
+
+        self.partialStores[key] = True
+        storeDefer = self.dht.storeValue(key, value)
+        storeDefer.addCallbacks(self._storePartial_done, self._store_error,
+                                callbackArgs = (key, pieces), errbackArgs = (key, ))
+        return storeDefer
+    
+    def stopPartial(self, hash):
+        """Stop adding a download that failed or was aborted to the DHT.
+        
+        Values can't be removed from the DHT, but partial values aren't
+        refreshed so they soon expire, and peers that find it meanwhile are
+        told the pieces aren't found. This stops a store still in progress
+        from going on to add the piece hashes.
+        
+        @type hash: L{Hash.HashObject}
+        @param hash: the hash object containing the expected hash for the file
+        """
+        if self.partialStores.pop(hash.expected(), None):
+            log.msg('Stopped sharing the download of %s' % b2a_hex(hash.expected()))
+    
+    def _storePartial_done(self, result, key, pieces):
+        """Add the pieces of a download to the DHT, if it's still being shared."""
+        if not self.partialStores.pop(key, None):
+            log.msg('Added %s to the DHT, but it is no longer shared: %r' % (b2a_hex(key), result))
+            return result
+        return self._store_done(result, key, pieces)
+
+    def _value(self, pieces):
+        """Create the value to store in the DHT for a file with the pieces."""
+        value = {'c': self.my_contact}
         
         # Determine how to store any piece data
         if len(pieces) <= 1:
@@ -140,16 +207,11 @@ class DHT:
         else:
             # Too long, must be served up by our peer HTTP server
             value['l'] = sha.new(''.join(pieces)).digest()
+        return value
 
-        storeDefer = self.dht.storeValue(key, value)
-        storeDefer.addCallbacks(self._store_done, self._store_error,
-                                callbackArgs = (hash, ), errbackArgs = (hash.digest(), ))
-        return storeDefer
-
-    def _store_done(self, result, hash):
+    def _store_done(self, result, key, pieces):
         """Add a key/value pair for the pieces of the file to the DHT (if necessary)."""
-        log.msg('Added %s to the DHT: %r' % (hash.hexdigest(), result))
-        pieces = hash.pieceDigests()
+        log.msg('Added %s to the DHT: %r' % (b2a_hex(key), result))
         if len(pieces) > DHT_PIECES and len(pieces) <= TORRENT_PIECES:
             # Add the piece data key and value to the DHT
             key = sha.new(''.join(pieces)).digest()
@@ -0,0 +1,271 @@
+
+"""Write downloaded data to files without blocking the reactor.
+
+@type MAX_QUEUE: C{int}
+@var MAX_QUEUE: the number of bytes waiting to be written to a file before
+    the downloads to it stop reading from the network
+@type MAX_WRITE: C{int}
+@var MAX_WRITE: the largest write to combine adjacent chunks of data into
+"""
+
+import os
+
+from twisted.internet import defer, threads
+from twisted.python import log, failure
+from twisted.python.filepath import FilePath
+from twisted.trial import unittest
+
+from util import preallocate, pwrite
+
+MAX_QUEUE = 1024*1024
+MAX_WRITE = 256*1024
+
+class DiskWriter:
+    """Write data to a file from a thread, combining adjacent chunks of it.
+
+    The data is queued to be written in the order it is received, and
+    chunks that follow on from the one before them are combined into a
+    single write. A batch of the queued writes is done at a time in a
+    thread, at their positions in the file (without seeking), so a slow
+    disk doesn't block the reactor and the writes can't interleave.
+
+    Once a write fails, no more data is written and the error is returned
+    by L{flush}.
+
+    @type path: C{string}
+    @ivar path: the name of the file
+    @type fd: C{int}
+    @ivar fd: the file descriptor to write to, or None once closed
+    @type closed: C{boolean}
+    @ivar closed: whether the writer has been closed, so can't be written to
+    @type queue: C{list}
+    @ivar queue: the writes waiting to be done, lists of the position in the
+        file, the chunks of data, their total length, and the methods to
+        call once they are written
+    @type writing: C{list}
+    @ivar writing: the batch of writes being done by the thread, or None
+    @type queued: C{int}
+    @ivar queued: the number of bytes waiting to be written, including
+        those being written
+    @type waiting: C{list} of L{twisted.internet.defer.Deferred}
+    @ivar waiting: waiting for the queue to no longer be full
+    @type flushes: C{list} of L{twisted.internet.defer.Deferred}
+    @ivar flushes: waiting for the data queued before them to be written
+    @type failure: L{twisted.python.failure.Failure}
+    @ivar failure: the error that stopped the writing, or None
+    """
+
+    def __init__(self, f, size = None):
+        """Open the file for writing.
+
+        @type f: C{file}
+        @param f: the open file to write to, it is opened again so that the
+            writes don't affect its position
+        @type size: C{int}
+        @param size: the expected size of the file, to reserve the disk space
+            for (optional, defaults to not reserving any)
+        """
+        self.path = f.name
+        self.fd = os.open(f.name, os.O_WRONLY)
+        if size and size > 0:
+            preallocate(f, size)
+        self.closed = False
+        self.queue = []
+        self.writing = None
+        self.queued = 0
+        self.waiting = []
+        self.flushes = []
+        self.failure = None
+
+    def write(self, position, data, written = None):
+        """Queue some data to be written to the file.
+
+        @type position: C{int}
+        @param position: the position in the file to write the data at
+        @type data: C{string}
+        @param data: the data to write
+        @param written: the method to call once the data has been written
+            (optional, it isn't called if the write fails)
+        """
+        if self.closed:
+            raise ValueError, "I/O operation on closed file"
+        if self.failure or not data:
+            return
+
+        last = self.queue and self.queue[-1]
+        if last and last[0] + last[2] == position and last[2] + len(data) <= MAX_WRITE:
+            last[1].append(data)
+            last[2] += len(data)
+        else:
+            last = [position, [data], len(data), []]
+            self.queue.append(last)
+        if written:
+            last[3].append(written)
+        self.queued += len(data)
+        self._writeNext()
+
+    def isFull(self):
+        """Check whether too much data is waiting to be written.
+
+        @rtype: C{boolean}
+        """
+        return self.queued >= MAX_QUEUE
+
+    def whenReady(self):
+        """Wait for the queue of data to be written to not be full.
+
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+        if not self.isFull():
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d
+
+    def flush(self):
+        """Wait for all the data queued so far to be written.
+
+        @rtype: L{twisted.internet.defer.Deferred}
+        @return: fires once the data has been written, or with the error if
+            writing it failed
+        """
+        if self.failure:
+            return defer.fail(self.failure)
+        if not self.queued:
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+        self.flushes.append(d)
+        last = (self.queue or self.writing)[-1]
+        last[3].append(lambda: self._flushed(d))
+        return d
+
+    def close(self):
+        """Close the file once all the queued data has been written.
+
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+        self.closed = True
+        d = self.flush()
+        d.addBoth(self._close)
+        return d
+
+    def _flushed(self, d):
+        """The data queued before a flush has all been written."""
+        self.flushes.remove(d)
+        d.callback(None)
+
+    def _close(self, result):
+        """Close the file descriptor."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        return result
+
+    def _writeNext(self):
+        """Start writing the queued data, unless some is already being written."""
+        if self.writing or not self.queue:
+            return
+        self.writing = self.queue
+        self.queue = []
+        d = threads.deferToThread(self._write, self.fd, self.writing)
+        d.addBoth(self._written)
+
+    def _write(self, fd, batch):
+        """Write a batch of data to the file (runs in a separate thread)."""
+        for position, chunks, length, callbacks in batch:
+            pwrite(fd, ''.join(chunks), position)
+
+    def _written(self, result):
+        """Tell the waiting methods that the batch has been written."""
+        batch = self.writing
+        self.writing = None
+        for position, chunks, length, callbacks in batch:
+            self.queued -= length
+
+        if isinstance(result, failure.Failure):
+            log.msg('Failed to write to %s' % self.path)
+            log.err(result)
+            self.failure = result
+            self.queue = []
+            self.queued = 0
+            flushes = self.flushes
+            self.flushes = []
+            for d in flushes:
+                d.errback(result)
+        else:
+            self._writeNext()
+            for position, chunks, length, callbacks in batch:
+                for callback in callbacks:
+                    callback()
+
+        if not self.isFull():
+            waiting = self.waiting
+            self.waiting = []
+            for d in waiting:
+                d.callback(None)
+
+class TestDiskWriter(unittest.TestCase):
+    """Unit tests for writing to files from a thread."""
+
+    writer = None
+
+    def setUp(self):
+        self.file = FilePath(self.mktemp())
+        self.f = self.file.open('w+')
+        self.writer = DiskWriter(self.f, 1000)
+
+    def test_combining(self):
+        """Tests that adjacent chunks are written together, in order."""
+        written = []
+        for i in xrange(10):
+            self.writer.write(i * 10, str(i) * 10, lambda i = i: written.append(i))
+        self.writer.write(50, 'x' * 10)
+        self.failUnlessEqual(len(self.writer.writing), 1)
+        self.failUnlessEqual([entry[2] for entry in self.writer.queue], [90, 10])
+
+        def check(result):
+            self.failUnlessEqual(written, range(10))
+            self.failUnlessEqual(self.writer.queued, 0)
+            data = ''.join([str(i) * 10 for i in xrange(10)])
+            self.failUnlessEqual(self.file.getContent(), data[:50] + 'x' * 10 + data[60:])
+        d = self.writer.flush()
+        d.addCallback(check)
+        return d
+
+    def test_full(self):
+        """Tests waiting for the queue to have room for more data."""
+        self.failUnless(self.writer.whenReady().called)
+        data = 'a' * (64*1024)
+        for i in xrange(MAX_QUEUE / len(data)):
+            self.writer.write(i * len(data), data)
+        self.failUnless(self.writer.isFull())
+
+        d = self.writer.whenReady()
+        self.failIf(d.called)
+        def check(result):
+            self.failIf(self.writer.isFull())
+            return self.writer.flush()
+        d.addCallback(check)
+        return d
+
+    def test_error(self):
+        """Tests that a failed write is returned by flushing."""
+        os.close(self.writer.fd)
+        self.writer.fd = os.open(self.f.name, os.O_RDONLY)
+        self.writer.write(0, 'data')
+        d = self.writer.flush()
+        self.failUnlessFailure(d, OSError)
+        def check(result):
+            self.flushLoggedErrors(OSError)
+            self.writer.write(10, 'more data')
+            self.failUnlessEqual(self.writer.queued, 0)
+            return self.failUnlessFailure(self.writer.flush(), OSError)
+        d.addCallback(check)
+        return d
+
+    def tearDown(self):
+        d = self.writer.close()
+        d.addErrback(lambda err: None)
+        d.addCallback(lambda result: self.f.close())
+        return d
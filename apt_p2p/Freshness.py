@@ -0,0 +1,210 @@
+
+"""Decide how long cached files without hashes can be used without checking.
+
+Files that apt requests that aren't listed in any index (mostly the
+Release files themselves) have to be checked with the mirror before they
+can be returned from the cache. Once checked (or downloaded), they are
+considered fresh for a while, so that the many requests of an
+C{apt-get update} don't each need another check.
+
+@type HEURISTIC_FRACTION: C{float}
+@var HEURISTIC_FRACTION: the fraction of the time since a file was last
+    modified that it is fresh for, if the mirror doesn't say how long
+@type RELEASE_FILES: C{list} of C{string}
+@var RELEASE_FILES: the names of the files that can contain a Valid-Until
+    field
+"""
+
+from email.Utils import parsedate_tz, mktime_tz
+import time
+
+from twisted.python import log
+from twisted.python.filepath import FilePath
+from twisted.trial import unittest
+
+HEURISTIC_FRACTION = 0.1
+RELEASE_FILES = ['Release', 'InRelease']
+
+class FreshnessPolicy:
+    """Track how long cached files without hashes are fresh for.
+
+    The lifetime of a file is determined from the headers the mirror sent
+    when it was last checked or downloaded: the Cache-Control max-age or
+    Expires if there is one, otherwise a fraction of the time since it was
+    last modified. Release files are never fresh past their Valid-Until.
+
+    All times are in (wall clock) seconds since the epoch, as the HTTP
+    dates they are compared with are.
+
+    @type maxAge: C{int}
+    @ivar maxAge: the longest time a file is considered fresh for
+    @type fresh: C{dictionary}
+    @ivar fresh: the time each file is fresh until, keys are the URLs
+    @type validUntil: C{dictionary}
+    @ivar validUntil: the Valid-Until times of the Release files, keys are
+        the URLs
+    """
+
+    def __init__(self, maxAge):
+        """Initialize the policy.
+
+        @type maxAge: C{int}
+        @param maxAge: the longest time a file is considered fresh for, 0 to
+            always check the files
+        """
+        self.maxAge = maxAge
+        self.fresh = {}
+        self.validUntil = {}
+
+    def isFresh(self, url, now = None):
+        """Check whether a cached file can be used without checking the mirror.
+
+        @param url: the URI of the file on the mirror
+        @type now: C{float}
+        @param now: the current time (optional, for testing)
+        @rtype: C{boolean}
+        """
+        if now is None:
+            now = time.time()
+        return (now < self.fresh.get(url, 0) and
+                (url not in self.validUntil or now < self.validUntil[url]))
+
+    def validated(self, url, headers, modtime = None, now = None):
+        """Determine how long a file is fresh for after the mirror sent it or confirmed it.
+
+        @param url: the URI of the file on the mirror
+        @type headers: L{twisted.web2.http_headers.Headers}
+        @param headers: the headers of the mirror's response
+        @type modtime: C{int}
+        @param modtime: the last modification time of the cached file, used
+            if the response doesn't have one (optional)
+        @type now: C{float}
+        @param now: the current time (optional, for testing)
+        """
+        if now is None:
+            now = time.time()
+
+        date = headers.getHeader('Date') or now
+        cacheControl = headers.getHeader('Cache-Control') or {}
+        expires = headers.getHeader('Expires')
+        if headers.getHeader('Last-Modified') is not None:
+            modtime = headers.getHeader('Last-Modified')
+        if 'no-cache' in cacheControl or 'no-store' in cacheControl:
+            lifetime = 0
+        elif cacheControl.get('max-age', None) is not None:
+            lifetime = cacheControl['max-age']
+        elif expires is not None:
+            lifetime = expires - date
+        elif modtime is not None:
+            lifetime = HEURISTIC_FRACTION * (date - modtime)
+        else:
+            lifetime = 0
+        lifetime = max(0, min(lifetime, self.maxAge))
+
+        if lifetime > 0:
+            log.msg('%s is fresh for %d seconds' % (url, lifetime))
+            self.fresh[url] = now + lifetime
+        else:
+            self.expire(url)
+
+    def expire(self, url):
+        """The file needs to be checked with the mirror before being used again."""
+        self.fresh.pop(url, None)
+
+    def releaseFile(self, url, file):
+        """Read the Valid-Until field of a newly cached Release file.
+
+        @param url: the URI of the file on the mirror
+        @type file: L{twisted.python.filepath.FilePath}
+        @param file: the file in the cache
+        """
+        if file.basename() not in RELEASE_FILES:
+            return
+
+        self.validUntil.pop(url, None)
+        try:
+            f = file.open()
+        except (IOError, OSError), e:
+            log.msg('Failed to read Valid-Until from %s: %r' % (file.path, e))
+            return
+
+        try:
+            for line in f:
+                if line.startswith('Valid-Until:'):
+                    date = parsedate_tz(line[len('Valid-Until:'):].strip())
+                    if date:
+                        self.validUntil[url] = mktime_tz(date)
+                    break
+                if line.startswith('MD5Sum:') or line.startswith('SHA1:') or line.startswith('SHA256:'):
+                    # The header fields are done, it's just files from here
+                    break
+        finally:
+            f.close()
+
+class TestFreshnessPolicy(unittest.TestCase):
+    """Tests for the freshness of cached files."""
+
+    url = 'http://ftp.us.debian.org/debian/dists/unstable/Release'
+
+    class Headers:
+        """Fake headers to validate files with."""
+
+        def __init__(self, **headers):
+            self.headers = headers
+
+        def getHeader(self, name):
+            return self.headers.get(name.lower().replace('-', '_'), None)
+
+    def setUp(self):
+        self.policy = FreshnessPolicy(3600)
+
+    def test_heuristic(self):
+        """Tests the lifetime of files from their last modification."""
+        self.failIf(self.policy.isFresh(self.url, 10000))
+        self.policy.validated(self.url, self.Headers(date = 10000, last_modified = 4000), now = 10000)
+        self.failUnless(self.policy.isFresh(self.url, 10000))
+        self.failUnless(self.policy.isFresh(self.url, 10599))
+        self.failIf(self.policy.isFresh(self.url, 10600))
+
+        # Limited to the maximum
+        self.policy.validated(self.url, self.Headers(last_modified = 0), now = 100000)
+        self.failUnless(self.policy.isFresh(self.url, 103599))
+        self.failIf(self.policy.isFresh(self.url, 103600))
+
+        # The cached file's modification time is used if the response has none
+        self.policy.validated(self.url, self.Headers(date = 10000), 9000, now = 10000)
+        self.failUnless(self.policy.isFresh(self.url, 10099))
+        self.failIf(self.policy.isFresh(self.url, 10100))
+
+        self.policy.expire(self.url)
+        self.failIf(self.policy.isFresh(self.url, 100000))
+
+    def test_explicit(self):
+        """Tests the lifetime of files the mirror says how long to keep."""
+        self.policy.validated(self.url, self.Headers(date = 10000, last_modified = 0,
+                                                     expires = 10100), now = 10000)
+        self.failUnless(self.policy.isFresh(self.url, 10099))
+        self.failIf(self.policy.isFresh(self.url, 10100))
+
+        self.policy.validated(self.url, self.Headers(date = 10000, expires = 20000,
+                                                     cache_control = {'max-age': 50}), now = 10000)
+        self.failUnless(self.policy.isFresh(self.url, 10049))
+        self.failIf(self.policy.isFresh(self.url, 10050))
+
+        self.policy.validated(self.url, self.Headers(date = 10000, last_modified = 0,
+                                                     cache_control = {'no-cache': None}), now = 10000)
+        self.failIf(self.policy.isFresh(self.url, 10000))
+
+    def test_valid_until(self):
+        """Tests that Release files are not fresh past their Valid-Until."""
+        release = FilePath(self.mktemp())
+        release.makedirs()
+        release = release.child('Release')
+        release.setContent('Origin: Debian\nValid-Until: Thu, 01 Jan 1970 02:50:00 UTC\n' +
+                           'SHA256:\n 0123 100 main/binary-i386/Packages\n')
+        self.policy.releaseFile(self.url, release)
+        self.failUnlessEqual(self.policy.validUntil[self.url], 10200)
+
+        self.policy.validated(self.url, self.Headers(date = 10000, last_modified = 4000), now = 10000)
+        self.failUnless(self.policy.isFresh(self.url, 10199))
+        self.failIf(self.policy.isFresh(self.url, 10200))
@@ -1,10 +1,26 @@
 
-"""Manage all download requests to a single site."""
+"""Manage all download requests to a single site.
+
+@type DNS_REFRESH: C{int}
+@var DNS_REFRESH: the number of seconds to use the resolved addresses of a
+    site before looking them up again
+@type EWMA_WEIGHT: C{float}
+@var EWMA_WEIGHT: the weight of a new sample in the moving averages of the
+    download speed and response time
+@type EWMA_EXPIRE: C{int}
+@var EWMA_EXPIRE: the number of seconds after the last sample that a moving
+    average is forgotten
+@type RATE_BURST: C{float}
+@var RATE_BURST: the number of seconds of data at the limited rate that can
+    be read in a burst
+"""
 
 from math import exp
-from datetime import datetime, timedelta
+import socket
 
-from twisted.internet import reactor, defer, protocol
+from twisted.internet import reactor, defer, protocol, threads
+from twisted.internet.abstract import isIPAddress
+from twisted.internet.error import DNSLookupError
 from twisted.internet.protocol import ClientFactory
 from twisted import version as twisted_version
 from twisted.python import log
@@ -17,6 +33,12 @@ from twisted.trial import unittest
 from zope.interface import implements
 
 from apt_p2p_conf import version
+from util import monotonic
+
+DNS_REFRESH = 3600
+EWMA_WEIGHT = 0.2
+EWMA_EXPIRE = 3600
+RATE_BURST = 0.25
 
 class PipelineError(Exception):
     """An error has occurred in pipelining requests."""
@@ -45,13 +67,155 @@ class FixedHTTPClientChannelRequest(HTTPClientChannelRequest):
         self.started = True
         HTTPClientChannelRequest.gotInitialLine(self, initialLine)
     
+class RateLimiter:
+    """Limit the rate data is read from some connections to.
+    
+    The limit is shared by all the connections, the bytes they read are
+    taken from a bucket that is refilled at the limited rate. Connections
+    that empty the bucket stop reading from their sockets (so TCP slows the
+    sender down) until it has been refilled.
+    
+    @type rate: C{int}
+    @ivar rate: the maximum number of bytes to read per second
+    @type capacity: C{float}
+    @ivar capacity: the maximum number of bytes in the bucket
+    @type available: C{float}
+    @ivar available: the number of bytes in the bucket, negative if more
+        have been read than are available
+    @type updated: C{float}
+    @ivar updated: the monotonic time the bucket was last refilled
+    @type waiting: C{list} of L{LoggingHTTPClientProtocol}
+    @ivar waiting: the connections waiting for the bucket to be refilled
+    @type resume_later: L{twisted.internet.interfaces.IDelayedCall}
+    @ivar resume_later: the delayed call to resume the waiting connections
+    """
+    
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = rate * RATE_BURST
+        self.available = self.capacity
+        self.updated = monotonic()
+        self.waiting = []
+        self.resume_later = None
+        
+    def _refill(self):
+        """Add the bytes for the time since the last refill to the bucket."""
+        now = monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def registerRead(self, length):
+        """Take some bytes that were read from the bucket.
+        
+        @type length: C{int}
+        @param length: the number of bytes that were read
+        @rtype: C{boolean}
+        @return: whether the connection should stop reading
+        """
+        self._refill()
+        self.available -= length
+        return self.available < 0
+    
+    def isThrottled(self):
+        """Check whether connections must wait for the bucket to be refilled."""
+        self._refill()
+        return self.available < 0
+    
+    def wait(self, proto):
+        """Resume reading on a connection once the bucket has been refilled."""
+        if proto not in self.waiting:
+            self.waiting.append(proto)
+        if self.resume_later is None or not self.resume_later.active():
+            self.resume_later = reactor.callLater(max(0.0, -self.available / self.rate), self._resume)
+    
+    def forget(self, proto):
+        """Stop waiting for the bucket to be refilled for a connection."""
+        if proto in self.waiting:
+            self.waiting.remove(proto)
+    
+    def _resume(self):
+        """Resume reading on the waiting connections, if there's data available."""
+        self.resume_later = None
+        if self.isThrottled():
+            self.resume_later = reactor.callLater(-self.available / self.rate, self._resume)
+            return
+        waiting = self.waiting
+        self.waiting = []
+        for proto in waiting:
+            proto.unthrottleReads()
+    
+    def stop(self):
+        """Stop waiting to resume connections."""
+        if self.resume_later and self.resume_later.active():
+            self.resume_later.cancel()
+        self.resume_later = None
+        self.waiting = []
+
 class LoggingHTTPClientProtocol(HTTPClientProtocol):
-    """A modified client protocol that logs the number of bytes received."""
+    """A modified client protocol that logs the number of bytes received.
     
-    def __init__(self, factory, stats = None, mirror = False):
+    The rate data is read at can also be limited. The response streams also
+    pause and resume reading from the connection as their buffers fill and
+    empty, so the connection only resumes once neither is holding it.
+    
+    @type limiters: C{list} of L{RateLimiter}
+    @ivar limiters: the rate limits to apply to reading data
+    @type throttled: C{boolean}
+    @ivar throttled: whether reading from the connection is paused by the limits
+    @type streamPaused: C{boolean}
+    @ivar streamPaused: whether reading from the connection is paused by the
+        response stream
+    """
+    
+    def __init__(self, factory, stats = None, mirror = False, limiters = None):
         HTTPClientProtocol.__init__(self, factory)
         self.stats = stats
         self.mirror = mirror
+        self.limiters = limiters or []
+        self.throttled = False
+        self.streamPaused = False
+    
+    def pauseProducing(self):
+        self.streamPaused = True
+        HTTPClientProtocol.pauseProducing(self)
+    
+    def resumeProducing(self):
+        self.streamPaused = False
+        if self.throttled:
+            # Reading resumes once the limits allow it
+            return
+        HTTPClientProtocol.resumeProducing(self)
+    
+    def dataReceived(self, data):
+        throttle = False
+        for limiter in self.limiters:
+            if limiter.registerRead(len(data)):
+                throttle = True
+        HTTPClientProtocol.dataReceived(self, data)
+        if throttle:
+            self.throttleReads()
+    
+    def throttleReads(self):
+        """Stop reading from the connection until the limits allow it."""
+        if self.throttled or self.transport is None or not self.connected:
+            return
+        self.throttled = True
+        self.transport.pauseProducing()
+        for limiter in self.limiters:
+            if limiter.isThrottled():
+                limiter.wait(self)
+    
+    def unthrottleReads(self):
+        """Resume reading from the connection, if all the limits allow it."""
+        if not self.throttled:
+            return
+        for limiter in self.limiters:
+            if limiter.isThrottled():
+                limiter.wait(self)
+                return
+        self.throttled = False
+        if self.transport is not None and self.connected and not self.streamPaused:
+            self.transport.resumeProducing()
     
     def lineReceived(self, line):
         if self.stats:
@@ -109,6 +273,8 @@ class LoggingHTTPClientProtocol(HTTPClientProtocol):
             self.manager.clientPipelining(self)
 
     def connectionLost(self, reason):
+        for limiter in self.limiters:
+            limiter.forget(self)
         self.readPersistent = False
         self.setTimeout(None)
         self.manager.clientGone(self)
@@ -122,6 +288,113 @@ class LoggingHTTPClientProtocol(HTTPClientProtocol):
             if request is not None:
                 request.connectionLost(PipelineError('Pipelined connection was closed.'))
                 
+class MovingAverage:
+    """An exponentially weighted moving average of recent samples.
+    
+    Adding a sample and getting the average both take constant time. If no
+    samples have been added in the last L{EWMA_EXPIRE} seconds, the
+    average is forgotten and the default is used instead.
+    
+    @type default: C{float}
+    @ivar default: the value to use when there are no recent samples
+    @type value: C{float}
+    @ivar value: the current average (or None if there is none yet)
+    @type updated: C{float}
+    @ivar updated: the monotonic time the last sample was added
+    """
+    
+    def __init__(self, default):
+        self.default = default
+        self.value = None
+        self.updated = None
+        
+    def __repr__(self):
+        return "<MovingAverage %r>" % (self.average(), )
+    
+    def add(self, sample, now = None):
+        """Add a new sample to the average.
+        
+        @type sample: C{float}
+        @param sample: the new value
+        @type now: C{float}
+        @param now: the monotonic time of the sample (optional, defaults to now)
+        """
+        if now is None:
+            now = monotonic()
+        if self.value is None or now - self.updated > EWMA_EXPIRE:
+            self.value = float(sample)
+        else:
+            self.value += EWMA_WEIGHT * (sample - self.value)
+        self.updated = now
+    
+    def average(self, now = None):
+        """Get the current value of the average.
+        
+        @type now: C{float}
+        @param now: the current monotonic time (optional, defaults to now)
+        """
+        if self.value is None:
+            return self.default
+        if now is None:
+            now = monotonic()
+        if now - self.updated > EWMA_EXPIRE:
+            self.value = None
+            return self.default
+        return self.value
+
+def downloadAverage():
+    """Create a moving average of download speeds.
+    
+    If there are none, then you get 150 KB/s.
+    """
+    return MovingAverage(150000.0)
+
+def responseAverage():
+    """Create a moving average of response times.
+    
+    If there are none, give it the benefit of the doubt (0.1 seconds).
+    """
+    return MovingAverage(0.1)
+
+class PeerAddress:
+    """The health of a single IP address of a site.
+    
+    @type ip: C{string}
+    @ivar ip: the IP address
+    @type errors: C{int}
+    @ivar errors: the number of errors that have occurred for the address
+    @type completed: C{int}
+    @ivar completed: the number of requests completed by the address
+    @type downloadSpeed: L{MovingAverage}
+    @ivar downloadSpeed: the recent download speed from the address
+    @type responseTime: L{MovingAverage}
+    @ivar responseTime: the recent response time of the address
+    """
+    
+    def __init__(self, ip):
+        self.ip = ip
+        self.errors = 0
+        self.completed = 0
+        self.downloadSpeed = downloadAverage()
+        self.responseTime = responseAverage()
+        
+    def __repr__(self):
+        return "(%r, %d/%d)" % (self.ip, self.errors, self.completed)
+        
+    def rank(self):
+        """Determine the health of the address, from 1 (best) to 0.
+        
+        @see: L{Peer.rerank}
+        """
+        rank = 1.0
+        speed = self.downloadSpeed.average()
+        if speed > 0.0:
+            rank *= exp(-512.0*1024 / speed)
+        if self.completed:
+            rank *= exp(-10.0 * self.errors / self.completed)
+        rank *= exp(-self.responseTime.average() / 5.0)
+        return rank
+
 class Peer(ClientFactory):
     """A manager for all HTTP requests to a single peer.
     
@@ -129,14 +402,37 @@ class Peer(ClientFactory):
     This includes buffering requests until they can be sent and reconnecting
     in the event of the connection being closed.
     
+    Sites given by name are resolved to all their IP addresses, and requests
+    are sent to a single one of them (the healthiest) rather than whichever
+    the DNS rotation returns. If the address returns a 404 or a hash error,
+    the next address in the rotation is used.
+    
+    @type addresses: C{list} of L{PeerAddress}
+    @ivar addresses: the resolved addresses of the site, in rotation order
+    @type address: L{PeerAddress}
+    @ivar address: the address requests are currently sent to
+    @type connectedAddress: L{PeerAddress}
+    @ivar connectedAddress: the address of the open connection
+    @type pool: L{PeerManager.PeerManager}
+    @ivar pool: the manager of the connections to all peers (optional)
+    @type lastActivity: C{float}
+    @ivar lastActivity: the last (monotonic) time a request was sent or answered
+    @type lastData: C{float}
+    @ivar lastData: the last (monotonic) time the peer successfully responded
+        with data, or None if it never has
+    @type limiters: C{list} of L{RateLimiter}
+    @ivar limiters: the rate limits to apply to downloads from the peer
     """
 
     implements(IHTTPClientManager)
     
-    def __init__(self, host, port = 80, stats = None):
+    def __init__(self, host, port = 80, stats = None, pool = None):
         self.host = host
         self.port = port
         self.stats = stats
+        self.pool = pool
+        self.lastActivity = monotonic()
+        self.lastData = None
         self.mirror = False
         self.rank = 0.01
         self.busy = False
@@ -147,11 +443,16 @@ class Peer(ClientFactory):
         self.outstanding = 0
         self.proto = None
         self.connector = None
+        self.addresses = []
+        self.address = None
+        self.connectedAddress = None
+        self.limiters = []
+        self._lookupTime = None
         self._errors = 0
         self._completed = 0
-        self._downloadSpeeds = []
+        self._downloadSpeed = downloadAverage()
         self._lastResponse = None
-        self._responseTimes = []
+        self._responseTime = responseAverage()
     
     def __repr__(self):
         return "(%r, %r, %r)" % (self.host, self.port, self.rank)
@@ -160,15 +461,90 @@ class Peer(ClientFactory):
     def connect(self):
         """Connect to the peer."""
         assert self.closed and not self.connecting
-        log.msg('Connecting to (%s, %d)' % (self.host, self.port))
         self.connecting = True
+        if (not isIPAddress(self.host) and (self._lookupTime is None or
+            monotonic() - self._lookupTime > DNS_REFRESH)):
+            d = self.lookupAddresses()
+            d.addCallback(self._connect)
+            d.addErrback(self.connectionError)
+        else:
+            self._connect()
+        
+    def _connect(self, result = None):
+        """Connect to the pinned address of the peer."""
+        if self.pool:
+            self.pool.connecting(self)
+        if self.address is None:
+            if self.addresses:
+                self.address = self._healthiestAddress()
+            else:
+                self.address = PeerAddress(self.host)
+        log.msg('Connecting to (%s, %d) at %s' % (self.host, self.port, self.address.ip))
+        self.connectedAddress = self.address
         d = protocol.ClientCreator(reactor, LoggingHTTPClientProtocol, self,
-                                   stats = self.stats, mirror = self.mirror).connectTCP(self.host, self.port, timeout = 10)
+                                   stats = self.stats, mirror = self.mirror,
+                                   limiters = self.limiters).connectTCP(self.address.ip, self.port, timeout = 10)
         d.addCallbacks(self.connected, self.connectionError)
 
+    def lookupAddresses(self):
+        """Resolve all the IP addresses of the peer's host name.
+        
+        @rtype: L{twisted.internet.defer.Deferred}
+        @return: a deferred that will fire when the lookup is complete
+        """
+        log.msg('Looking up the addresses of %s' % self.host)
+        d = threads.deferToThread(socket.gethostbyname_ex, self.host)
+        d.addCallbacks(self._gotAddresses, self._lookupError)
+        return d
+    
+    def _gotAddresses(self, result):
+        """Save the resolved addresses, keeping the health of known ones."""
+        name, aliases, ips = result
+        if not ips:
+            return self._lookupError(DNSLookupError(self.host))
+        
+        self._lookupTime = monotonic()
+        known = dict([(address.ip, address) for address in self.addresses])
+        self.addresses = [known.get(ip, None) or PeerAddress(ip) for ip in ips]
+        if self.address not in self.addresses:
+            self.address = None
+        log.msg('Found addresses for %s: %r' % (self.host, self.addresses))
+        
+    def _lookupError(self, err):
+        """Use the old addresses if the lookup fails, if there are any."""
+        if self.addresses:
+            log.msg('Failed to lookup %s, using the old addresses: %r' % (self.host, err))
+            self._lookupTime = monotonic()
+            return None
+        if not isinstance(err, DNSLookupError):
+            err = DNSLookupError(self.host)
+        raise err
+    
+    def _healthiestAddress(self):
+        """Find the healthiest of the resolved addresses."""
+        best = self.addresses[0]
+        for address in self.addresses[1:]:
+            if address.rank() > best.rank():
+                best = address
+        return best
+    
+    def failover(self):
+        """Switch future requests to the next address in the rotation.
+        
+        The switch happens once the outstanding requests to the current
+        address are complete.
+        """
+        if len(self.addresses) < 2 or self.address not in self.addresses:
+            return
+        i = self.addresses.index(self.address)
+        self.address = self.addresses[(i + 1) % len(self.addresses)]
+        log.msg('Failing over (%s, %d) to %s' % (self.host, self.port, self.address.ip))
+        if self.request_queue:
+            reactor.callLater(0, self.processQueue)
+        
     def connected(self, proto):
         """Begin processing the queued requests."""
-        log.msg('Connected to (%s, %d)' % (self.host, self.port))
+        log.msg('Connected to (%s, %d) at %s' % (self.host, self.port, self.connectedAddress.ip))
         self.closed = False
         self.connecting = False
         self.proto = proto
@@ -181,11 +557,15 @@ class Peer(ClientFactory):
 
         # Remove one request so that we don't loop indefinitely
         if self.request_queue:
-            req, deferRequest, submissionTime = self.request_queue.pop(0)
+            req, deferRequest, submissionTime, tried, priority = self.request_queue.pop(0)
             deferRequest.errback(err)
             
         self._completed += 1
         self._errors += 1
+        if self.connectedAddress is not None:
+            self.connectedAddress.completed += 1
+            self.connectedAddress.errors += 1
+            self.failover()
         self.rerank()
         if self.connecting:
             self.connecting = False
@@ -196,15 +576,25 @@ class Peer(ClientFactory):
         if not self.closed:
             self.proto.transport.loseConnection()
 
-    def submitRequest(self, request):
+    def submitRequest(self, request, priority = 0):
         """Add a new request to the queue.
         
+        The request is queued behind the other requests of the same or a
+        more urgent priority, but ahead of any less urgent ones.
+        
         @type request: L{twisted.web2.client.http.ClientRequest}
+        @type priority: C{int}
+        @param priority: the priority of the request, lower is more urgent
+            (optional, defaults to 0)
         @return: deferred that will fire with the completed request
         """
-        submissionTime = datetime.now()
+        submissionTime = monotonic()
+        self.lastActivity = submissionTime
         deferRequest = defer.Deferred()
-        self.request_queue.append((request, deferRequest, submissionTime))
+        i = len(self.request_queue)
+        while i > 0 and self.request_queue[i-1][4] > priority:
+            i -= 1
+        self.request_queue.insert(i, (request, deferRequest, submissionTime, [], priority))
         self.rerank()
         reactor.callLater(0, self.processQueue)
         return deferRequest
@@ -218,6 +608,11 @@ class Peer(ClientFactory):
         if self.closed:
             self.connect()
             return
+        if self.connectedAddress is not self.address:
+            # Switch addresses once the outstanding requests are done
+            if not self.outstanding:
+                self.close()
+            return
         if self.busy and not self.pipeline:
             return
         if self.outstanding and not self.pipeline:
@@ -229,51 +624,81 @@ class Peer(ClientFactory):
                     (self.proto.readPersistent, self.proto.inRequests))
             return
 
-        req, deferRequest, submissionTime = self.request_queue.pop(0)
+        req, deferRequest, submissionTime, tried, priority = self.request_queue.pop(0)
         try:
             deferResponse = self.proto.submitRequest(req, False)
         except:
             # Try again later
-            log.msg('Got an error trying to submit a new HTTP request %s' % (request.uri, ))
+            log.msg('Got an error trying to submit a new HTTP request %s' % (req.uri, ))
             log.err()
-            self.request_queue.insert(0, (request, deferRequest, submissionTime))
-            ractor.callLater(1, self.processQueue)
+            self.request_queue.insert(0, (req, deferRequest, submissionTime, tried, priority))
+            reactor.callLater(1, self.processQueue)
             return
             
         self.outstanding += 1
         self.rerank()
+        if self.stats:
+            self.stats.sentRequest(self.mirror)
+        tried.append(self.connectedAddress)
         deferResponse.addCallbacks(self.requestComplete, self.requestError,
-                                   callbackArgs = (req, deferRequest, submissionTime),
-                                   errbackArgs = (req, deferRequest))
+                                   callbackArgs = (req, deferRequest, submissionTime, tried, priority),
+                                   errbackArgs = (req, deferRequest, tried))
 
-    def requestComplete(self, resp, req, deferRequest, submissionTime):
+    def requestComplete(self, resp, req, deferRequest, submissionTime, tried, priority):
         """Process a completed request."""
         self._processLastResponse()
         self.outstanding -= 1
         assert self.outstanding >= 0
         log.msg('%s of %s completed with code %d (%r)' % (req.method, req.uri, resp.code, resp.headers))
         self._completed += 1
-        now = datetime.now()
-        self._responseTimes.append((now, now - submissionTime))
-        self._lastResponse = (now, resp.stream.length)
+        address = tried[-1]
+        address.completed += 1
+        now = monotonic()
+        self.lastActivity = now
+        self._responseTime.add(now - submissionTime, now)
+        address.responseTime.add(now - submissionTime, now)
+        
+        if resp.code == 404 and [a for a in self.addresses if a not in tried]:
+            # This address may be out of sync, try the request on the next one
+            log.msg('Address %s is missing %s, trying the next address' % (address.ip, req.uri))
+            address.errors += 1
+            if resp.stream and resp.stream.length:
+                stream_mod.readAndDiscard(resp.stream)
+            if self.address is address:
+                self.failover()
+            self.request_queue.insert(0, (req, deferRequest, submissionTime, tried, priority))
+            self.rerank()
+            reactor.callLater(0, self.processQueue)
+            return
+        
+        if resp.code in (200, 206) and resp.stream and resp.stream.length:
+            self.lastData = now
+        self._lastResponse = (now, resp.stream.length, address)
         self.rerank()
         deferRequest.callback(resp)
 
-    def requestError(self, error, req, deferRequest):
+    def requestError(self, error, req, deferRequest, tried):
         """Process a request that ended with an error."""
         self._processLastResponse()
         self.outstanding -= 1
         assert self.outstanding >= 0
         log.msg('Download of %s generated error %r' % (req.uri, error))
+        self.lastActivity = monotonic()
         self._completed += 1
         self._errors += 1
+        tried[-1].completed += 1
+        tried[-1].errors += 1
         self.rerank()
         deferRequest.errback(error)
         
     def hashError(self, error):
-        """Log that a hash error occurred from the peer."""
+        """Log that a hash error occurred from the peer, and try another address."""
         log.msg('Hash error from peer (%s, %d): %r' % (self.host, self.port, error))
         self._errors += 1
+        if self.connectedAddress is not None:
+            self.connectedAddress.errors += 1
+            if self.address is self.connectedAddress:
+                self.failover()
         self.rerank()
 
     #{ IHTTPClientManager interface
@@ -315,7 +740,7 @@ class Peer(ClientFactory):
                           (version.short(), twisted_version.short(), web2_version.short()))
         return headers
     
-    def get(self, path, method="GET", modtime=None):
+    def get(self, path, method="GET", modtime=None, priority=0):
         """Add a new request to the queue.
         
         @type path: C{string}
@@ -327,13 +752,16 @@ class Peer(ClientFactory):
         @param modtime: the modification time to use for an 'If-Modified-Since'
             header, as seconds since the epoch
             (optional, defaults to not sending that header)
+        @type priority: C{int}
+        @param priority: the priority of the request, lower is more urgent
+            (optional, defaults to 0)
         """
         headers = self.setCommonHeaders()
         if modtime:
             headers.setHeader('If-Modified-Since', modtime)
-        return self.submitRequest(ClientRequest(method, path, headers, None))
+        return self.submitRequest(ClientRequest(method, path, headers, None), priority)
     
-    def getRange(self, path, rangeStart, rangeEnd, method="GET"):
+    def getRange(self, path, rangeStart, rangeEnd, method="GET", priority=0):
         """Add a new request with a Range header to the queue.
         
         @type path: C{string}
@@ -345,67 +773,71 @@ class Peer(ClientFactory):
         @type method: C{string}
         @param method: the HTTP method to use, 'GET' or 'HEAD'
             (optional, defaults to 'GET')
+        @type priority: C{int}
+        @param priority: the priority of the request, lower is more urgent
+            (optional, defaults to 0)
         """
         headers = self.setCommonHeaders()
         headers.setHeader('Range', ('bytes', [(rangeStart, rangeEnd)]))
-        return self.submitRequest(ClientRequest(method, path, headers, None))
+        return self.submitRequest(ClientRequest(method, path, headers, None), priority)
     
     #{ Peer information
     def isIdle(self):
         """Check whether the peer is idle or not."""
         return not self.busy and not self.request_queue and not self.outstanding
     
+    def isConnected(self):
+        """Check whether the peer has (or is opening) a connection."""
+        return not self.closed or self.connecting
+    
+    def summary(self):
+        """Get a compact summary of the peer's performance, to save for later.
+        
+        @rtype: (C{int}, C{int}, C{float}, C{float})
+        @return: the number of errors and completed requests, and the
+            download speed and response time
+        """
+        return (self._errors, self._completed, self.downloadSpeed(), self.responseTime())
+    
+    def setSummary(self, summary):
+        """Restore the performance of the peer from a saved summary.
+        
+        @see: L{summary}
+        """
+        errors, completed, speed, responseTime = summary
+        self._errors = errors
+        self._completed = completed
+        self._downloadSpeed = downloadAverage()
+        self._downloadSpeed.add(speed)
+        self._responseTime = responseAverage()
+        self._responseTime.add(responseTime)
+        self.rerank()
+    
     def _processLastResponse(self):
         """Save the download time of the last request for speed calculations."""
         if self._lastResponse is not None:
             if self._lastResponse[1] is not None:
-                now = datetime.now()
-                self._downloadSpeeds.append((now, now - self._lastResponse[0], self._lastResponse[1]))
+                now = monotonic()
+                speed = self._lastResponse[1] / max(now - self._lastResponse[0], 0.001)
+                self._downloadSpeed.add(speed, now)
+                self._lastResponse[2].downloadSpeed.add(speed, now)
             self._lastResponse = None
             
     def downloadSpeed(self):
         """Gets the latest average download speed for the peer.
         
-        The average is over the last 10 responses that occurred in the last hour.
+        The average is a moving average of the responses in the last hour.
         """
-        total_time = 0.0
-        total_download = 0
-        now = datetime.now()
-        while self._downloadSpeeds and (len(self._downloadSpeeds) > 10 or 
-                                        now - self._downloadSpeeds[0][0] > timedelta(seconds=3600)):
-            self._downloadSpeeds.pop(0)
-
-        # If there are none, then you get 0
-        if not self._downloadSpeeds:
-            return 150000.0
-        
-        for download in self._downloadSpeeds:
-            total_time += download[1].days*86400.0 + download[1].seconds + download[1].microseconds/1000000.0
-            total_download += download[2]
-
-        return total_download / total_time
+        return self._downloadSpeed.average()
     
     def responseTime(self):
         """Gets the latest average response time for the peer.
         
         Response time is the time from receiving the request, to the time
-        the download begins. The average is over the last 10 responses that
-        occurred in the last hour.
+        the download begins. The average is a moving average of the
+        responses in the last hour.
         """
-        total_response = 0.0
-        now = datetime.now()
-        while self._responseTimes and (len(self._responseTimes) > 10 or 
-                                       now - self._responseTimes[0][0] > timedelta(seconds=3600)):
-            self._responseTimes.pop(0)
-
-        # If there are none, give it the benefit of the doubt
-        if not self._responseTimes:
-            return 0.1
-
-        for response in self._responseTimes:
-            total_response += response[1].days*86400.0 + response[1].seconds + response[1].microseconds/1000000.0
-
-        return total_response / len(self._responseTimes)
+        return self._responseTime.average()
     
     def rerank(self):
         """Determine the ranking value for the peer.
@@ -436,6 +868,8 @@ class TestClientManager(unittest.TestCase):
     client = None
     pending_calls = []
     length = []
+    listener = None
+    limiter = None
     
     def gotResp(self, resp, num, expect):
         self.failUnless(resp.code >= 200 and resp.code < 300, "Got a non-200 response: %r" % resp.code)
@@ -615,6 +1049,106 @@ class TestClientManager(unittest.TestCase):
         d.addCallback(lambda a: self.flushLoggedErrors(NoRouteError))
         return d
         
+    def test_moving_average(self):
+        """Tests the moving averages used to rank peers."""
+        average = MovingAverage(0.1)
+        self.failUnlessEqual(average.average(), 0.1)
+        average.add(1.0, 100.0)
+        self.failUnlessEqual(average.average(100.0), 1.0)
+        for i in xrange(50):
+            average.add(2.0, 100.0 + i)
+        self.failUnless(abs(average.average(150.0) - 2.0) < 0.001)
+        
+        # Old averages are forgotten
+        self.failUnlessEqual(average.average(150.0 + EWMA_EXPIRE), 0.1)
+        
+    def test_address_rotation(self):
+        """Tests pinning and failing over the resolved addresses of a site."""
+        self.client = Peer('mirror.example.com', 80)
+        self.client._gotAddresses(('mirror.example.com', [], ['10.0.0.1', '10.0.0.2', '10.0.0.3']))
+        self.failUnlessEqual(len(self.client.addresses), 3)
+        
+        # The first address is the healthiest after an error on another
+        self.client.addresses[1].completed = 1
+        self.client.addresses[1].errors = 1
+        self.client.address = self.client._healthiestAddress()
+        self.client.connectedAddress = self.client.address
+        self.failIfEqual(self.client.address.ip, '10.0.0.2')
+        
+        # A hash error moves to the next address in the rotation
+        first = self.client.address
+        self.client.hashError('Piece received from peer does not match expected')
+        self.failIfIdentical(self.client.address, first)
+        self.failUnlessEqual(first.errors, 1)
+        
+        # A new lookup keeps the health of the known addresses
+        self.client._gotAddresses(('mirror.example.com', [], ['10.0.0.2', '10.0.0.4']))
+        self.failUnlessEqual(self.client.addresses[0].errors, 1)
+        self.failUnlessEqual(self.client.addresses[1].errors, 0)
+
+    def test_rate_limit(self):
+        """Tests the accuracy of the download rate limit with a local server."""
+        from twisted.web2 import server, channel, static
+        data = '0123456789abcdef' * 25600
+        site = server.Site(static.Data(data, 'application/octet-stream'))
+        self.listener = reactor.listenTCP(0, channel.HTTPFactory(site), interface = '127.0.0.1')
+        self.client = Peer('127.0.0.1', self.listener.getHost().port)
+        self.limiter = RateLimiter(100*1024)
+        self.client.limiters = [self.limiter]
+        self.timeout = 30
+        received = []
+        start = monotonic()
+        
+        def gotResp(resp):
+            self.failUnlessEqual(resp.code, 200)
+            return stream_mod.readStream(resp.stream, received.append)
+        
+        def checkRate(result):
+            self.failUnlessEqual(''.join(received), data)
+            rate = (len(data) - self.limiter.capacity) / (monotonic() - start)
+            log.msg('Download rate was %0.0f bytes/sec, limited to %d' % (rate, self.limiter.rate))
+            self.failUnless(rate > 0.8 * self.limiter.rate and rate < 1.2 * self.limiter.rate,
+                            "Download rate %r is not close to %r" % (rate, self.limiter.rate))
+        
+        d = self.client.get('/')
+        d.addCallback(gotResp)
+        d.addCallback(checkRate)
+        return d
+
+    def test_throttled_resume(self):
+        """Tests that the response stream can't resume a throttled connection."""
+        class PausableTransport:
+            paused = False
+            def pauseProducing(self):
+                self.paused = True
+            def resumeProducing(self):
+                self.paused = False
+        
+        self.limiter = RateLimiter(1024)
+        proto = LoggingHTTPClientProtocol(None, limiters = [self.limiter])
+        proto.transport = PausableTransport()
+        proto.connected = 1
+        
+        # The stream resuming is ignored until the limit allows reading
+        self.limiter.available = -1024.0
+        proto.throttleReads()
+        proto.pauseProducing()
+        proto.resumeProducing()
+        self.failUnless(proto.transport.paused)
+        self.limiter.available = self.limiter.capacity
+        proto.unthrottleReads()
+        self.failIf(proto.transport.paused)
+        
+        # The limit allowing reading doesn't resume a paused stream
+        self.limiter.available = -1024.0
+        proto.throttleReads()
+        proto.pauseProducing()
+        self.limiter.available = self.limiter.capacity
+        proto.unthrottleReads()
+        self.failUnless(proto.transport.paused)
+        proto.resumeProducing()
+        self.failIf(proto.transport.paused)
+
     def tearDown(self):
         for p in self.pending_calls:
             if p.active():
@@ -623,3 +1157,9 @@ class TestClientManager(unittest.TestCase):
         if self.client:
             self.client.close()
             self.client = None
+        if self.limiter:
+            self.limiter.stop()
+            self.limiter = None
+        if self.listener:
+            self.listener.stopListening()
+            self.listener = None
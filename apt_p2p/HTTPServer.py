@@ -5,17 +5,46 @@ from urllib import quote_plus, unquote_plus
 from binascii import b2a_hex
 import operator
 
-from twisted.python import log
+from twisted.python import log, failure
 from twisted.internet import defer
 from twisted.web2 import server, http, resource, channel, stream
 from twisted.web2 import static, http_headers, responsecode
 from twisted.trial import unittest
 from twisted.python.filepath import FilePath
 
-from policies import ThrottlingFactory, ThrottlingProtocol, ProtocolWrapper
+from policies import ThrottlingFactory, ThrottlingProtocol, ProtocolWrapper, LimitConnectionsByPeer
 from Streams import UploadStream, FileUploadStream, PiecesUploadStream
+from Hash import PIECE_SIZE, HashObject
 from apt_p2p_conf import config
-from apt_p2p_Khashmir.bencode import bencode
+from apt_p2p_Khashmir.bencode import bencode, bdecode
+
+def cachedResponse(resource, fileCache, streamClass = stream.MemoryStream):
+    """Create a response for a static file from the files kept in memory.
+    
+    @type resource: L{twisted.web2.static.File}
+    @param resource: the resource for the file
+    @type fileCache: L{HotCache.HotCache}
+    @param fileCache: the files kept in memory
+    @param streamClass: the class of stream to send the file's contents with
+        (optional, defaults to a L{twisted.web2.stream.MemoryStream})
+    @return: the response, or None if the file is not small enough to be
+        kept in memory
+    """
+    if fileCache is None:
+        return None
+    data = fileCache.read(resource.fp)
+    if data is None:
+        return None
+    
+    response = http.Response()
+    response.stream = streamClass(data)
+    for (header, value) in (
+        ("content-type", resource.contentType()),
+        ("content-encoding", resource.contentEncoding()),
+    ):
+        if value is not None:
+            response.headers.setHeader(header, value)
+    return response
 
 class FileDownloader(static.File):
     """Modified to make it suitable for apt requests.
@@ -43,6 +72,13 @@ class FileDownloader(static.File):
     def renderHTTP(self, req):
         log.msg('Got request for %s from %s' % (req.uri, req.remoteAddr))
         
+        # Files still being downloaded are streamed as they arrive
+        if self.manager:
+            resp = self.manager.cache.get_downloading('http:/' + req.uri)
+            if resp is not None:
+                log.msg('Streaming the file still being downloaded: %s' % req.uri)
+                return resp
+        
         # Make sure the file is in the DB and unchanged
         if self.manager and not self.manager.db.isUnchanged(self.fp):
             if self.fp.exists() and self.fp.isfile():
@@ -60,6 +96,14 @@ class FileDownloader(static.File):
             resp = self._renderHTTP_done(resp, req)
         return resp
         
+    def render(self, req):
+        """Serve small files from memory if possible."""
+        if self.manager:
+            resp = cachedResponse(self, self.manager.db.fileCache)
+            if resp is not None:
+                return resp
+        return super(FileDownloader, self).render(req)
+        
     def _renderHTTP_done(self, resp, req):
         log.msg('Initial response to %s: %r' % (req.uri, resp))
         
@@ -102,9 +146,58 @@ class FileUploader(static.File):
     """Modified to make it suitable for peer requests.
     
     Uses the modified L{Streams.FileUploadStream} to stream the file for throttling,
-    and doesn't do any listing of directory contents.
+    and doesn't do any listing of directory contents. Requests wait for an
+    upload slot before being answered.
+    
+    @type slots: L{UploadSlots}
+    @ivar slots: the upload slots to wait for (optional, defaults to not
+        limiting the number of uploads)
+    @type throttle: C{boolean}
+    @ivar throttle: whether the upload will be throttled (optional,
+        defaults to True)
+    @type fileCache: L{HotCache.HotCache}
+    @ivar fileCache: the files kept in memory to upload from (optional)
     """
 
+    def __init__(self, path, slots = None, throttle = True, fileCache = None,
+                 defaultType="text/plain", ignoredExts=(), processors=None, indexNames=None):
+        self.slots = slots
+        self.throttle = throttle
+        self.fileCache = fileCache
+        super(FileUploader, self).__init__(path, defaultType, ignoredExts, processors, indexNames)
+    
+    def renderHTTP(self, req):
+        if self.slots is None:
+            return super(FileUploader, self).renderHTTP(req)
+        
+        d = self.slots.acquire(req.remoteAddr.host)
+        d.addCallback(self._renderHTTP_slot, req)
+        return d
+    
+    def _renderHTTP_slot(self, result, req):
+        """Render the upload now that it has a slot, releasing it when done."""
+        # Runs after any range filtering, so the final stream is wrapped
+        req.addResponseFilter(self._releaseSlot, atEnd = True)
+        d = defer.maybeDeferred(super(FileUploader, self).renderHTTP, req)
+        d.addErrback(self._renderHTTP_error)
+        return d
+    
+    def _renderHTTP_error(self, err):
+        """Release the slot if the request failed before it was answered."""
+        self.slots.release()
+        self.slots = None
+        return err
+    
+    def _releaseSlot(self, req, resp):
+        """Release the upload slot once the response has been sent."""
+        if self.slots is not None:
+            if resp.stream is None:
+                self.slots.release()
+            else:
+                resp.stream = SlotStream(resp.stream, self.slots.release)
+            self.slots = None
+        return resp
+
     def render(self, req):
         if not self.fp.exists():
             return responsecode.NOT_FOUND
@@ -113,6 +206,11 @@ class FileUploader(static.File):
             # Don't try to render a directory listing
             return responsecode.NOT_FOUND
 
+        # Small files are sent from memory (still throttled as uploads)
+        response = cachedResponse(self, self.fileCache, PiecesUploadStream)
+        if response is not None:
+            return response
+
         try:
             f = self.fp.open()
         except IOError, e:
@@ -126,7 +224,7 @@ class FileUploader(static.File):
 
         response = http.Response()
         # Use the modified FileStream
-        response.stream = FileUploadStream(f, 0, self.fp.getsize())
+        response.stream = FileUploadStream(f, 0, self.fp.getsize(), self.throttle)
 
         for (header, value) in (
             ("content-type", self.contentType()),
@@ -137,6 +235,155 @@ class FileUploader(static.File):
 
         return response
 
+class PartialUploader(FileUploader):
+    """Modified to only upload the verified pieces of a file being downloaded.
+    
+    Only requests for a single range of the file are answered, and only if
+    all the pieces in it have been verified, otherwise the file is not found.
+    The file already has its full size on disk, so only the requested range
+    is streamed, not anything after it that is still being downloaded.
+    
+    @type download: L{PeerManager.FileDownload}
+    @ivar download: the download of the file
+    """
+
+    def __init__(self, download, slots = None, throttle = True):
+        self.download = download
+        super(PartialUploader, self).__init__(download.filePath.path, slots, throttle)
+
+    def render(self, req):
+        range = req.headers.getHeader('range')
+        if range is None or range[0] != 'bytes' or len(range[1]) != 1:
+            return responsecode.NOT_FOUND
+        
+        start, end = range[1][0]
+        if start is None or end is None or not self.download.hasRange(start, end):
+            return responsecode.NOT_FOUND
+        
+        try:
+            f = self.fp.open()
+        except IOError:
+            return responsecode.NOT_FOUND
+        
+        response = http.Response(responsecode.PARTIAL_CONTENT)
+        response.stream = FileUploadStream(f, start, end - start + 1, self.throttle)
+        response.headers.setHeader('content-range', ('bytes', start, end, self.download.hash.expSize))
+        response.headers.setHeader('content-type', self.contentType())
+        return response
+
+class SlotStream(UploadStream):
+    """Wraps the stream of an upload to release its slot when it's done.
+    
+    @ivar stream: the stream being uploaded
+    @type release: C{method}
+    @ivar release: the method to call (once) when the stream is done
+    """
+    
+    def __init__(self, stream, release):
+        self.stream = stream
+        self.length = stream.length
+        self.release = release
+        
+    def read(self):
+        data = self.stream.read()
+        if isinstance(data, defer.Deferred):
+            data.addBoth(self._read)
+            return data
+        return self._read(data)
+    
+    def _read(self, data):
+        """Release the slot at the end of the stream."""
+        if data is None or isinstance(data, failure.Failure):
+            self._done()
+        else:
+            self.length = self.stream.length
+        return data
+    
+    def close(self):
+        self.stream.close()
+        self.length = 0
+        self._done()
+        
+    def _done(self):
+        if self.release:
+            self.release()
+            self.release = None
+    
+class UploadSlots:
+    """Limit the number of uploads to peers that are sent at once.
+    
+    Requests from peers that arrive while all the slots are in use wait
+    for one to be freed. The waiting peers take turns getting the freed
+    slots, so a peer that sends many (pipelined) requests does not get
+    more than its share of them. Peers that are uploading to us can
+    optionally be given the freed slots first.
+    
+    @type slots: C{int}
+    @ivar slots: the number of uploads that can be sent at once
+    @type active: C{int}
+    @ivar active: the number of slots currently in use
+    @type waiting: C{list} of (C{string}, C{list} of L{twisted.internet.defer.Deferred})
+    @ivar waiting: the hosts of peers waiting for a slot and the requests
+        they are waiting with, in the order the peers take turns in
+    @type preferred: C{method}
+    @ivar preferred: takes the host of a peer and returns whether it should
+        be given a slot before the other peers (optional)
+    """
+    
+    def __init__(self, slots, preferred = None):
+        self.slots = slots
+        self.active = 0
+        self.waiting = []
+        self.preferred = preferred
+        
+    def acquire(self, host):
+        """Wait for an upload slot for a peer.
+        
+        @type host: C{string}
+        @param host: the host of the peer the upload is to
+        @rtype: L{twisted.internet.defer.Deferred}
+        @return: fires when the upload has a slot, which must then be
+            released with L{release}
+        """
+        d = defer.Deferred()
+        if self.active < self.slots and not self.waiting:
+            self.active += 1
+            d.callback(host)
+            return d
+        
+        for waitingHost, requests in self.waiting:
+            if waitingHost == host:
+                requests.append(d)
+                break
+        else:
+            self.waiting.append((host, [d]))
+        log.msg('Waiting for an upload slot for %s' % host)
+        return d
+    
+    def release(self):
+        """An upload is done with its slot, give it to the next waiting peer."""
+        self.active -= 1
+        assert self.active >= 0
+        while self.waiting and self.active < self.slots:
+            host, d = self._next()
+            self.active += 1
+            d.callback(host)
+        
+    def _next(self):
+        """Remove and return the next waiting peer and request to get a slot."""
+        i = 0
+        if self.preferred:
+            for j in xrange(len(self.waiting)):
+                if self.preferred(self.waiting[j][0]):
+                    i = j
+                    break
+        host, requests = self.waiting.pop(i)
+        d = requests.pop(0)
+        if requests:
+            # Let the other peers have a turn first
+            self.waiting.append((host, requests))
+        return host, d
+
 class UploadThrottlingProtocol(ThrottlingProtocol):
     """Protocol for throttling uploads.
     
@@ -182,7 +429,9 @@ class TopLevel(resource.Resource):
     @ivar db: the database to use for looking up files and hashes
     @type manager: L{apt_p2p.AptP2P}
     @ivar manager: the main program object to send requests to
-    @type factory: L{twisted.web2.channel.HTTPFactory} or L{policies.ThrottlingFactory}
+    @type uploadSlots: L{UploadSlots}
+    @ivar uploadSlots: the limit on the number of uploads to peers at once
+    @type factory: L{policies.LimitConnectionsByPeer}
     @ivar factory: the factory to use to serve HTTP requests
     """
     
@@ -204,6 +453,13 @@ class TopLevel(resource.Resource):
         self.uploadLimit = None
         if config.getint('DEFAULT', 'UPLOAD_LIMIT') > 0:
             self.uploadLimit = int(config.getint('DEFAULT', 'UPLOAD_LIMIT')*1024)
+        self.uploadBurst = int(config.getint('DEFAULT', 'UPLOAD_BURST')*1024)
+        self.uploadSlots = None
+        if config.getint('DEFAULT', 'UPLOAD_SLOTS') > 0:
+            preferred = None
+            if config.getboolean('DEFAULT', 'UPLOAD_RECIPROCATE'):
+                preferred = self.uploadedRecently
+            self.uploadSlots = UploadSlots(config.getint('DEFAULT', 'UPLOAD_SLOTS'), preferred)
         self.factory = None
 
     def getHTTPFactory(self):
@@ -212,12 +468,28 @@ class TopLevel(resource.Resource):
             self.factory = channel.HTTPFactory(server.Site(self),
                                                **{'maxPipeline': 10, 
                                                   'betweenRequestsTimeOut': 60})
-            self.factory = ThrottlingFactory(self.factory, writeLimit = self.uploadLimit)
+            self.factory = ThrottlingFactory(self.factory, writeLimit = self.uploadLimit,
+                                             writeBurst = self.uploadBurst)
             self.factory.protocol = UploadThrottlingProtocol
             if self.manager:
                 self.factory.protocol.stats = self.manager.stats
+            self.factory = LimitConnectionsByPeer(self.factory)
+            self.factory.maxConnectionsPerPeer = config.getint('DEFAULT', 'UPLOAD_PEER_CONNECTIONS')
+            self.factory.unlimitedHosts = ('127.0.0.1', )
         return self.factory
 
+    def uploadedRecently(self, host):
+        """Check whether a peer has recently uploaded to us."""
+        if self.manager and getattr(self.manager, 'peers', None):
+            return self.manager.peers.uploadedRecently(host)
+        return False
+
+    def partialDownload(self, hash):
+        """Find a download in progress that is sharing its verified pieces."""
+        if self.manager and getattr(self.manager, 'peers', None):
+            return self.manager.peers.partialDownload(hash)
+        return None
+
     def render(self, ctx):
         """Render a web page with descriptive statistics."""
         if self.manager:
@@ -250,14 +522,45 @@ class TopLevel(resource.Resource):
                 # If it is a file, return it
                 if 'path' in files[0]:
                     log.msg('Sharing %s with %s' % (files[0]['path'].path, request.remoteAddr))
-                    return FileUploader(files[0]['path'].path), ()
+                    return FileUploader(files[0]['path'].path, self.uploadSlots,
+                                        self.uploadLimit is not None, self.db.fileCache), ()
                 else:
                     # It's not for a file, but for a piece string, so return that
                     log.msg('Sending torrent string %s to %s' % (b2a_hex(hash), request.remoteAddr))
                     return PiecesUploader(bencode({'t': files[0]['pieces']}), 'application/x-bencoded'), ()
-            else:
-                log.msg('Hash could not be found in database: %r' % hash)
+            
+            # Share the verified pieces of a file still being downloaded
+            download = self.partialDownload(hash)
+            if download is not None and download.hash.expected() != hash:
+                # It's for the piece string of a large download
+                log.msg('Sending torrent string %s of a download to %s' % (b2a_hex(hash), request.remoteAddr))
+                return PiecesUploader(bencode({'t': ''.join(download.pieces)}), 'application/x-bencoded'), ()
+            if download is not None:
+                log.msg('Sharing the verified pieces of %s with %s' % (download.filePath.path, request.remoteAddr))
+                return PartialUploader(download, self.uploadSlots, self.uploadLimit is not None), ()
+            
+            log.msg('Hash could not be found in database: %r' % hash)
+            return None, ()
+
+        # If the request is for which pieces of a file are available (from a peer)
+        if name == '~bitfield':
+            if len(segments) != 2:
+                log.msg('Got a malformed request from %s' % request.remoteAddr)
                 return None, ()
+            
+            hash = unquote_plus(request.uri[len('/~bitfield/'):])
+            files = self.db.lookupHash(hash, filesOnly = True)
+            if files:
+                # The whole file is available
+                bitfield = '1' * max(1, (files[0]['size'] + PIECE_SIZE - 1) / PIECE_SIZE)
+            else:
+                download = self.partialDownload(hash)
+                if download is None:
+                    log.msg('Hash could not be found for a bitfield: %r' % hash)
+                    return None, ()
+                bitfield = download.bitfield()
+            log.msg('Sending the available pieces of %s to %s' % (b2a_hex(hash), request.remoteAddr))
+            return PiecesUploader(bencode({'b': bitfield}), 'application/x-bencoded'), ()
 
         if len(name) > 1:
             # It's a request from apt
@@ -290,20 +593,46 @@ class TestTopLevel(unittest.TestCase):
     
     client = None
     pending_calls = []
+    fileCache = None
     torrent_hash = '\xca \xb8\x0c\x00\xe7\x07\xf8~])+\x9d\xe5_B\xff\x1a\xc4!'
     torrent = 'abcdefghij0123456789\xca\xec\xb8\x0c\x00\xe7\x07\xf8~])\x8f\x9d\xe5_B\xff\x1a\xc4!'
     file_hash = '\xf8~])+\x9d\xe5_B\xff\x1a\xc4!\xca \xb8\x0c\x00\xe7\x07'
+    partial_hash = '\x00\xe7\x07\xf8~])+\x9d\xe5_B\xff\x1a\xc4!\xca \xb8\x0c'
+    partial_pieces_hash = '\xe5_B\xff\x1a\xc4!\xca \xb8\x0c\x00\xe7\x07\xf8~])+\x9d'
+    
+    class Download:
+        """A fake download in progress that has verified its first piece."""
+        
+        def __init__(self, path, hash, size):
+            self.filePath = path
+            self.hash = HashObject()
+            self.hash.expHash = hash
+            self.hash.expSize = size
+            self.pieces = ['a' * 20, 'b' * 20]
+        
+        def bitfield(self):
+            return '10'
+        
+        def hasRange(self, start, end):
+            return start >= 0 and end < PIECE_SIZE
     
     def setUp(self):
         self.client = TopLevel(FilePath('/boot'), self, None)
         
-    def lookupHash(self, hash):
-        if hash == self.torrent_hash:
+    def lookupHash(self, hash, filesOnly = False):
+        if hash == self.torrent_hash and not filesOnly:
             return [{'pieces': self.torrent}]
         elif hash == self.file_hash:
-            return [{'path': FilePath('/boot/grub/stage2')}]
+            return [{'path': FilePath('/boot/grub/stage2'), 'size': PIECE_SIZE + 1}]
         else:
             return []
+    
+    def partialDownload(self, hash):
+        if hash in (self.partial_hash, self.partial_pieces_hash):
+            path = FilePath(self.mktemp())
+            path.setContent('a' * (PIECE_SIZE + 1000))
+            return self.Download(path, self.partial_hash, PIECE_SIZE + 1000)
+        return None
         
     def create_request(self, host, path):
         req = server.Request(None, 'GET', path, (1,1), 0, http_headers.Headers())
@@ -368,6 +697,65 @@ class TestTopLevel(unittest.TestCase):
                                   '/~/' + quote_plus('foobar'))
         self.failUnlessRaises(http.HTTPError, req._getChild, None, self.client, req.postpath)
 
+    def test_partial_upload(self):
+        """Tests sharing the verified pieces of a download in progress."""
+        self.peers = self
+        self.client.manager = self
+        req = self.create_request('123.45.67.89',
+                                  '/~/' + quote_plus(self.partial_hash))
+        req.headers.setHeader('range', ('bytes', [(0, 99)]))
+        res = req._getChild(None, self.client, req.postpath)
+        self.failUnless(isinstance(res, PartialUploader))
+        df = defer.maybeDeferred(res.renderHTTP, req)
+        df.addCallback(self.check_resp, 206)
+        
+        # Only the verified range is sent, pieces that aren't verified yet
+        # are not found, nor is the whole file
+        def checkUnverified(resp):
+            self.failUnlessEqual(resp.stream.length, 100)
+            self.failUnlessEqual(resp.headers.getHeader('content-range'),
+                                 ('bytes', 0, 99, PIECE_SIZE + 1000))
+            resp.stream.close()
+            req.headers.setHeader('range', ('bytes', [(PIECE_SIZE - 10, PIECE_SIZE + 9)]))
+            self.failUnlessEqual(res.render(req), responsecode.NOT_FOUND)
+            req.headers.removeHeader('range')
+            self.failUnlessEqual(res.render(req), responsecode.NOT_FOUND)
+        df.addCallback(checkUnverified)
+        return df
+
+    def test_partial_torrent_upload(self):
+        """Tests sending the piece hashes of a download in progress."""
+        self.peers = self
+        self.client.manager = self
+        req = self.create_request('123.45.67.89',
+                                  '/~/' + quote_plus(self.partial_pieces_hash))
+        res = req._getChild(None, self.client, req.postpath)
+        self.failUnless(isinstance(res, PiecesUploader))
+        self.failUnlessEqual(bdecode(res.data), {'t': 'a' * 20 + 'b' * 20})
+        df = defer.maybeDeferred(res.renderHTTP, req)
+        df.addCallback(self.check_resp, 200)
+        return df
+
+    def test_bitfield(self):
+        """Tests sending the pieces of a file that are available."""
+        self.peers = self
+        self.client.manager = self
+        received = []
+        def checkBitfield(result, bitfield):
+            self.failUnlessEqual(bdecode(''.join(received)), {'b': bitfield})
+            del received[:]
+        
+        df = defer.succeed(None)
+        for hash, bitfield in ((self.partial_hash, '10'), (self.file_hash, '11')):
+            req = self.create_request('123.45.67.89', '/~bitfield/' + quote_plus(hash))
+            res = req._getChild(None, self.client, req.postpath)
+            self.failUnless(isinstance(res, PiecesUploader))
+            df.addCallback(lambda result, res = res, req = req: res.renderHTTP(req))
+            df.addCallback(self.check_resp, 200)
+            df.addCallback(lambda resp: stream.readStream(resp.stream, received.append))
+            df.addCallback(checkBitfield, bitfield)
+        return df
+
     def check_resp(self, resp, code):
         self.failUnlessEqual(resp.code, code)
         return resp
@@ -380,6 +768,40 @@ class TestTopLevel(unittest.TestCase):
         if self.client:
             self.client = None
 
+class TestUploadSlots(unittest.TestCase):
+    """Unit tests for the upload slots."""
+    
+    def acquire(self, slots, host, granted):
+        d = slots.acquire(host)
+        d.addCallback(granted.append)
+    
+    def test_fairness(self):
+        """Tests that peers waiting for slots take turns."""
+        slots = UploadSlots(1)
+        granted = []
+        for host in ('a', 'a', 'a', 'b'):
+            self.acquire(slots, host, granted)
+        self.failUnlessEqual(granted, ['a'])
+        
+        for i in xrange(3):
+            slots.release()
+        self.failUnlessEqual(granted, ['a', 'a', 'b', 'a'])
+        self.failUnlessEqual(slots.active, 1)
+        slots.release()
+        self.failUnlessEqual(slots.active, 0)
+    
+    def test_preferred(self):
+        """Tests that peers uploading to us get slots first."""
+        slots = UploadSlots(2, lambda host: host == 'c')
+        granted = []
+        for host in ('a', 'a', 'b', 'a', 'c', 'c'):
+            self.acquire(slots, host, granted)
+        self.failUnlessEqual(granted, ['a', 'a'])
+        
+        for i in xrange(4):
+            slots.release()
+        self.failUnlessEqual(granted, ['a', 'a', 'c', 'c', 'b', 'a'])
+
 if __name__ == '__builtin__':
     # Running from twistd -ny HTTPServer.py
     # Then test with:
@@ -0,0 +1,210 @@
+
+"""Keep the contents of small files that are served often in memory.
+
+@type COMPACT_SLACK: C{int}
+@var COMPACT_SLACK: the number of stale entries to allow in the LRU heap
+    before it is rebuilt
+"""
+
+from heapq import heapify, heappush, heappop
+import os
+
+from twisted.python import log
+from twisted.python.filepath import FilePath
+from twisted.trial import unittest
+
+COMPACT_SLACK = 100
+
+class HotCache:
+    """A least recently used cache of the contents of small files.
+
+    Files are identified by their path, modification time (at full
+    precision), inode and size, so a file that has changed since it was
+    cached is read again from disk, even if it was rewritten within the
+    same second with the same size.
+
+    @type maxSize: C{int}
+    @ivar maxSize: the maximum total size of the files to keep in memory
+    @type maxFileSize: C{int}
+    @ivar maxFileSize: the size of the largest file to keep in memory
+    @type size: C{int}
+    @ivar size: the total size of the files currently in memory
+    @type entries: C{dictionary}
+    @ivar entries: the files in memory, keys are the paths, values are lists
+        of the modification time and inode, size, contents and last use of
+        the file
+    @type lru: C{list}
+    @ivar lru: a heap of (last use, path) to find the least recently used
+        file with, entries for files that have since been used again are
+        stale and skipped
+    @type uses: C{int}
+    @ivar uses: the number of times a file in memory has been used, to
+        order the last uses with
+    @type hits: C{int}
+    @ivar hits: the number of times a file was read from memory
+    @type misses: C{int}
+    @ivar misses: the number of times a small file had to be read from disk
+    """
+
+    def __init__(self, maxSize, maxFileSize):
+        """Initialize the cache.
+
+        @type maxSize: C{int}
+        @param maxSize: the maximum total size of the files to keep in memory
+        @type maxFileSize: C{int}
+        @param maxFileSize: the size of the largest file to keep in memory
+        """
+        self.maxSize = maxSize
+        self.maxFileSize = maxFileSize
+        self.size = 0
+        self.entries = {}
+        self.lru = []
+        self.uses = 0
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, file):
+        """Get the contents of a small file, from memory if possible.
+
+        @type file: L{twisted.python.filepath.FilePath}
+        @param file: the file to read
+        @rtype: C{string}
+        @return: the contents of the file, or None if it is not a file or it
+            is too large to be kept in memory
+        """
+        file.restat(False)
+        if not file.isfile():
+            return None
+        version = (file.statinfo.st_mtime, file.statinfo.st_ino)
+        size = file.getsize()
+        if size > self.maxFileSize:
+            return None
+
+        entry = self.entries.get(file.path, None)
+        if entry and entry[0] == version and entry[1] == size:
+            self.hits += 1
+            self._use(file.path, entry)
+            return entry[2]
+
+        self.misses += 1
+        try:
+            data = file.getContent()
+        except (IOError, OSError), e:
+            log.msg('Failed to read %s into memory: %r' % (file.path, e))
+            return None
+        if len(data) != size:
+            # The file changed while it was being read
+            return data
+
+        self.invalidate(file.path)
+        entry = [version, size, data, 0]
+        self.entries[file.path] = entry
+        self.size += size
+        self._use(file.path, entry)
+        self._evict()
+        return data
+
+    def invalidate(self, path):
+        """Remove a file from memory.
+
+        @type path: C{string}
+        @param path: the path of the file
+        """
+        entry = self.entries.pop(path, None)
+        if entry:
+            self.size -= entry[1]
+
+    def _use(self, path, entry):
+        """Mark a file in memory as the most recently used."""
+        self.uses += 1
+        entry[3] = self.uses
+        heappush(self.lru, (self.uses, path))
+        if len(self.lru) > 2*len(self.entries) + COMPACT_SLACK:
+            self.lru = [(entry[3], path) for path, entry in self.entries.items()]
+            heapify(self.lru)
+
+    def _evict(self):
+        """Remove the least recently used files until there's enough room."""
+        while self.size > self.maxSize and self.lru:
+            lastUse, path = heappop(self.lru)
+            entry = self.entries.get(path, None)
+            if entry and entry[3] == lastUse:
+                self.invalidate(path)
+
+class TestHotCache(unittest.TestCase):
+    """Tests for the hot cache of files."""
+
+    def setUp(self):
+        self.directory = FilePath(self.mktemp())
+        self.directory.makedirs()
+        self.files = []
+        for i in xrange(4):
+            file = self.directory.child('file%d' % i)
+            file.setContent(str(i) * 1000)
+            self.files.append(file)
+        self.cache = HotCache(3000, 1500)
+
+    def test_hits(self):
+        """Tests reading files from memory."""
+        self.failUnlessEqual(self.cache.read(self.files[0]), '0' * 1000)
+        self.failUnlessEqual((self.cache.hits, self.cache.misses), (0, 1))
+        self.failUnlessEqual(self.cache.read(self.files[0]), '0' * 1000)
+        self.failUnlessEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        # Large files and directories are not cached
+        self.files[1].setContent('1' * 2000)
+        self.failUnlessEqual(self.cache.read(self.files[1]), None)
+        self.failUnlessEqual(self.cache.read(self.directory), None)
+        self.failUnlessEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.failUnlessEqual(self.cache.size, 1000)
+
+    def test_changed(self):
+        """Tests that changed files are read again."""
+        self.cache.read(self.files[0])
+        self.files[0].setContent('changed')
+        self.failUnlessEqual(self.cache.read(self.files[0]), 'changed')
+        self.failUnlessEqual((self.cache.hits, self.cache.misses), (0, 2))
+        self.failUnlessEqual(self.cache.size, len('changed'))
+
+        self.cache.invalidate(self.files[0].path)
+        self.failUnlessEqual(self.cache.size, 0)
+        self.failUnlessEqual(self.cache.read(self.files[0]), 'changed')
+        self.failUnlessEqual((self.cache.hits, self.cache.misses), (0, 3))
+
+    def test_rewritten(self):
+        """Tests that files rewritten with the same size are read again."""
+        mtime = int(self.files[0].getmtime())
+        os.utime(self.files[0].path, (mtime, mtime + 0.25))
+        self.cache.read(self.files[0])
+        
+        # Rewritten in place in the same second
+        f = open(self.files[0].path, 'r+')
+        f.write('a' * 1000)
+        f.close()
+        os.utime(self.files[0].path, (mtime, mtime + 0.75))
+        self.failUnlessEqual(self.cache.read(self.files[0]), 'a' * 1000)
+        self.failUnlessEqual((self.cache.hits, self.cache.misses), (0, 2))
+        
+        # Replaced by a new file with the same modification time
+        self.files[0].setContent('b' * 1000)
+        os.utime(self.files[0].path, (mtime, mtime + 0.75))
+        self.failUnlessEqual(self.cache.read(self.files[0]), 'b' * 1000)
+        self.failUnlessEqual((self.cache.hits, self.cache.misses), (0, 3))
+        self.failUnlessEqual(self.cache.read(self.files[0]), 'b' * 1000)
+        self.failUnlessEqual((self.cache.hits, self.cache.misses), (1, 3))
+
+    def test_lru(self):
+        """Tests that the least recently used files are removed first."""
+        for i in (0, 1, 2, 0):
+            self.cache.read(self.files[i])
+        self.cache.read(self.files[3])
+        self.failUnlessEqual(self.cache.size, 3000)
+        self.failUnlessEqual(sorted(self.cache.entries.keys()),
+                             [self.files[i].path for i in (0, 2, 3)])
+
+        for i in xrange(COMPACT_SLACK * 2):
+            self.cache.read(self.files[2])
+        self.failUnless(len(self.cache.lru) <= 3 * 2 + COMPACT_SLACK)
+        self.cache.read(self.files[1])
+        self.failUnlessEqual(sorted(self.cache.entries.keys()),
+                             [self.files[i].path for i in (1, 2, 3)])
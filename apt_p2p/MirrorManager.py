@@ -1,19 +1,27 @@
 
 """Manage the multiple mirrors that may be requested.
 
+Mirrors that serve the same suite usually have byte-identical index files,
+so the indexes are tracked by the hash of the suite's Release file rather
+than by mirror. Every mirror serving the same Release file then shares a
+single L{AptPackages} instance. When a suite's Release file changes, the
+index files it lists as unchanged are carried over to the new index, as
+apt won't download them again.
+
 @var aptpkg_dir: the name of the directory to use for mirror files
 """
 
 from urlparse import urlparse
-import os
+from urllib import unquote, quote_plus
+import os, sha, shelve
 
 from twisted.python import log
 from twisted.python.filepath import FilePath
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from twisted.trial import unittest
 from twisted.web2.http import splitHostPort
 
-from AptPackages import AptPackages
+from AptPackages import AptPackages, TRACKED_FILES, releaseHashes
 
 aptpkg_dir='apt-packages'
 
@@ -26,12 +34,41 @@ class MirrorManager:
     @type cache_dir: L{twisted.python.filepath.FilePath}
     @ivar cache_dir: the directory to use for storing all files
     @type apt_caches: C{dictionary}
-    @ivar apt_caches: the avaliable mirrors
+    @ivar apt_caches: the avaliable indexes, keys are the index keys (the
+        hex hash of the suite's Release file), values are the L{AptPackages}
+    @type mirrors: C{dictionary}
+    @ivar mirrors: the known mirrors, keys are the sites, values are
+        dictionaries with keys the base directories, and values dictionaries
+        with keys the suite directories and values the index keys
+    @type suites: C{shelve dictionary}
+    @ivar suites: the persistent storage of the L{mirrors} information
+    @type releases: C{shelve dictionary}
+    @ivar releases: the hashes of the index files listed in the Release
+        file of each index, keys are the index keys
+    @type import_later: L{twisted.internet.interfaces.IDelayedCall}
+    @ivar import_later: the delayed call to import the next file from apt's
+        lists directory
     """
     
     def __init__(self, cache_dir):
         self.cache_dir = cache_dir
         self.apt_caches = {}
+        self.mirrors = {}
+        self.import_later = None
+        packages_dir = self.cache_dir.child(aptpkg_dir)
+        if not packages_dir.exists():
+            packages_dir.makedirs()
+        self.suites = shelve.open(packages_dir.child('suites.db').path)
+        self.releases = shelve.open(packages_dir.child('releases.db').path)
+        for site, baseDir, suite, key in self.suites.values():
+            self.mirrors.setdefault(site, {}).setdefault(baseDir, {})[suite] = key
+        
+        # The indexes used to be kept per mirror, they are rebuilt from the
+        # index files apt has when apt-p2p starts
+        old_mirrors = packages_dir.child('mirrors')
+        if old_mirrors.exists():
+            log.msg('Removing the old per mirror indexes in %s' % old_mirrors.path)
+            old_mirrors.remove()
     
     def extractPath(self, url):
         """Break the full URI down into the site, base directory and path.
@@ -66,9 +103,9 @@ class MirrorManager:
             # Try to find an existing cache that starts with this one
             # (fallback to using an empty base directory)
             baseDir = ''
-            if site in self.apt_caches:
+            if site in self.mirrors:
                 longest_match = 0
-                for base in self.apt_caches[site]:
+                for base in self.mirrors[site]:
                     base_match = ''
                     for dirs in path.split('/'):
                         if base.startswith(base_match + '/' + dirs):
@@ -81,45 +118,304 @@ class MirrorManager:
             log.msg("Settled on baseDir: %s" % baseDir)
         
         return site, baseDir, path
+    
+    def _releaseKey(self, file_path):
+        """Determine the index key to use for a Release file's suite.
         
-    def init(self, site, baseDir):
-        """Make sure an L{AptPackages} exists for this mirror."""
-        if site not in self.apt_caches:
-            self.apt_caches[site] = {}
-            
-        if baseDir not in self.apt_caches[site]:
-            site_cache = self.cache_dir.child(aptpkg_dir).child('mirrors').child(site + baseDir.replace('/', '_'))
-            site_cache.makedirs
-            self.apt_caches[site][baseDir] = AptPackages(site_cache)
+        @type file_path: L{twisted.python.filepath.FilePath}
+        @param file_path: the location of the Release file in the file system
+        @rtype: C{string}
+        @return: the hex hash of the contents of the Release file
+        """
+        hasher = sha.new()
+        f = file_path.open('r')
+        data = f.read(32*1024)
+        while data:
+            hasher.update(data)
+            data = f.read(32*1024)
+        f.close()
+        return hasher.hexdigest()
+        
+    def _mirrorKey(self, site, baseDir):
+        """Determine the index key to use for a mirror's files without a Release file."""
+        return 'mirror-' + (site + baseDir).replace('/', '_')
+        
+    def _findSuite(self, site, baseDir, path):
+        """Find the suite directory of a mirror that contains a path.
+        
+        @return: the longest known suite directory that contains the path,
+            or None if none of them do
+        """
+        suite = None
+        for known in self.mirrors.get(site, {}).get(baseDir, {}):
+            if path.startswith(known) and (suite is None or len(known) > len(suite)):
+                suite = known
+        return suite
+        
+    def _setSuite(self, site, baseDir, suite, key):
+        """Set the index key used for a mirror's suite.
+        
+        Indexes that are no longer used by any mirror are cleaned up.
+        """
+        suites = self.mirrors.setdefault(site, {}).setdefault(baseDir, {})
+        old_key = suites.get(suite, None)
+        if old_key == key:
+            return
+        
+        suites[suite] = key
+        self.suites[site + baseDir + suite] = (site, baseDir, suite, key)
+        self.suites.sync()
+        
+        if old_key is not None:
+            for site_dirs in self.mirrors.values():
+                for base_suites in site_dirs.values():
+                    if old_key in base_suites.values():
+                        return
+            log.msg('Index %s is no longer used by any mirror' % old_key)
+            if old_key in self.apt_caches:
+                self.apt_caches[old_key].cleanup()
+                del self.apt_caches[old_key]
+            if self.releases.has_key(old_key):
+                del self.releases[old_key]
+                self.releases.sync()
+            index_cache = self.cache_dir.child(aptpkg_dir).child('indexes').child(old_key)
+            index_cache.restat(False)
+            if index_cache.exists():
+                index_cache.remove()
+        
+    def _carryOver(self, old_key, key, suite):
+        """Add the index files that haven't changed to a suite's new index.
+        
+        Apt only downloads the index files whose hashes in the new Release
+        file are different, so the rest are taken from the old index.
+        
+        @param old_key: the suite's previous index key
+        @param key: the suite's new index key
+        @param suite: the suite directory
+        """
+        if (old_key is None or old_key == key or not self.releases.has_key(old_key) or
+            not self.releases.has_key(key)):
+            return
+        old_hashes = self.releases[old_key]
+        new_hashes = self.releases[key]
+        old_cache = self.init(old_key)
+        new_cache = self.init(key)
+        for path in old_cache.packages.keys():
+            name = path[len(suite):]
+            if (not path.startswith(suite) or name.lower() == 'release' or
+                new_cache.has_file(path) or not old_cache.has_file(path)):
+                continue
+            old_hash = old_hashes.get(name, {})
+            new_hash = new_hashes.get(name, {})
+            common = [hash_type for hash_type in old_hash if hash_type in new_hash]
+            if common and [old_hash[t] for t in common] == [new_hash[t] for t in common]:
+                log.msg('Index file %s is unchanged, adding it to index %s' % (path, key))
+                new_cache.file_updated(path, self._indexFile(key, path, old_cache.packages[path]))
+        
+    def _indexFile(self, key, path, file_path):
+        """Keep an index file in the index's own directory.
+        
+        Indexes are shared by mirrors, whose own files change when they move
+        to a new Release file, so the index keeps a hard link to (or, if that
+        fails, a copy of) the file it was built from.
+        
+        @param key: the index key
+        @type path: C{string}
+        @param path: the path of the file within the mirror
+        @type file_path: L{twisted.python.filepath.FilePath}
+        @param file_path: the location of the mirror's file
+        @rtype: L{twisted.python.filepath.FilePath}
+        @return: the location of the index's file
+        """
+        files_dir = self.cache_dir.child(aptpkg_dir).child('indexes').child(key).child('files')
+        if not files_dir.exists():
+            files_dir.makedirs()
+        index_file = files_dir.child(quote_plus(path))
+        index_file.restat(False)
+        if index_file.exists():
+            index_file.remove()
+        try:
+            os.link(file_path.path, index_file.path)
+        except OSError:
+            file_path.copyTo(index_file)
+        index_file.restat(False)
+        return index_file
+        
+    def init(self, key):
+        """Make sure an L{AptPackages} exists for this index key."""
+        if key not in self.apt_caches:
+            index_cache = self.cache_dir.child(aptpkg_dir).child('indexes').child(key)
+            self.apt_caches[key] = AptPackages(index_cache)
+        return self.apt_caches[key]
     
     def updatedFile(self, url, file_path):
         """A file in the mirror has changed or been added.
         
+        Release files determine the index key of their suite, all other index
+        files are added to the index of the suite they belong to. Files that
+        another mirror has already added to a shared index are not added again.
+        
         @see: L{AptPackages.PackageFileList.update_file}
         """
         site, baseDir, path = self.extractPath(url)
-        self.init(site, baseDir)
-        self.apt_caches[site][baseDir].file_updated(path, file_path)
+        filename = path.split('/')[-1]
+        if filename.lower() not in TRACKED_FILES:
+            return
+        
+        if filename.lower() == 'release':
+            suite = path[:-len(filename)]
+            key = self._releaseKey(file_path)
+            if not self.releases.has_key(key):
+                self.releases[key] = releaseHashes(file_path)
+                self.releases.sync()
+            self._carryOver(self.mirrors.get(site, {}).get(baseDir, {}).get(suite, None), key, suite)
+            self._setSuite(site, baseDir, suite, key)
+        else:
+            suite = self._findSuite(site, baseDir, path)
+            if suite is None:
+                # Track files without a Release file separately for the mirror
+                suite = ''
+                self._setSuite(site, baseDir, suite, self._mirrorKey(site, baseDir))
+            key = self.mirrors[site][baseDir][suite]
+        
+        apt_cache = self.init(key)
+        if key != self._mirrorKey(site, baseDir):
+            if apt_cache.has_file(path):
+                log.msg('Index %s already has the file for %s' % (key, url))
+                return
+            file_path = self._indexFile(key, path, file_path)
+        apt_cache.file_updated(path, file_path)
 
+    def listsFileToURL(self, filename, port = None):
+        """Convert the name of a file in apt's lists directory to its URL.
+        
+        Apt names the files by replacing the '/' in the URL with '_' (and
+        escaping any '_' in the URL). Files downloaded through an apt-p2p
+        proxy have the proxy's address prepended, which is removed.
+        
+        @type filename: C{string}
+        @param filename: the name of the file in the lists directory
+        @type port: C{int}
+        @param port: the port apt-p2p is listening on (optional, defaults to
+            not removing any proxy address)
+        @rtype: C{string}
+        @return: the URL of the file on the mirror
+        """
+        parts = [unquote(part) for part in filename.split('_')]
+        if port is not None and len(parts) > 1 and parts[0].endswith(':' + str(port)):
+            parts = parts[1:]
+        return 'http://' + '/'.join(parts)
+    
+    def importAptLists(self, lists_dir, port = None):
+        """Add the index files found in apt's lists directory to the mirrors.
+        
+        This makes the hashes of packages available as soon as apt-p2p
+        starts, rather than after apt next updates its indexes through it.
+        The files are imported one per reactor iteration, so parsing the
+        Release files doesn't hold up the reactor, and the caches of the
+        suites are then pre-warmed one after another.
+        
+        @type lists_dir: L{twisted.python.filepath.FilePath}
+        @param lists_dir: the directory apt stores its index files in
+        @type port: C{int}
+        @param port: the port apt-p2p is listening on
+        @rtype: L{twisted.internet.defer.Deferred}
+        @return: a deferred that will fire with the number of index files
+            that were imported
+        """
+        lists_dir.restat(False)
+        if not lists_dir.isdir():
+            log.msg('No apt lists directory to import from: %s' % lists_dir.path)
+            return defer.succeed(0)
+        
+        # Release files must be added first to determine the suites
+        release_files = []
+        index_files = []
+        for filename in lists_dir.listdir():
+            index_type = unquote(filename.split('_')[-1]).lower()
+            if index_type == 'release':
+                release_files.append(filename)
+            elif index_type in TRACKED_FILES:
+                index_files.append(filename)
+        
+        d = defer.Deferred()
+        self._importAptLists(lists_dir, release_files + index_files, port, d)
+        return d
+    
+    def _importAptLists(self, lists_dir, filenames, port, d, count = 0):
+        """Import the next file from apt's lists directory.
+        
+        @type filenames: C{list} of C{string}
+        @param filenames: the names of the files left to import
+        @type d: L{twisted.internet.defer.Deferred}
+        @param d: the deferred to callback when all the files are imported
+        @type count: C{int}
+        @param count: the number of files imported so far
+        """
+        self.import_later = None
+        if not filenames:
+            log.msg('Imported %d index files from %s' % (count, lists_dir.path))
+            d.callback(count)
+            return
+        
+        filename = filenames.pop(0)
+        url = self.listsFileToURL(filename, port)
+        try:
+            self.updatedFile(url, lists_dir.child(filename))
+            count += 1
+        except (IOError, OSError), e:
+            log.msg('Failed to import apt lists file %s: %r' % (filename, e))
+        self.import_later = reactor.callLater(0, self._importAptLists, lists_dir,
+                                              filenames, port, d, count)
+    
     def findHash(self, url):
         """Find the hash for a given url.
+        
+        Index files are looked up in the index for their suite, other files
+        are looked up in all the indexes for the mirror.
 
         @param url: the URI of the file's location on the mirror
         @rtype: L{twisted.internet.defer.Deferred}
         @return: a deferred that will fire with the returned L{Hash.HashObject}
         """
         site, baseDir, path = self.extractPath(url)
-        self.init(site, baseDir)
-        if site in self.apt_caches and baseDir in self.apt_caches[site]:
-            return self.apt_caches[site][baseDir].findHash(path)
-        return defer.fail(MirrorError("Site Not Found"))
+        suites = self.mirrors.get(site, {}).get(baseDir, {})
+        if not suites:
+            return defer.fail(MirrorError("Site Not Found"))
+        
+        suite = self._findSuite(site, baseDir, path)
+        if suite:
+            keys = [suites[suite]]
+        else:
+            # Search the specific suites first, then the whole mirror
+            keys = [suites[s] for s in suites if s]
+            keys.sort()
+            if '' in suites:
+                keys.append(suites[''])
+        return self._findHashInIndexes(keys, path)
+    
+    def _findHashInIndexes(self, keys, path):
+        """Lookup the path in the first index, and the remaining ones if it's not found."""
+        d = self.init(keys.pop(0)).findHash(path)
+        if keys:
+            d.addCallback(self._findHash_next, keys, path)
+        return d
+    
+    def _findHash_next(self, hash, keys, path):
+        """Check the next index if the hash wasn't found."""
+        if hash.expected() is not None:
+            return hash
+        return self._findHashInIndexes(keys, path)
     
     def cleanup(self):
-        for site in self.apt_caches.keys():
-            for baseDir in self.apt_caches[site].keys():
-                self.apt_caches[site][baseDir].cleanup()
-                del self.apt_caches[site][baseDir]
-            del self.apt_caches[site]
+        if self.import_later and self.import_later.active():
+            self.import_later.cancel()
+        self.import_later = None
+        for key in self.apt_caches.keys():
+            self.apt_caches[key].cleanup()
+            del self.apt_caches[key]
+        self.suites.close()
+        self.releases.close()
     
 class TestMirrorManager(unittest.TestCase):
     """Unit tests for the mirror manager."""
@@ -232,6 +528,93 @@ class TestMirrorManager(unittest.TestCase):
         d.addBoth(lastDefer.callback)
         return lastDefer
 
+    def test_sharedIndexes(self):
+        """Tests that mirrors serving the same Release file share an index."""
+        releaseFile = os.popen('ls -S /var/lib/apt/lists/ | grep -E "_Release$" | head -n 1').read().rstrip('\n')
+        release_path = releaseFile[releaseFile.find('_dists_'):].replace('_','/')
+        suite = release_path[:-7]
+        
+        self.client.updatedFile('http://ftp.us.debian.org/debian' + release_path, 
+                                FilePath('/var/lib/apt/lists/' + releaseFile))
+        self.client.updatedFile('http://ftp.de.debian.org/debian' + release_path, 
+                                FilePath('/var/lib/apt/lists/' + releaseFile))
+        
+        us_key = self.client.mirrors['ftp.us.debian.org:80']['/debian'][suite]
+        de_key = self.client.mirrors['ftp.de.debian.org:80']['/debian'][suite]
+        self.failUnlessEqual(us_key, de_key)
+        self.failUnless(self.client.init(us_key) is self.client.init(de_key))
+        self.failUnless(self.client.init(us_key).has_file(release_path))
+
+    def test_indexFiles(self):
+        """Tests that indexes keep their files when the mirror's files change."""
+        releaseFile = os.popen('ls -S /var/lib/apt/lists/ | grep -E "_Release$" | head -n 1').read().rstrip('\n')
+        release_path = releaseFile[releaseFile.find('_dists_'):].replace('_','/')
+        mirrorRelease = FilePath('/tmp/.apt-p2p-Release')
+        FilePath('/var/lib/apt/lists/' + releaseFile).copyTo(mirrorRelease)
+        
+        self.client.updatedFile('http://ftp.us.debian.org/debian' + release_path, mirrorRelease)
+        key = self.client.mirrors['ftp.us.debian.org:80']['/debian'][release_path[:-7]]
+        index_file = self.client.init(key).packages[release_path]
+        self.failIfEqual(index_file.path, mirrorRelease.path)
+        
+        # The mirror moves on to a new Release file
+        mirrorRelease.remove()
+        mirrorRelease.setContent('X-Apt-P2P-Test: changed\n')
+        self.failUnless(self.client.init(key).has_file(release_path))
+        self.failUnlessEqual(index_file.getContent(),
+                             FilePath('/var/lib/apt/lists/' + releaseFile).getContent())
+        mirrorRelease.remove()
+
+    def test_changedRelease(self):
+        """Tests that unchanged index files are kept when the Release file changes."""
+        packagesFile = os.popen('ls -Sr /var/lib/apt/lists/ | grep -E "_main_.*Packages$" | tail -n 1').read().rstrip('\n')
+        for f in os.walk('/var/lib/apt/lists').next()[2]:
+            if f[-7:] == "Release" and packagesFile.startswith(f[:-7]):
+                releaseFile = f
+                break
+        release_url = 'http://' + releaseFile.replace('_','/')
+        packages_url = release_url[:-7] + packagesFile[len(releaseFile)-7:].replace('_','/')
+        
+        self.client.updatedFile(release_url, FilePath('/var/lib/apt/lists/' + releaseFile))
+        self.client.updatedFile(packages_url, FilePath('/var/lib/apt/lists/' + packagesFile))
+        site, baseDir, path = self.client.extractPath(packages_url)
+        suite = self.client._findSuite(site, baseDir, path)
+        old_key = self.client.mirrors[site][baseDir][suite]
+        
+        # A new Release file that lists the same Packages file
+        newRelease = FilePath('/tmp/.apt-p2p-Release')
+        newRelease.setContent('X-Apt-P2P-Test: changed\n' +
+                              FilePath('/var/lib/apt/lists/' + releaseFile).getContent())
+        self.client.updatedFile(release_url, newRelease)
+        
+        new_key = self.client.mirrors[site][baseDir][suite]
+        self.failIfEqual(old_key, new_key)
+        self.failUnless(self.client.init(new_key).has_file(path))
+        self.failIf(old_key in self.client.apt_caches)
+        newRelease.remove()
+
+    def test_listsFileToURL(self):
+        """Tests converting the names of apt's lists files to URLs."""
+        url = self.client.listsFileToURL('ftp.us.debian.org_debian_dists_unstable_Release')
+        self.failUnlessEqual(url, 'http://ftp.us.debian.org/debian/dists/unstable/Release')
+        url = self.client.listsFileToURL('localhost:9977_ftp.us.debian.org_debian_dists_unstable_Release', 9977)
+        self.failUnlessEqual(url, 'http://ftp.us.debian.org/debian/dists/unstable/Release')
+        url = self.client.listsFileToURL('security.debian.org_dists_etch%5fupdates_main_binary-i386_Packages', 9977)
+        self.failUnlessEqual(url, 'http://security.debian.org/dists/etch_updates/main/binary-i386/Packages')
+
+    def test_importAptLists(self):
+        """Tests importing the index files from apt's lists directory."""
+        releaseFile = os.popen('ls -S /var/lib/apt/lists/ | grep -E "_Release$" | head -n 1').read().rstrip('\n')
+        
+        def checkImport(count):
+            self.failUnless(count > 0)
+            site, baseDir, path = self.client.extractPath(self.client.listsFileToURL(releaseFile))
+            self.failUnless(path[:-7] in self.client.mirrors[site][baseDir])
+        
+        d = self.client.importAptLists(FilePath('/var/lib/apt/lists'))
+        d.addCallback(checkImport)
+        return d
+
     def tearDown(self):
         for p in self.pending_calls:
             if p.active():
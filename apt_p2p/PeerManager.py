@@ -1,28 +1,266 @@
 
-"""Manage a set of peers and the requests to them."""
+"""Manage a set of peers and the requests to them.
 
-from random import choice
+@type MAX_RANGE_PIECES: C{int}
+@var MAX_RANGE_PIECES: the maximum number of pieces (or blocks) to request
+    from a peer in a single range request
+@type BLOCK_SIZE: C{int}
+@var BLOCK_SIZE: the size of the blocks to request when a download has
+    fewer pieces than there are peers to download from
+@type MAX_CLIENTS: C{int}
+@var MAX_CLIENTS: the maximum number of peers to keep in memory, the least
+    recently used idle ones beyond this are forgotten (but their
+    performance is saved)
+@type HEDGE_SAMPLES: C{int}
+@var HEDGE_SAMPLES: the number of recent peer response times to use to
+    determine the latency budget before hedging
+@type HEDGE_BUDGET: C{float}
+@var HEDGE_BUDGET: the latency budget to use until enough response times
+    have been seen
+@type RECIPROCATE_TIME: C{int}
+@var RECIPROCATE_TIME: the number of seconds after a peer last uploaded to
+    us that it is still preferred for uploads
+@type BITFIELD_REFRESH: C{int}
+@var BITFIELD_REFRESH: the number of seconds before asking a peer that is
+    still downloading a file again which pieces it has
+@type STATE_SAVE_DELAY: C{int}
+@var STATE_SAVE_DELAY: the number of seconds to wait after a piece is
+    verified before saving the state of the download, so that the pieces
+    verified in the meantime are saved together
+@type STALE_DOWNLOAD: C{int}
+@var STALE_DOWNLOAD: the number of seconds after a partial download was
+    last changed that it is removed, if it isn't being resumed
+@type SUMMARY_EXPIRE: C{int}
+@var SUMMARY_EXPIRE: the number of seconds to keep the saved performance
+    of a forgotten peer
+"""
+
+from random import choice, random
+from StringIO import StringIO
 from urlparse import urlparse, urlunparse
 from urllib import quote_plus
 from binascii import b2a_hex, a2b_hex
-import sha
+from heapq import heapify, heappush, heappop
+import sha, os, time, shelve
 
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, threads
 from twisted.python import log
+from twisted.python.filepath import FilePath
 from twisted.trial import unittest
 from twisted.web2 import stream
 from twisted.web2.http import Response, splitHostPort
 
-from HTTPDownloader import Peer
-from Streams import GrowingFileStream, StreamToFile
-from util import uncompact
-from Hash import PIECE_SIZE
-from apt_p2p_Khashmir.bencode import bdecode
+from HTTPDownloader import Peer, RateLimiter
+from Scheduler import Scheduler, downloadPriority
+from Streams import GrowingFileStream, StreamToFile, PiecesStreamToFile
+from DiskWriter import DiskWriter
+from util import uncompact, compact, monotonic
+from Hash import PIECE_SIZE, HashObject
+from apt_p2p_Khashmir.bencode import bencode, bdecode
 from apt_p2p_conf import config
 
+MAX_RANGE_PIECES = 8
+BLOCK_SIZE = 64*1024
+MAX_CLIENTS = 500
+HEDGE_SAMPLES = 100
+HEDGE_BUDGET = 1.0
+RECIPROCATE_TIME = 600
+BITFIELD_REFRESH = 10
+STATE_SAVE_DELAY = 5
+STALE_DOWNLOAD = 7*86400
+SUMMARY_EXPIRE = 30*86400
+
 class PeerError(Exception):
     """An error occurred downloading from peers."""
     
+class StreamingPicker:
+    """Pick the pieces of a download in order.
+    
+    This gets the stream of the file to the requester as soon as possible.
+    
+    @type download: L{FileDownload}
+    @ivar download: the download to pick pieces for
+    @type window: C{int}
+    @ivar window: the number of pieces after the next one needed for the
+        stream that are always picked first, in order
+    """
+    
+    def __init__(self, download, window):
+        self.download = download
+        self.window = window
+        
+    def order(self):
+        """Get the order to try to request the pieces in.
+        
+        @rtype: C{list} of C{int}
+        @return: the piece numbers, in order of preference
+        """
+        return range(self.download.nextFinish, len(self.download.completePieces))
+    
+class RarestFirstPicker(StreamingPicker):
+    """Pick the pieces in the priority window in order, then the rarest ones.
+    
+    Getting the pieces the fewest peers have first spreads them out to more
+    peers sooner, which suits downloads that are mostly done for seeding.
+    """
+    
+    def order(self):
+        """Get the order to try to request the pieces in.
+        
+        @rtype: C{list} of C{int}
+        @return: the piece numbers, in order of preference
+        """
+        start = self.download.nextFinish
+        end = min(start + self.window, len(self.download.completePieces))
+        rest = [(self.download.availability(piece), random(), piece)
+                for piece in xrange(end, len(self.download.completePieces))]
+        rest.sort()
+        return range(start, end) + [piece for (avail, r, piece) in rest]
+
+PIECE_PICKERS = {'streaming': StreamingPicker,
+                 'rarest': RarestFirstPicker,
+                 }
+
+class PeerQueue:
+    """The peers of a download that can accept more requests, by rank.
+    
+    The peers are kept in a heap, so the highest ranked one can be found
+    quickly. A peer that has been sent a request but can still accept more
+    is moved behind all the others until the peers are next reranked, so
+    the requests are spread over the peers.
+    
+    @type peers: C{dictionary}
+    @ivar peers: the peers of the download, keys are the sites, values are
+        dictionaries containing the 'peer'
+    @type heap: C{list} of (C{int}, C{float}, C{int}, (C{string}, C{int}))
+    @ivar heap: the entries for the peers, the round the peer was last
+        used in, its negated rank, and a counter to identify the entry
+    @type entries: C{dictionary}
+    @ivar entries: the counter of the current entry for each peer in the
+        queue, entries in the heap that aren't current have been removed
+    @type round: C{int}
+    @ivar round: the number of times the peers have been moved behind the others
+    @type counter: C{int}
+    @ivar counter: the next entry counter to use
+    """
+    
+    def __init__(self, peers, sites = []):
+        self.peers = peers
+        self.heap = []
+        self.entries = {}
+        self.round = 0
+        self.counter = 0
+        for site in sites:
+            self.add(site)
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def __contains__(self, site):
+        return site in self.entries
+    
+    def _push(self, site, round):
+        """Add a new entry for a peer to the heap."""
+        self.counter += 1
+        self.entries[site] = self.counter
+        heappush(self.heap, (round, -self.peers[site]['peer'].rank, self.counter, site))
+    
+    def add(self, site):
+        """Add a peer to the queue, if it's not already in it."""
+        if site not in self.entries:
+            self._push(site, 0)
+    
+    def remove(self, site):
+        """Remove a peer from the queue, if it's in it."""
+        if site in self.entries:
+            del self.entries[site]
+    
+    def best(self):
+        """Get the highest ranked peer in the queue (which must not be empty)."""
+        while self.heap[0][2] != self.entries.get(self.heap[0][3], None):
+            heappop(self.heap)
+        return self.heap[0][3]
+    
+    def pop(self):
+        """Remove and return the highest ranked peer in the queue."""
+        site = self.best()
+        heappop(self.heap)
+        del self.entries[site]
+        return site
+    
+    def demote(self, site):
+        """Move a peer in the queue behind all the other peers."""
+        self.round += 1
+        self._push(site, self.round)
+
+    def rerank(self):
+        """Reorder the peers in the queue by their current rank."""
+        self.round = 0
+        self.heap = [(0, -self.peers[site]['peer'].rank, counter, site)
+                     for site, counter in self.entries.iteritems()]
+        heapify(self.heap)
+
+class HedgePolicy:
+    """Decide when to also request a slow piece from the mirror.
+    
+    If no peer has started to respond for the piece the stream needs next
+    within the latency budget, the piece is also requested from the mirror.
+    The budget is a percentile of the recent response times of peers, and
+    the bytes requested from the mirror this way are kept below a
+    percentage of the bytes downloaded from peers.
+    
+    @type percentile: C{int}
+    @ivar percentile: the percentile of the response times to use as the budget
+    @type percent: C{int}
+    @ivar percent: the maximum percentage of the peer downloads' bytes to
+        also request from the mirror
+    @type responseTimes: C{list} of C{float}
+    @ivar responseTimes: the recent times peers took to start responding
+    @type downloaded: C{long}
+    @ivar downloaded: the number of bytes of the downloads from peers
+    @type hedged: C{long}
+    @ivar hedged: the number of bytes that were also requested from the mirror
+    """
+    
+    def __init__(self, percentile, percent):
+        self.percentile = percentile
+        self.percent = percent
+        self.responseTimes = []
+        self.downloaded = 0L
+        self.hedged = 0L
+    
+    def addResponseTime(self, responseTime):
+        """Save the time a peer took to start responding to a request."""
+        self.responseTimes.append(responseTime)
+        del self.responseTimes[:-HEDGE_SAMPLES]
+    
+    def addDownload(self, size):
+        """Save the size of a new download from peers."""
+        self.downloaded += size
+    
+    def budget(self):
+        """Get the time to wait for a peer to respond before hedging.
+        
+        @rtype: C{float}
+        """
+        if len(self.responseTimes) < 10:
+            return HEDGE_BUDGET
+        times = sorted(self.responseTimes)
+        return times[min(len(times) - 1, len(times) * self.percentile / 100)]
+    
+    def hedge(self, size):
+        """Try to request some bytes from the mirror.
+        
+        @type size: C{int}
+        @param size: the number of bytes to request
+        @rtype: C{boolean}
+        @return: whether the bytes can be requested
+        """
+        if (self.hedged + size) * 100 > self.percent * (self.downloaded + size):
+            return False
+        self.hedged += size
+        return True
+
 class FileDownload:
     """Manage a download from a list of peers or a mirror.
     
@@ -35,31 +273,85 @@ class FileDownload:
     @ivar compact_peers: a list of the peer info where the file can be found
     @type file: C{file}
     @ivar file: the open file to right the download to
+    @type filePath: L{twisted.python.filepath.FilePath}
+    @ivar filePath: the location of the file to write the download to
+    @type statePath: L{twisted.python.filepath.FilePath}
+    @ivar statePath: the location to save the completed pieces of the
+        download to, so it can be resumed later
     @type path: C{string}
     @ivar path: the path to request from peers to access the file
     @type pieces: C{list} of C{string} 
     @ivar pieces: the hashes of the pieces in the file
     @type started: C{boolean}
     @ivar started: whether the download has begun yet
+    @type downloading: C{boolean}
+    @ivar downloading: whether the pieces have begun to be requested
     @type defer: L{twisted.internet.defer.Deferred}
     @ivar defer: the deferred that will callback with the result of the download
     @type peers: C{dictionary}
-    @ivar peers: information about each of the peers available to download from
+    @ivar peers: information about each of the peers available to download
+        from, peers that are still downloading the file themselves are
+        'partial', and 'have' is the string of which pieces they have
+    @type sharing: C{boolean}
+    @ivar sharing: whether the verified pieces are being shared with peers
+        before the download is complete
+    @type piecesKey: C{string}
+    @ivar piecesKey: the SHA1 hash of the piece hashes of a download being
+        shared, that peers request them from us with
     @type outstanding: C{int}
     @ivar outstanding: the number of requests to peers currently outstanding
-    @type peerlist: C{list} of L{HTTPDownloader.Peer}
-    @ivar peerlist: the sorted list of peers for this download
+    @type maxRequests: C{int}
+    @ivar maxRequests: the maximum number of requests to have outstanding
+    @type maxPeerRequests: C{int}
+    @ivar maxPeerRequests: the maximum number of requests to have outstanding
+        to a single peer
+    @type sitelist: L{PeerQueue}
+    @ivar sitelist: the peers for this download that have the whole file
+        and can accept more requests, by rank
     @type stream: L{GrowingFileStream}
     @ivar stream: the stream of resulting data from the download
+    @type writer: L{DiskWriter.DiskWriter}
+    @ivar writer: the writer of the downloaded pieces to the file
     @type nextFinish: C{int}
     @ivar nextFinish: the next piece that is needed to finish for the stream
+    @type chunkSize: C{int}
+    @ivar chunkSize: the size of the pieces or blocks that are requested
     @type completePieces: C{list} of C{boolean} or L{HTTPDownloader.Peer}
-    @ivar completePieces: one per piece, will be False if no requests are
-        outstanding for the piece, True if the piece has been successfully
-        downloaded, or the Peer that a request for this piece has been sent  
+    @ivar completePieces: one per piece (or block), will be False if no
+        requests are outstanding for the piece, True if the piece has been
+        successfully downloaded, or the Peer that a request for this piece
+        has been sent (or that sent the block of a piece not yet verified,
+        or the piece that is being written to the file)
+    @type blockSources: C{dictionary}
+    @ivar blockSources: the peers that sent the downloaded blocks of pieces
+        that haven't been verified yet, keys are the block numbers
+    @type writingPieces: C{dictionary}
+    @ivar writingPieces: the pieces (or blocks) that were downloaded to a
+        buffer and are waiting to be written to the file, values are the
+        peers that sent them
+    @type requests: C{dictionary}
+    @ivar requests: the requests for incomplete pieces, keys are the piece
+        numbers, values are dictionaries with keys the sites the requests
+        were sent to, and values dictionaries with the 'buffer' to write
+        the piece to (if it's not written directly to the file), the
+        'writer' that is streaming the piece, and the 'index' of the piece
+        in the range that was requested
+    @type picker: L{StreamingPicker}
+    @ivar picker: determines the order to request pieces in
+    @type endgame: C{boolean}
+    @ivar endgame: whether to duplicate the last outstanding pieces to the
+        fastest idle peers
+    @type priority: C{int}
+    @ivar priority: the priority of the download's requests, lower is more urgent
+    @ivar client: the apt client that requested the download
+    @type hedge_later: L{twisted.internet.interfaces.IDelayedCall}
+    @ivar hedge_later: the delayed call to check if the piece needed next
+        should also be requested from the mirror
+    @type hedged: C{list} of C{int}
+    @ivar hedged: the pieces that have been requested from the mirror
     """
     
-    def __init__(self, manager, hash, mirror, compact_peers, file):
+    def __init__(self, manager, hash, mirror, compact_peers, file, client = None):
         """Initialize the instance and check for piece hashes.
         
         @type manager: L{PeerManager}
@@ -71,22 +363,37 @@ class FileDownload:
         @param compact_peers: a list of the peer info where the file can be found
         @type file: L{twisted.python.filepath.FilePath}
         @param file: the temporary file to use to store the downloaded file
+        @param client: the apt client that requested the download
+            (optional, defaults to an unknown client)
         """
         self.manager = manager
         self.hash = hash
         self.mirror = mirror
         self.compact_peers = compact_peers
+        self.priority = downloadPriority(mirror, hash.expSize)
+        self.client = client
         
         self.path = '/~/' + quote_plus(hash.expected())
+        self.maxRequests = config.getint('DEFAULT', 'MAX_DOWNLOAD_REQUESTS')
+        self.maxPeerRequests = config.getint('DEFAULT', 'MAX_PEER_REQUESTS')
         self.defer = None
         self.mirror_path = None
         self.pieces = None
         self.started = False
+        self.downloading = False
+        self.sharing = False
+        self.piecesKey = None
+        self.save_later = None
         
+        # Keep any previous partial download of the file to resume from
+        self.filePath = file
+        self.statePath = file.siblingExtension('.pieces')
         file.restat(False)
         if file.exists():
-            file.remove()
-        self.file = file.open('w+')
+            self.file = file.open('r+')
+        else:
+            self.file = file.open('w+')
+        self.writer = DiskWriter(self.file, hash.expSize)
 
     def run(self):
         """Start the downloading process."""
@@ -103,6 +410,11 @@ class FileDownload:
             site = uncompact(compact_peer['c'])
             peer = self.manager.getPeer(site)
             self.peers.setdefault(site, {})['peer'] = peer
+            if compact_peer.get('p', 0):
+                self.peers[site].setdefault('partial', True)
+            else:
+                # The peer has the whole file, even if it also shared it partially
+                self.peers[site]['partial'] = False
 
             # Extract any piece information from the peers list
             if 't' in compact_peer:
@@ -225,7 +537,7 @@ class FileDownload:
                                       **{'callbackArgs': (key, site),
                                          'errbackArgs': (key, site)})
                     self.outstanding += 1
-                    if self.outstanding >= 4:
+                    if self.outstanding >= self.maxRequests:
                         break
         
         if self.pieces is None and self.outstanding <= 0:
@@ -283,17 +595,45 @@ class FileDownload:
             log.msg('Peer returned a piece string that did not match')
             self.getPeerPieces(key, site)
 
+    def addPeers(self, compact_peers):
+        """Add more peers to download from, as they are found.
+        
+        The piece information of the new peers is not used, the first
+        peers found determine the pieces. Peers that were sharing a partial
+        download that are found to have completed it are used for all the
+        pieces.
+        
+        @type compact_peers: C{list} of C{dictionary}
+        @param compact_peers: a list of the peer info of the new peers
+        """
+        added = False
+        for compact_peer in compact_peers:
+            if 'c' not in compact_peer:
+                continue
+            site = uncompact(compact_peer['c'])
+            partial = bool(compact_peer.get('p', 0))
+            if site in self.peers:
+                if partial or not self.peers[site].get('partial', False):
+                    continue
+                log.msg('Peer %r has completed the download of %s' % (site, self.path))
+                self.peers[site]['partial'] = False
+            else:
+                log.msg('Adding a new peer %r to the download of %s' % (site, self.path))
+                self.peers[site] = {'peer': self.manager.getPeer(site), 'partial': partial}
+            if self.started:
+                if partial:
+                    self.getBitfield(site)
+                else:
+                    self.sitelist.add(site)
+            added = True
+        
+        if added and self.downloading and not self.file.closed:
+            self.getPieces()
+
     #{ Downloading the file
     def sort(self):
-        """Sort the peers by their rank (highest ranked at the end)."""
-        def sort(a, b):
-            """Sort peers by their rank."""
-            if self.peers[a]['peer'].rank > self.peers[b]['peer'].rank:
-                return 1
-            elif self.peers[a]['peer'].rank < self.peers[b]['peer'].rank:
-                return -1
-            return 0
-        self.sitelist.sort(sort)
+        """Reorder the peers by their current rank."""
+        self.sitelist.rerank()
 
     def startDownload(self):
         """Start the download from the peers."""
@@ -305,181 +645,839 @@ class FileDownload:
         self.started = True
         assert self.pieces, "You must initialize the piece hashes first"
         
-        self.sitelist = self.peers.keys()
+        self.sitelist = PeerQueue(self.peers, [site for site in self.peers
+                                               if not self.peers[site].get('partial', False)])
         
         # Special case if there's only one good peer left
 #        if len(self.sitelist) == 1:
-#            log.msg('Downloading from peer %r' % (self.peers[self.sitelist[0]]['peer'], ))
-#            self.defer.callback(self.peers[self.sitelist[0]]['peer'].get(self.path))
+#            log.msg('Downloading from peer %r' % (self.peers[self.sitelist.best()]['peer'], ))
+#            self.defer.callback(self.peers[self.sitelist.best()]['peer'].get(self.path))
 #            return
         
         # Begin to download the pieces
         self.outstanding = 0
         self.nextFinish = 0
-        self.completePieces = [False for piece in self.pieces]
+        if self.hash.expSize and len(self.pieces) < len(self.sitelist):
+            # Use smaller blocks so more of the peers can be used
+            log.msg('Downloading %s in blocks from %d peers' % (self.path, len(self.sitelist)))
+            self.chunkSize = BLOCK_SIZE
+            self.completePieces = [False for x in xrange(0, self.hash.expSize, BLOCK_SIZE)]
+        else:
+            self.chunkSize = PIECE_SIZE
+            self.completePieces = [False for piece in self.pieces]
+        self.blockSources = {}
+        self.writingPieces = {}
+        self.requests = {}
+        picker = config.get('DEFAULT', 'PIECE_PICKER')
+        if picker not in PIECE_PICKERS:
+            log.msg('Unknown piece picker %r, using in order streaming' % picker)
+            picker = 'streaming'
+        self.picker = PIECE_PICKERS[picker](self, config.getint('DEFAULT', 'PRIORITY_WINDOW'))
+        self.endgame = config.getboolean('DEFAULT', 'ENDGAME')
         self.addedMirror = False
+        self.hedge_later = None
+        self.hedged = []
+        if self.hash.expSize:
+            self.manager.hedging.addDownload(self.hash.expSize)
+        
+        # Find out which pieces the peers still downloading it have
+        for site in self.peers:
+            if self.peers[site].get('partial', False):
+                self.getBitfield(site)
+        
+        # Check for pieces from a previous download of the file first
+        d = self.resume()
+        d.addCallback(self._resumed)
+        d.addErrback(self._resumeError)
+        
+    def _resumed(self, pieces):
+        """Begin downloading the remaining pieces."""
+        if pieces:
+            log.msg('Resuming download of %s with %d of %d pieces' %
+                    (self.path, len(pieces), len(self.pieces)))
+            for piece in pieces:
+                self.completePieces[piece] = True
+            while (self.nextFinish < len(self.completePieces) and
+                   self.completePieces[self.nextFinish] == True):
+                self.nextFinish += 1
+            if self.nextFinish:
+                self._startStream({})
+                self.stream.updateAvailable(self.nextFinish*self.chunkSize)
         self.addMirror()
+        self.downloading = True
+        self.share()
         self.getPieces()
+        
+    def _resumeError(self, err):
+        """Start the download from the beginning."""
+        log.msg('Failed to resume the download of %s' % self.path)
+        log.err(err)
+        self._resumed([])
+
+    def _startStream(self, headers):
+        """Start sending the return file.
+        
+        @type headers: C{dictionary}
+        @param headers: the headers to send with the response
+        """
+        if self.defer:
+            df = self.defer
+            self.defer = None
+            self.stream = GrowingFileStream(self.file, self.hash.expSize)
+            resp = Response(200, headers, self.stream)
+            df.callback(resp)
 
     def addMirror(self):
         """Use the mirror if there are few peers."""
         if not self.addedMirror and len(self.sitelist) + self.outstanding < config.getint('DEFAULT', 'MIN_DOWNLOAD_PEERS'):
             self.addedMirror = True
-            parsed = urlparse(self.mirror)
-            if parsed[0] == "http":
-                site = splitHostPort(parsed[0], parsed[1])
-                self.mirror_path = urlunparse(('', '') + parsed[2:])
-                peer = self.manager.getPeer(site, mirror = True)
-                self.peers[site] = {}
-                self.peers[site]['peer'] = peer
-                self.sitelist.append(site)
+            site = self._mirrorSite()
+            if site:
+                self.peers[site].pop('hedge', None)
+                self.sitelist.add(site)
+    
+    def _mirrorSite(self):
+        """Get the mirror as a peer of the download.
+        
+        @return: the site of the mirror, or None if it's not an HTTP mirror
+        """
+        parsed = urlparse(self.mirror)
+        if parsed[0] != "http":
+            return None
+        site = splitHostPort(parsed[0], parsed[1])
+        if site not in self.peers:
+            self.mirror_path = urlunparse(('', '') + parsed[2:])
+            self.peers[site] = {'peer': self.manager.getPeer(site, mirror = True)}
+        return site
         
+    #{ Hedging slow pieces
+    def _scheduleHedge(self):
+        """Start waiting for the next piece needed by the stream to start arriving."""
+        if not self.manager.hedging.percent or not self.mirror.startswith('http:'):
+            return
+        
+        # Skip the blocks that are done, waiting for the rest of their piece
+        piece = self.nextFinish
+        while (piece < len(self.completePieces) and
+               self.completePieces[piece] not in (True, False) and
+               not self.requests.get(piece, {})):
+            piece += 1
+        if self.hedge_later is not None:
+            if self.hedge_later.args[0] == piece:
+                return
+            self._cancelHedge()
+        if (piece >= len(self.completePieces) or piece in self.hedged or
+            self.completePieces[piece] in (True, False)):
+            return
+        sent = min([request['sent'] for request in self.requests[piece].values()])
+        delay = max(0.0, self.manager.hedging.budget() - (monotonic() - sent))
+        self.hedge_later = reactor.callLater(delay, self._hedge, piece)
+    
+    def _cancelHedge(self):
+        """Stop waiting to hedge a piece."""
+        if self.hedge_later and self.hedge_later.active():
+            self.hedge_later.cancel()
+        self.hedge_later = None
+    
+    def _hedge(self, piece):
+        """Request a piece from the mirror if no peer has started to send it."""
+        self.hedge_later = None
+        if (self.file.closed or self.completePieces[piece] in (True, False) or
+            not self.requests.get(piece, {})):
+            return
+        for request in self.requests[piece].values():
+            if request['writer'] is not None:
+                # A peer is already sending it
+                return
+        
+        site = self._mirrorSite()
+        if (site is None or site in self.requests.get(piece, {}) or
+            not self.manager.hedging.hedge(self.chunkSize)):
+            return
+        if not self.manager.scheduler.acquire(self):
+            return
+        log.msg('No response for piece %d after %0.2f seconds, also requesting it from the mirror' %
+                (piece, self.manager.hedging.budget()))
+        self.hedged.append(piece)
+        if site not in self.sitelist:
+            self.peers[site]['hedge'] = True
+        self._requestPieces([piece], site, True)
+        
+    #{ Sharing the verified pieces
+    def share(self):
+        """Advertise the download in the DHT, so peers can get the verified pieces."""
+        if (not config.getboolean('DEFAULT', 'PARTIAL_SEEDING') or self.manager.dht is None or
+            len(self.pieces) <= 1 or None in self.pieces):
+            return
+        storeDefer = self.manager.dht.storePartial(self.hash, self.pieces)
+        if storeDefer is not None:
+            log.msg('Sharing the verified pieces of %s' % self.path)
+            self.sharing = True
+            self.piecesKey = sha.new(''.join(self.pieces)).digest()
+            storeDefer.addErrback(self._shareError)
+    
+    def _shareError(self, err):
+        """Adding the download to the DHT failed, peers can't find it."""
+        log.msg('Failed to share the download of %s in the DHT' % self.path)
+    
+    def _stopSharing(self):
+        """Stop sharing a download that failed or was aborted."""
+        if self.sharing and self.manager.dht is not None:
+            self.manager.dht.stopPartial(self.hash)
+        self.sharing = False
+    
+    def bitfield(self):
+        """Get which pieces of the file have been downloaded and verified.
+        
+        @rtype: C{string}
+        @return: a '1' for each piece that is complete, '0' otherwise
+        """
+        blocks = PIECE_SIZE / self.chunkSize
+        return ''.join([(False not in [complete == True for complete in
+                                       self.completePieces[piece*blocks:(piece + 1)*blocks]] and '1') or '0'
+                        for piece in xrange(len(self.pieces))])
+    
+    def hasRange(self, start, end):
+        """Check whether a range of the file has all been downloaded and verified.
+        
+        @type start: C{int}
+        @param start: the first byte of the range
+        @type end: C{int}
+        @param end: the last byte of the range
+        @rtype: C{boolean}
+        """
+        if start < 0 or end < start or end >= self.hash.expSize:
+            return False
+        for chunk in xrange(start / self.chunkSize, end / self.chunkSize + 1):
+            if self.completePieces[chunk] != True:
+                return False
+        return True
+    
+    #{ Finding the pieces of peers still downloading the file
+    def getBitfield(self, site):
+        """Ask a peer that is still downloading the file which pieces it has.
+        
+        @param site: the peer to ask
+        """
+        self.peers[site]['checking'] = True
+        self.peers[site]['checked'] = monotonic()
+        path = '/~bitfield/' + quote_plus(self.hash.expected())
+        df = self.peers[site]['peer'].get(path, priority = self.priority)
+        reactor.callLater(0, df.addCallbacks,
+                          *(self._getBitfield, self._bitfieldError),
+                          **{'callbackArgs': (site, ),
+                             'errbackArgs': (site, )})
+    
+    def _getBitfield(self, response, site):
+        """Process the retrieved headers of the pieces a peer has."""
+        if response.code != 200:
+            log.msg('Peer %r responded %d for the pieces it has of %s' % (site, response.code, self.path))
+            if response.stream and response.stream.length:
+                stream.readAndDiscard(response.stream)
+            self._bitfieldDone(site, False)
+        else:
+            data = []
+            df = stream.readStream(response.stream, data.append)
+            df.addCallbacks(self._gotBitfield, self._bitfieldError,
+                            callbackArgs = (data, site), errbackArgs = (site, ))
+    
+    def _gotBitfield(self, result, data, site):
+        """Save the pieces a peer has."""
+        try:
+            have = bdecode(''.join(data))['b']
+        except:
+            log.msg('Error bdecoding the pieces of peer %r' % (site, ))
+            log.err()
+            self._bitfieldDone(site, False)
+            return
+        log.msg('Peer %r has %d of the %d pieces of %s' % (site, have.count('1'), len(self.pieces), self.path))
+        self.peers[site]['have'] = have
+        self._bitfieldDone(site, True)
+    
+    def _bitfieldError(self, err, site):
+        """Asking a peer which pieces it has failed."""
+        log.msg('Failed to get the pieces peer %r has of %s' % (site, self.path))
+        log.err(err)
+        self._bitfieldDone(site, False)
+    
+    def _bitfieldDone(self, site, success):
+        """Request any pieces a peer has, or count the failure against it."""
+        self.peers[site]['checking'] = False
+        if not success:
+            self.peers[site]['errors'] = self.peers[site].get('errors', 0) + 1
+        elif self.downloading and not self.file.closed:
+            self.getPieces()
+    
+    def hasPiece(self, site, chunk):
+        """Check whether a peer has a piece (or block) of the file.
+        
+        @param site: the peer to check
+        @type chunk: C{int}
+        @param chunk: the piece (or block) to check for
+        @rtype: C{boolean}
+        """
+        if not self.peers[site].get('partial', False):
+            return True
+        have = self.peers[site].get('have', '')
+        piece = chunk * self.chunkSize / PIECE_SIZE
+        return piece < len(have) and have[piece] == '1'
+    
+    #{ Resuming downloads
+    def resume(self):
+        """Find the pieces of the file completed by a previous download.
+        
+        The pieces the saved state says are complete are verified against
+        their hashes in a thread before they are used.
+        
+        @rtype: L{twisted.internet.defer.Deferred}
+        @return: a deferred that will fire with the list of complete pieces
+        """
+        self.statePath.restat(False)
+        if (len(self.pieces) <= 1 or self.chunkSize != PIECE_SIZE or
+            None in self.pieces or not self.statePath.exists()):
+            return defer.succeed([])
+        
+        state = self.statePath.getContent()
+        if len(state) != len(self.pieces):
+            log.msg('Ignoring the saved state of %s, it has the wrong number of pieces' % self.path)
+            return defer.succeed([])
+        
+        pieces = [piece for piece in xrange(len(state)) if state[piece] == '1']
+        return threads.deferToThread(self._verifyPieces, pieces)
+    
+    def _verifyPieces(self, pieces):
+        """Check the hashes of pieces in the file (runs in a separate thread)."""
+        f = self.filePath.open('r')
+        verified = []
+        for piece in pieces:
+            f.seek(piece*PIECE_SIZE)
+            if sha.new(f.read(PIECE_SIZE)).digest() == self.pieces[piece]:
+                verified.append(piece)
+        f.close()
+        return verified
+    
+    def _scheduleSave(self):
+        """Save the state soon, along with any other pieces verified by then."""
+        if self.save_later is None:
+            self.save_later = reactor.callLater(STATE_SAVE_DELAY, self.saveState)
+    
+    def _cancelSave(self):
+        """Cancel any pending save of the state."""
+        if self.save_later is not None and self.save_later.active():
+            self.save_later.cancel()
+        self.save_later = None
+    
+    def saveState(self):
+        """Save the completed pieces so the download can be resumed later."""
+        self._cancelSave()
+        state = ''.join([(complete == True and '1') or '0'
+                         for complete in self.completePieces])
+        try:
+            self.statePath.setContent(state)
+        except (IOError, OSError), e:
+            log.msg('Failed to save the state of %s: %r' % (self.path, e))
+    
+    def removeState(self):
+        """Remove the saved state of the download once it is no longer needed."""
+        self._cancelSave()
+        self.statePath.restat(False)
+        if self.statePath.exists():
+            self.statePath.remove()
+
     #{ Downloading the pieces
     def getPieces(self):
         """Download the next pieces from the peers."""
+        if self.nextFinish >= len(self.completePieces):
+            # Check if we're done (late duplicate requests are ignored)
+            if not self.stream.finished:
+                log.msg('Download is complete for %s' % self.path)
+                self._finished()
+                self.removeState()
+                self.stream.allAvailable(remove = True)
+            return
+        
         if self.file.closed:
             log.msg('Download has been aborted for %s' % self.path)
+            self._stopSharing()
+            self._finished()
+            self.removeState()
             self.stream.allAvailable(remove = True)
             return
+        
+        if self.writer.failure:
+            # Other peers can't help if the data can't be written
+            if not self.writer.closed:
+                log.msg('Download failed, could not write the file for %s' % self.path)
+                self._failed()
+            return
             
         self.sort()
-        piece = self.nextFinish
-        while self.outstanding < 4 and self.sitelist and piece < len(self.completePieces):
+        order = self.picker.order()
+        self._getPartialPieces(order)
+        for piece in order:
+            if self.outstanding >= self.maxRequests or not self.sitelist:
+                break
             if self.completePieces[piece] == False:
-                # Send a request to the highest ranked peer
-                site = self.sitelist.pop()
-                self.completePieces[piece] = site
-                log.msg('Sending a request for piece %d to peer %r' % (piece, self.peers[site]['peer']))
+                # Wait for a turn if other downloads are more urgent
+                if not self.manager.scheduler.acquire(self):
+                    break
                 
-                self.outstanding += 1
-                path = self.path
-                if self.peers[site]['peer'].mirror:
-                    path = self.mirror_path
-                if len(self.completePieces) > 1:
-                    df = self.peers[site]['peer'].getRange(path, piece*PIECE_SIZE, (piece+1)*PIECE_SIZE - 1)
-                else:
-                    df = self.peers[site]['peer'].get(path)
-                reactor.callLater(0, df.addCallbacks,
-                                  *(self._getPiece, self._getError),
-                                  **{'callbackArgs': (piece, site),
-                                     'errbackArgs': (piece, site)})
-            piece += 1
+                # Send a request to the highest ranked peer, for as many of
+                # the following pieces as it can download quickly
+                site = self._takeSite()
+                pieces = [piece]
+                while (len(pieces) < self.rangePieces(site) and
+                       pieces[-1] + 1 < len(self.completePieces) and
+                       self.completePieces[pieces[-1] + 1] == False):
+                    pieces.append(pieces[-1] + 1)
+                self._requestPieces(pieces, site)
+        
+        # Duplicate the remaining outstanding pieces to the fastest idle peers
+        if self.endgame and False not in self.completePieces:
+            for piece in xrange(self.nextFinish, len(self.completePieces)):
+                if self.outstanding >= self.maxRequests or not self.sitelist:
+                    break
+                if piece in self.requests and len(self.requests[piece]) < 2:
+                    site = self.sitelist.best()
+                    if site not in self.requests[piece]:
+                        if not self.manager.scheduler.acquire(self):
+                            break
+                        log.msg('Endgame, duplicating piece %d' % piece)
+                        self._requestPieces([piece], self._takeSite(), True)
                 
-        # Check if we're done
-        if self.outstanding <= 0 and self.nextFinish >= len(self.completePieces):
-            log.msg('Download is complete for %s' % self.path)
-            self.stream.allAvailable(remove = True)
-            
+        # Watch for the piece needed next being slow to start arriving
+        self._scheduleHedge()
+        
         # Check if we ran out of peers
         if self.outstanding <= 0 and not self.sitelist and False in self.completePieces:
             log.msg("Download failed, no peers left to try.")
-            if self.defer:
-                # Send a return error
-                df = self.defer
-                self.defer = None
-                resp = Response(500, {}, None)
-                df.callback(resp)
-            else:
-                # Already streaming the response, try and abort
-                self.stream.allAvailable(remove = True)
+            self._failed()
+    
+    def _failed(self):
+        """Stop the failed download, keeping the completed pieces to resume later."""
+        self._stopSharing()
+        self._finished()
+        self.saveState()
+        if self.defer:
+            # Send a return error
+            df = self.defer
+            self.defer = None
+            resp = Response(500, {}, None)
+            df.callback(resp)
+        elif not self.stream.finished:
+            # Already streaming the response, try and abort
+            self.stream.allAvailable()
+    
+    def _getPartialPieces(self, order):
+        """Request the pieces that peers still downloading the file have.
+        
+        These peers aren't in the L{sitelist}, they are sent requests first
+        for the pieces they have verified, in the order of preference. If
+        they have none that are needed, they are asked again which pieces
+        they have every L{BITFIELD_REFRESH} seconds.
+        
+        @type order: C{list} of C{int}
+        @param order: the piece numbers, in order of preference
+        """
+        if False not in self.completePieces:
+            return
+        
+        for site in self.peers.keys():
+            info = self.peers[site]
+            if not info.get('partial', False) or info.get('errors', 0) >= 3:
+                continue
+            
+            for piece in order:
+                if (self.outstanding >= self.maxRequests or
+                    info.get('outstanding', 0) >= self.window(site)):
+                    break
+                if self.completePieces[piece] == False and self.hasPiece(site, piece):
+                    if not self.manager.scheduler.acquire(self):
+                        return
+                    pieces = [piece]
+                    while (len(pieces) < self.rangePieces(site) and
+                           pieces[-1] + 1 < len(self.completePieces) and
+                           self.completePieces[pieces[-1] + 1] == False and
+                           self.hasPiece(site, pieces[-1] + 1)):
+                        pieces.append(pieces[-1] + 1)
+                    self._requestPieces(pieces, site)
+            
+            if (not info.get('outstanding', 0) and not info.get('checking', False) and
+                monotonic() - info.get('checked', 0) >= BITFIELD_REFRESH):
+                self.getBitfield(site)
+    
+    def _finished(self):
+        """Clean up once the download is complete, failed, or aborted."""
+        self.sharing = False
+        self._cancelHedge()
+        self._cancelSave()
+        # Errors writing the file have already been logged
+        self.writer.close().addErrback(lambda err: None)
+        self.manager.scheduler.remove(self)
+        if self.manager.downloads.get(self.hash.expected(), None) is self:
+            del self.manager.downloads[self.hash.expected()]
+    
+    def window(self, site):
+        """Determine the number of requests to keep outstanding to a peer.
+        
+        Enough requests are pipelined to the peer to cover the data it can
+        send during one response time (its bandwidth-delay product), so that
+        the connection doesn't sit idle between pieces.
+        
+        @param site: the peer to check
+        @rtype: C{int}
+        """
+        peer = self.peers[site]['peer']
+        window = 1 + int(peer.downloadSpeed() * peer.responseTime() / self.chunkSize)
+        return max(1, min(window, self.maxPeerRequests))
+    
+    def _takeSite(self):
+        """Get the highest ranked peer to send a request to.
+        
+        The peer is removed from the list of available peers if this
+        request fills its window.
+        """
+        site = self.sitelist.best()
+        if self.peers[site].get('outstanding', 0) + 1 >= self.window(site):
+            self.sitelist.pop()
+        else:
+            # It will be ranked lower once the request is sent
+            self.sitelist.demote(site)
+        return site
+    
+    def _releaseSite(self, site, keep = True):
+        """A request to a peer has been answered.
+        
+        @param site: the peer that answered
+        @type keep: C{boolean}
+        @param keep: whether to keep sending requests to the peer
+            (optional, defaults to True)
+        """
+        self.outstanding -= 1
+        self.peers[site]['outstanding'] -= 1
+        self.manager.scheduler.release(self)
+        if not keep:
+            self.sitelist.remove(site)
+            self.addMirror()
+        elif not self.peers[site].get('hedge', False) and not self.peers[site].get('partial', False):
+            self.sitelist.add(site)
+
+    def rangePieces(self, site):
+        """Determine the number of consecutive pieces to request from a peer at once.
+        
+        Fast peers are sent a single range request for about a second of
+        data, saving the overhead of a request and response per piece.
+        
+        @param site: the peer to check
+        @rtype: C{int}
+        """
+        speed = self.peers[site]['peer'].downloadSpeed()
+        return max(1, min(int(speed / self.chunkSize), MAX_RANGE_PIECES))
     
-    def _getPiece(self, response, piece, site):
+    def _requestPieces(self, pieces, site, buffered = False):
+        """Send a request for one or more consecutive pieces to a peer.
+        
+        @type pieces: C{list} of C{int}
+        @param pieces: the consecutive pieces to request
+        @param site: the peer to request them from
+        @type buffered: C{boolean}
+        @param buffered: whether to download the single piece to memory
+            rather than directly to the file, used when the piece is also
+            being downloaded from another peer (optional, defaults to False)
+        """
+        log.msg('Sending a request for pieces %d-%d to peer %r' % (pieces[0], pieces[-1], self.peers[site]['peer']))
+        for index in xrange(len(pieces)):
+            piece = pieces[index]
+            if self.completePieces[piece] == False:
+                self.completePieces[piece] = site
+            self.requests.setdefault(piece, {})[site] = {'buffer': None, 'writer': None,
+                                                         'index': index, 'sent': monotonic()}
+        if buffered:
+            assert len(pieces) == 1, "Only single pieces can be buffered"
+            self.requests[pieces[0]][site]['buffer'] = StringIO()
+        
+        self.outstanding += 1
+        self.peers[site]['outstanding'] = self.peers[site].get('outstanding', 0) + 1
+        path = self.path
+        if self.peers[site]['peer'].mirror:
+            path = self.mirror_path
+        if len(self.completePieces) > 1:
+            df = self.peers[site]['peer'].getRange(path, pieces[0]*self.chunkSize, (pieces[-1]+1)*self.chunkSize - 1,
+                                                   priority = self.priority)
+        else:
+            df = self.peers[site]['peer'].get(path, priority = self.priority)
+        reactor.callLater(0, df.addCallbacks,
+                          *(self._getPiece, self._getError),
+                          **{'callbackArgs': (pieces, site),
+                             'errbackArgs': (pieces, site)})
+
+    def _cancelRequest(self, request):
+        """Stop writing the piece of a request to the file."""
+        if isinstance(request['writer'], PiecesStreamToFile):
+            request['writer'].cancelPiece(request['index'])
+        elif request['writer']:
+            request['writer'].cancel()
+
+    def _pieceFailed(self, piece, site):
+        """Forget a failed request for a piece, so it can be requested again."""
+        request = self.requests.get(piece, {}).pop(site, None)
+        if request:
+            self._cancelRequest(request)
+        if self.completePieces[piece] == True:
+            return
+        if self.requests.get(piece, {}):
+            # Another request for the piece is still outstanding
+            self.completePieces[piece] = self.requests[piece].keys()[0]
+        else:
+            self.requests.pop(piece, None)
+            self.completePieces[piece] = False
+
+    def availability(self, piece):
+        """Determine the number of peers that have a piece.
+        
+        @type piece: C{int}
+        @param piece: the piece to check
+        @rtype: C{int}
+        """
+        return len([site for site in self.peers if self.hasPiece(site, piece)])
+
+    def _getPiece(self, response, pieces, site):
         """Process the retrieved headers from the peer."""
-        if response.code == 404:
+        keep = True
+        active = [piece for piece in pieces
+                  if self.completePieces[piece] != True and site in self.requests.get(piece, {})]
+        if not active:
+            # Other peers already finished these pieces
+            log.msg('Discarding the late response for pieces %d-%d from peer %r' % (pieces[0], pieces[-1], self.peers[site]['peer']))
+            if response.stream and response.stream.length:
+                stream.readAndDiscard(response.stream)
+        elif response.code == 404 and self.peers[site].get('partial', False):
+            # Peer hasn't verified these pieces, check again which it has
+            log.msg('Peer sharing a partial download does not have pieces %d-%d: %r' % (pieces[0], pieces[-1], self.peers[site]['peer']))
+            for piece in active:
+                self._pieceFailed(piece, site)
+            if response.stream and response.stream.length:
+                stream.readAndDiscard(response.stream)
+            self.peers[site]['have'] = ''
+            self.peers[site]['checked'] = 0
+            self.peers[site]['errors'] = self.peers[site].get('errors', 0) + 1
+        elif response.code == 404:
             # Peer no longer has this file, move on
-            log.msg('Peer sharing piece %d no longer has it: %r' % (piece, self.peers[site]['peer']))
-            self.completePieces[piece] = False
+            log.msg('Peer sharing pieces %d-%d no longer has it: %r' % (pieces[0], pieces[-1], self.peers[site]['peer']))
+            for piece in active:
+                self._pieceFailed(piece, site)
             if response.stream and response.stream.length:
                 stream.readAndDiscard(response.stream)
             
             # Don't add the site back, just move on
-            site = None
+            keep = False
         elif ((len(self.completePieces) > 1 and response.code != 206) or
             (response.code not in (200, 206))):
             # Request failed, try a different peer
-            log.msg('Wrong response type %d for piece %d from peer %r' % (response.code, piece, self.peers[site]['peer']))
+            log.msg('Wrong response type %d for pieces %d-%d from peer %r' % (response.code, pieces[0], pieces[-1], self.peers[site]['peer']))
             self.peers[site]['peer'].hashError('Peer responded with the wrong type of download: %r' % response.code)
-            self.completePieces[piece] = False
+            for piece in active:
+                self._pieceFailed(piece, site)
             self.peers[site]['errors'] = self.peers[site].get('errors', 0) + 1
             if response.stream and response.stream.length:
                 stream.readAndDiscard(response.stream)
 
             # After 3 errors in a row, drop the peer
             if self.peers[site]['errors'] >= 3:
-                site = None
+                keep = False
         else:
+            if not self.peers[site]['peer'].mirror:
+                self.manager.hedging.addResponseTime(monotonic() - self.requests[active[0]][site]['sent'])
             if self.defer:
-                # Start sending the return file
-                df = self.defer
-                self.defer = None
-                self.stream = GrowingFileStream(self.file, self.hash.expSize)
-
                 # Get the headers from the peer's response
                 headers = {}
                 if response.headers.hasHeader('last-modified'):
                     headers['last-modified'] = response.headers.getHeader('last-modified')
-                resp = Response(200, headers, self.stream)
-                df.callback(resp)
+                self._startStream(headers)
 
-            # Read the response stream to the file
-            log.msg('Streaming piece %d from peer %r' % (piece, self.peers[site]['peer']))
+            # Read the response stream to the file (or the buffer)
+            log.msg('Streaming pieces %d-%d from peer %r' % (pieces[0], pieces[-1], self.peers[site]['peer']))
+            if self.requests[active[0]][site]['buffer'] is not None:
+                outFile, start, diskWriter = self.requests[active[0]][site]['buffer'], 0, None
+            else:
+                outFile, start, diskWriter = self.file, pieces[0]*self.chunkSize, self.writer
             if response.code == 206:
-                df = StreamToFile(self.hash.newPieceHasher(), response.stream,
-                                  self.file, piece*PIECE_SIZE, PIECE_SIZE).run()
+                writer = PiecesStreamToFile(self.hash.newPieceHasher, response.stream,
+                                            outFile, start, len(pieces)*self.chunkSize, self.chunkSize,
+                                            diskWriter)
             else:
-                df = StreamToFile(self.hash.newHasher(), response.stream,
-                                  self.file).run()
+                writer = StreamToFile(self.hash.newHasher(), response.stream,
+                                      outFile, start, writer = diskWriter)
+            for index in xrange(len(pieces)):
+                if pieces[index] in active:
+                    self.requests[pieces[index]][site]['writer'] = writer
+                elif response.code == 206:
+                    writer.cancelPiece(index)
+            df = writer.run()
             reactor.callLater(0, df.addCallbacks,
-                              *(self._gotPiece, self._gotError),
-                              **{'callbackArgs': (piece, site),
-                                 'errbackArgs': (piece, site)})
+                              *(self._gotPieces, self._gotError),
+                              **{'callbackArgs': (pieces, site),
+                                 'errbackArgs': (pieces, site)})
 
-        self.outstanding -= 1
-        if site:
-            self.sitelist.append(site)
-        else:
-            self.addMirror()
+        self._releaseSite(site, keep)
         self.getPieces()
 
-    def _getError(self, err, piece, site):
+    def _getError(self, err, pieces, site):
         """Peer failed, try again."""
-        log.msg('Got error for piece %d from peer %r' % (piece, self.peers[site]['peer']))
-        self.outstanding -= 1
-        self.peers[site]['errors'] = self.peers[site].get('errors', 0) + 1
-        if self.peers[site]['errors'] < 3:
-            self.sitelist.append(site)
+        log.msg('Got error for pieces %d-%d from peer %r' % (pieces[0], pieces[-1], self.peers[site]['peer']))
+        if self.writer.failure:
+            # Writing to the file failed (already logged), not the peer
+            self._releaseSite(site)
         else:
-            self.addMirror()
-        self.completePieces[piece] = False
+            self.peers[site]['errors'] = self.peers[site].get('errors', 0) + 1
+            self._releaseSite(site, self.peers[site]['errors'] < 3)
+            log.err(err)
+        for piece in pieces:
+            if site in self.requests.get(piece, {}):
+                self._pieceFailed(piece, site)
+        self.getPieces()
+
+    def _gotPieces(self, hashes, pieces, site):
+        """Process the retrieved pieces from the peer."""
+        if not isinstance(hashes, list):
+            hashes = [hashes]
+        for index in xrange(len(pieces)):
+            if index < len(hashes):
+                self._checkPiece(hashes[index], pieces[index], site)
+            elif site in self.requests.get(pieces[index], {}):
+                # The response ended before this piece
+                log.msg('Piece %d was missing from the response of peer %r' % (pieces[index], self.peers[site]['peer']))
+                self._pieceFailed(pieces[index], site)
         self.getPieces()
-        log.err(err)
 
-    def _gotPiece(self, hash, piece, site):
-        """Process the retrieved piece from the peer."""
-        if self.pieces[piece] and hash.digest() != self.pieces[piece]:
+    def _checkPiece(self, hash, piece, site):
+        """Check the hash of a retrieved piece (or block)."""
+        if self.completePieces[piece] == True or site not in self.requests.get(piece, {}):
+            # Lost the race to another peer
+            log.msg('Piece %d from peer %r was already finished by another' % (piece, self.peers[site]['peer']))
+        elif self.chunkSize == PIECE_SIZE and self.pieces[piece] and hash.digest() != self.pieces[piece]:
             # Hash doesn't match
             log.msg('Hash error for piece %d from peer %r' % (piece, self.peers[site]['peer']))
             self.peers[site]['peer'].hashError('Piece received from peer does not match expected')
             self.peers[site]['errors'] = self.peers[site].get('errors', 0) + 1
-            self.completePieces[piece] = False
+            self._pieceFailed(piece, site)
         else:
             # Successfully completed one of several pieces
             log.msg('Finished with piece %d from peer %r' % (piece, self.peers[site]['peer']))
-            self.completePieces[piece] = True
-            self.peers[site]['errors'] = 0
-            while (self.nextFinish < len(self.completePieces) and
-                   self.completePieces[self.nextFinish] == True):
-                self.nextFinish += 1
-                self.stream.updateAvailable(PIECE_SIZE)
+            requests = self.requests.pop(piece, {})
+            request = requests.pop(site, None)
+            
+            # Cancel the other requests for the piece before they write more
+            for other in requests.values():
+                self._cancelRequest(other)
+            if request and request['buffer'] is not None:
+                # Written after any data the other requests already queued,
+                # and only used once it's in the file
+                self.completePieces[piece] = site
+                self.writingPieces[piece] = site
+                self.writer.write(piece*self.chunkSize, request['buffer'].getvalue(),
+                                  lambda: self._bufferWritten(piece, site))
+                self.writer.flush().addErrback(self._bufferError, piece, site)
+            else:
+                self._pieceDone(piece, site)
 
+    def _pieceDone(self, piece, site):
+        """Use a piece (or block) from a peer that is in the file."""
+        if self.chunkSize == PIECE_SIZE:
+            self.peers[site]['errors'] = 0
+            self._chunksComplete([piece])
+        else:
+            # Blocks can only be verified once the whole piece is done
+            self.completePieces[piece] = site
+            self.blockSources[piece] = site
+            self._checkBlocks(piece)
+    
+    def _bufferWritten(self, piece, site):
+        """The buffered piece (or block) from a peer has been written to the file."""
+        if self.writingPieces.pop(piece, None) is None or self.writer.closed:
+            return
+        self._pieceDone(piece, site)
         self.getPieces()
+    
+    def _bufferError(self, err, piece, site):
+        """Writing a buffered piece (or block) failed, so download it again."""
+        if self.writingPieces.pop(piece, None) is not None:
+            log.msg('Failed to write piece %d from peer %r' % (piece, self.peers[site]['peer']))
+            log.err(err)
+            self.completePieces[piece] = False
+            if not self.writer.closed:
+                self.getPieces()
 
-    def _gotError(self, err, piece, site):
+    def _checkBlocks(self, block):
+        """Verify the piece a block is in, if all its blocks are done.
+        
+        If the piece's hash is wrong, all the peers that sent blocks of it
+        are blamed, and all of its blocks are downloaded again.
+        
+        @type block: C{int}
+        @param block: the block that was just downloaded
+        """
+        blocks = PIECE_SIZE / self.chunkSize
+        piece = block / blocks
+        chunks = range(piece*blocks, min((piece + 1)*blocks, len(self.completePieces)))
+        for chunk in chunks:
+            if chunk not in self.blockSources:
+                return
+        
+        sources = []
+        for chunk in chunks:
+            site = self.blockSources.pop(chunk)
+            if site not in sources:
+                sources.append(site)
+        
+        if self.pieces[piece]:
+            if len(self.pieces) == 1:
+                hasher = self.hash.newHasher()
+            else:
+                hasher = self.hash.newPieceHasher()
+            self.file.seek(piece*PIECE_SIZE)
+            hasher.update(self.file.read(PIECE_SIZE))
+            if hasher.digest() != self.pieces[piece]:
+                log.msg('Hash error for piece %d from blocks sent by peers %r' % (piece, sources))
+                for site in sources:
+                    self.peers[site]['peer'].hashError('Blocks received from peer do not match expected')
+                    self.peers[site]['errors'] = self.peers[site].get('errors', 0) + 1
+                for chunk in chunks:
+                    self.completePieces[chunk] = False
+                return
+        
+        for site in sources:
+            self.peers[site]['errors'] = 0
+        self._chunksComplete(chunks)
+
+    def _chunksComplete(self, chunks):
+        """Mark verified pieces (or blocks) as complete and stream them.
+        
+        @type chunks: C{list} of C{int}
+        @param chunks: the pieces (or blocks) that are complete
+        """
+        for chunk in chunks:
+            self.completePieces[chunk] = True
+        if [complete for complete in self.completePieces if complete != True]:
+            self._scheduleSave()
+        else:
+            # The file may be read completely before getPieces runs again
+            self.removeState()
+        while (self.nextFinish < len(self.completePieces) and
+               self.completePieces[self.nextFinish] == True):
+            self.nextFinish += 1
+            self.stream.updateAvailable(self.chunkSize)
+
+    def _gotError(self, err, pieces, site):
         """Piece download failed, try again."""
-        log.msg('Error streaming piece %d from peer %r: %r' % (piece, self.peers[site]['peer'], err))
-        log.err(err)
-        self.peers[site]['errors'] = self.peers[site].get('errors', 0) + 1
-        self.completePieces[piece] = False
+        log.msg('Error streaming pieces %d-%d from peer %r: %r' % (pieces[0], pieces[-1], self.peers[site]['peer'], err))
+        if not self.writer.failure:
+            # Failing to write to the file (already logged) isn't the peer's fault
+            log.err(err)
+            self.peers[site]['errors'] = self.peers[site].get('errors', 0) + 1
+        for piece in pieces:
+            if site in self.requests.get(piece, {}):
+                self._pieceFailed(piece, site)
         self.getPieces()
         
 class PeerManager:
@@ -492,7 +1490,30 @@ class PeerManager:
     @type stats: L{stats.StatsLogger}
     @ivar stats: the statistics logger to record sent data to
     @type clients: C{dictionary}
-    @ivar clients: the available peers that have been previously contacted
+    @ivar clients: the available peers that have been recently contacted
+    @type summaries: C{shelve dictionary}
+    @ivar summaries: the saved performance of peers that have been forgotten,
+        keys are the 'host:port', values are the time it was saved and the
+        summary
+    @type maxClients: C{int}
+    @ivar maxClients: the maximum number of peers to keep in memory
+    @type targetConnections: C{int}
+    @ivar targetConnections: the number of open connections to try to stay
+        below, by closing idle ones
+    @type idleTimeout: C{int}
+    @ivar idleTimeout: the number of seconds to keep idle connections open
+    @type cleanup_later: L{twisted.internet.interfaces.IDelayedCall}
+    @ivar cleanup_later: the delayed call to the next cleanup of the peers
+    @type scheduler: L{Scheduler.Scheduler}
+    @ivar scheduler: shares the requests to peers between the downloads
+    @type hedging: L{HedgePolicy}
+    @ivar hedging: decides when to also request slow pieces from the mirror
+    @type downloads: C{dictionary}
+    @ivar downloads: the active downloads from peers, keys are the hashes
+        of the files being downloaded
+    @type limiters: C{dictionary}
+    @ivar limiters: the download rate limits, keys are 'total', 'peer' and
+        'mirror' (missing if there is no limit)
     """
 
     def __init__(self, cache_dir, dht, stats):
@@ -504,8 +1525,23 @@ class PeerManager:
         self.dht = dht
         self.stats = stats
         self.clients = {}
+        self.downloads = {}
+        self.summaries = shelve.open(self.cache_dir.child('peers.db').path)
+        self.maxClients = MAX_CLIENTS
+        self.targetConnections = config.getint('DEFAULT', 'TARGET_CONNECTIONS')
+        self.idleTimeout = config.gettime('DEFAULT', 'CONNECTION_IDLE')
+        self.cleanup_later = reactor.callLater(self.idleTimeout, self._periodicCleanup)
+        self.scheduler = Scheduler(config.getint('DEFAULT', 'MAX_TOTAL_REQUESTS'))
+        self.hedging = HedgePolicy(config.getint('DEFAULT', 'HEDGE_PERCENTILE'),
+                                   config.getint('DEFAULT', 'HEDGE_PERCENT'))
+        self.limiters = {}
+        for name, option in (('total', 'DOWNLOAD_LIMIT'), ('peer', 'PEER_DOWNLOAD_LIMIT'),
+                             ('mirror', 'MIRROR_DOWNLOAD_LIMIT')):
+            if config.getint('DEFAULT', option) > 0:
+                self.limiters[name] = RateLimiter(config.getint('DEFAULT', option)*1024)
+        self.removeStale()
         
-    def get(self, hash, mirror, peers = [], method="GET", modtime=None):
+    def get(self, hash, mirror, peers = [], method="GET", modtime=None, client=None):
         """Download from a list of peers or fallback to a mirror.
         
         @type hash: L{Hash.HashObject}
@@ -521,7 +1557,10 @@ class PeerManager:
         @param modtime: the modification time to use for an 'If-Modified-Since'
             header, as seconds since the epoch
             (optional, defaults to not sending that header)
+        @param client: the apt client that requested the file
+            (optional, defaults to an unknown client)
         """
+        peers = self._otherPeers(peers)
         if not peers or method != "GET" or modtime is not None:
             log.msg('Downloading (%s) from mirror %s' % (method, mirror))
             parsed = urlparse(mirror)
@@ -529,7 +1568,7 @@ class PeerManager:
             site = splitHostPort(parsed[0], parsed[1])
             path = urlunparse(('', '') + parsed[2:])
             peer = self.getPeer(site, mirror = True)
-            return peer.get(path, method, modtime)
+            return peer.get(path, method, modtime, downloadPriority(mirror, hash.expSize))
 #        elif len(peers) == 1:
 #            site = uncompact(peers[0]['c'])
 #            log.msg('Downloading from peer %r' % (site, ))
@@ -538,7 +1577,48 @@ class PeerManager:
 #            return peer.get(path)
         else:
             tmpfile = self.cache_dir.child(hash.hexexpected())
-            return FileDownload(self, hash, mirror, peers, tmpfile).run()
+            download = FileDownload(self, hash, mirror, peers, tmpfile, client)
+            self.downloads[hash.expected()] = download
+            return download.run()
+        
+    def addPeers(self, hash, peers):
+        """Add more peers to an active download, as they are found.
+        
+        @type hash: L{Hash.HashObject}
+        @param hash: the hash object containing the expected hash for the file
+        @type peers: C{list} of C{string}
+        @param peers: a list of the peer info of the new peers
+        @rtype: C{boolean}
+        @return: whether there was an active download to add them to
+        """
+        download = self.downloads.get(hash.expected(), None)
+        if download is None:
+            return False
+        download.addPeers(self._otherPeers(peers))
+        return True
+    
+    def _otherPeers(self, peers):
+        """Remove this peer's own values (e.g. of a partial download) from the peers."""
+        if self.dht is None or not getattr(self.dht, 'my_contact', None):
+            return peers
+        return [peer for peer in peers if peer.get('c') != self.dht.my_contact]
+    
+    def partialDownload(self, key):
+        """Find an active download that is sharing its verified pieces.
+        
+        @type key: C{string}
+        @param key: the expected hash of the file, or the hash of its piece
+            hashes
+        @rtype: L{FileDownload}
+        @return: the download, or None if there isn't one sharing the file
+        """
+        download = self.downloads.get(key, None)
+        if download is not None and download.sharing:
+            return download
+        for download in self.downloads.values():
+            if download.sharing and download.piecesKey == key:
+                return download
+        return None
         
     def getPeer(self, site, mirror = False):
         """Create a new peer if necessary and return it.
@@ -549,16 +1629,224 @@ class PeerManager:
             (optional, defaults to False)
         """
         if site not in self.clients:
-            self.clients[site] = Peer(site[0], site[1], self.stats)
+            self.clients[site] = Peer(site[0], site[1], self.stats, self)
             if mirror:
                 self.clients[site].mirror = True
+            self.clients[site].limiters = [limiter for limiter in
+                    (self.limiters.get('total'), self.limiters.get(mirror and 'mirror' or 'peer'))
+                    if limiter is not None]
+            key = '%s:%d' % site
+            if self.summaries.has_key(key):
+                saved, summary = self.summaries[key]
+                self.clients[site].setSummary(summary)
         return self.clients[site]
     
+    def _saveSummary(self, site):
+        """Save the performance of a peer, to restore it when it's used again."""
+        self.summaries['%s:%d' % site] = (time.time(), self.clients[site].summary())
+    
+    #{ Connection pool
+    def connecting(self, peer):
+        """Make room for a new connection to a peer.
+        
+        If there are too many open connections, the least recently used
+        idle ones are closed. Peers keep a single (pipelined) connection
+        open, so there is at most one connection to each peer. The target
+        is not a hard limit, if all the connections are busy the new one
+        is still opened, rather than delaying the requests.
+        
+        @type peer: L{HTTPDownloader.Peer}
+        @param peer: the peer that is about to connect
+        """
+        connected = [(p.lastActivity, p) for p in self.clients.values()
+                     if p is not peer and p.isConnected()]
+        if len(connected) < self.targetConnections:
+            return
+        
+        connected.sort()
+        for lastActivity, p in connected:
+            if len(connected) < self.targetConnections:
+                break
+            if p.isIdle() and not p.closed:
+                log.msg('Closing the least recently used connection to %r' % (p, ))
+                p.close()
+                connected.remove((lastActivity, p))
+        if len(connected) >= self.targetConnections:
+            log.msg('Opening a connection beyond the target, %d are busy' % len(connected))
+    
+    def _periodicCleanup(self):
+        """Cleanup the peers and schedule the next cleanup."""
+        self.cleanup_later = None
+        self.cleanup()
+        self.cleanup_later = reactor.callLater(self.idleTimeout, self._periodicCleanup)
+    
+    def cleanup(self):
+        """Close idle connections and forget the least recently used idle peers.
+        
+        Peers that are part of an active download are not forgotten, as the
+        download would keep using them. The saved performance of peers that
+        haven't been used for L{SUMMARY_EXPIRE} is removed.
+        """
+        idle_since = monotonic() - self.idleTimeout
+        in_use = {}
+        for download in self.downloads.values():
+            for site in download.peers:
+                in_use[site] = True
+        idle = []
+        for site, peer in self.clients.items():
+            if peer.isIdle() and peer.lastActivity < idle_since:
+                if not peer.closed:
+                    log.msg('Closing the idle connection to %r' % (peer, ))
+                    peer.close()
+                if site not in in_use:
+                    idle.append((peer.lastActivity, site))
+        
+        # Forget the least recently used peers, saving their performance
+        idle.sort()
+        while idle and len(self.clients) > self.maxClients:
+            lastActivity, site = idle.pop(0)
+            self._saveSummary(site)
+            del self.clients[site]
+        
+        expired = time.time() - SUMMARY_EXPIRE
+        for key in self.summaries.keys():
+            if self.summaries[key][0] < expired:
+                del self.summaries[key]
+        self.summaries.sync()
+        self.removeStale()
+    
+    def removeStale(self):
+        """Remove the partial downloads that haven't been resumed for a while.
+        
+        Downloads that fail keep their pieces (and saved state) to be resumed
+        later, these are removed after L{STALE_DOWNLOAD} seconds.
+        """
+        active = [b2a_hex(key) for key in self.downloads]
+        stale = time.time() - STALE_DOWNLOAD
+        for child in self.cache_dir.children():
+            name = child.basename()
+            if name.endswith('.pieces'):
+                name = name[:-7]
+            try:
+                a2b_hex(name)
+            except TypeError:
+                continue
+            if name in active:
+                continue
+            try:
+                if child.getModificationTime() < stale:
+                    log.msg('Removing the stale partial download %s' % child.path)
+                    child.remove()
+            except OSError, e:
+                log.msg('Failed to remove the stale partial download %s: %r' % (child.path, e))
+    
+    def uploadedRecently(self, host):
+        """Check whether a peer has recently uploaded to us.
+        
+        @type host: C{string}
+        @param host: the IP address of the peer
+        @rtype: C{boolean}
+        """
+        recently = monotonic() - RECIPROCATE_TIME
+        for site, peer in self.clients.items():
+            if (site[0] == host and not peer.mirror and peer.lastData is not None and
+                peer.lastData > recently):
+                return True
+        return False
+    
     def close(self):
-        """Close all the connections to peers."""
+        """Close all the connections to peers, and save their performance."""
+        if self.cleanup_later and self.cleanup_later.active():
+            self.cleanup_later.cancel()
+        self.cleanup_later = None
+        # Save the pieces verified since the downloads last saved them
+        for download in self.downloads.values():
+            if download.downloading:
+                download.saveState()
         for site in self.clients:
             self.clients[site].close()
+            self._saveSummary(site)
         self.clients = {}
+        self.summaries.close()
+        self.scheduler.close()
+        for limiter in self.limiters.values():
+            limiter.stop()
+
+class SimulatedPeer:
+    """A fake peer for testing that responds to requests after a delay.
+    
+    It counts the requests it is sent, the most data it had requested but
+    not yet sent at once, and the amount of data it sent and was requested.
+    """
+    
+    def __init__(self, data, delay, rank, pending_calls, speed = 150000.0,
+                 bandwidth = None):
+        self.data = data
+        self.delay = delay
+        self.bandwidth = bandwidth
+        self.rank = rank
+        self.speed = speed
+        self.requests = 0
+        self.outstanding = 0
+        self.maxOutstanding = 0
+        self.sent = 0
+        self.requested = 0
+        self.missing = 0
+        self.mirror = False
+        self.bitfield = None
+        self.pending_calls = pending_calls
+        
+    def _respond(self, code, data):
+        self.requests += 1
+        self.outstanding += len(data)
+        self.maxOutstanding = max(self.maxOutstanding, self.outstanding)
+        delay = self.delay
+        if self.bandwidth:
+            delay += float(len(data)) / self.bandwidth
+        d = defer.Deferred()
+        self.pending_calls.append(reactor.callLater(delay, self._responded, d, code, data))
+        return d
+    
+    def _responded(self, d, code, data):
+        self.outstanding -= len(data)
+        self.sent += len(data)
+        d.callback(Response(code, {}, data))
+        
+    def get(self, path, priority = 0):
+        if path.startswith('/~bitfield/'):
+            return self._respond(200, bencode({'b': self.bitfield}))
+        return self._respond(200, self.data)
+    
+    def getRange(self, path, rangeStart, rangeEnd, priority = 0):
+        self.requested += len(self.data[rangeStart:rangeEnd + 1])
+        if self.bitfield is not None:
+            for piece in xrange(rangeStart / PIECE_SIZE, rangeEnd / PIECE_SIZE + 1):
+                if self.bitfield[piece] != '1':
+                    self.missing += 1
+                    return self._respond(404, '')
+        return self._respond(206, self.data[rangeStart:rangeEnd + 1])
+    
+    def hashError(self, error):
+        pass
+    
+    def downloadSpeed(self):
+        return self.speed
+    
+    def responseTime(self):
+        return self.delay
+
+class SimulatedManager:
+    """A fake peer manager for testing that returns the simulated peers."""
+    
+    def __init__(self, peers, hedge = 0):
+        self.peers = peers
+        self.scheduler = Scheduler(16)
+        self.hedging = HedgePolicy(90, hedge)
+        self.downloads = {}
+        self.dht = None
+        
+    def getPeer(self, site, mirror = False):
+        return self.peers[site]
 
 class TestPeerManager(unittest.TestCase):
     """Unit tests for the PeerManager."""
@@ -566,6 +1854,439 @@ class TestPeerManager(unittest.TestCase):
     manager = None
     pending_calls = []
     
+    def simulateDownload(self, data, delays, speed = 150000.0, bandwidth = None,
+                         pieceInfo = True, mirrorDelay = None, hedge = 0, partial = {}):
+        """Download the data from simulated peers with the given delays.
+        
+        The first peer is ranked highest, so it gets the first piece. If a
+        mirror delay is given, the file is also available from a simulated
+        HTTP mirror. The peers in partial are still downloading the file,
+        and only have the pieces in their bitfields.
+        
+        @return: a deferred that fires with the time the download took
+        """
+        hash = HashObject()
+        hash.set(hash.ORDER[0], sha.new(data).hexdigest(), len(data))
+        pieces = ''.join([sha.new(data[x:x+PIECE_SIZE]).digest()
+                          for x in xrange(0, len(data), PIECE_SIZE)])
+        compact_peers = []
+        peers = {}
+        for i in xrange(len(delays)):
+            site = ('10.0.0.%d' % (i + 1), 9977)
+            peers[site] = SimulatedPeer(data, delays[i], 1.0 / (i + 1), self.pending_calls,
+                                        speed, bandwidth)
+            if pieceInfo:
+                compact_peers.append({'c': compact(site[0], site[1]), 't': {'t': pieces}})
+            else:
+                compact_peers.append({'c': compact(site[0], site[1])})
+            if i in partial:
+                peers[site].bitfield = partial[i]
+                compact_peers[-1]['p'] = 1
+        
+        mirror = 'ftp://mirror/'
+        if mirrorDelay is not None:
+            mirror = 'http://mirror/file'
+            peers[('mirror', 80)] = SimulatedPeer(data, mirrorDelay, 0.001, self.pending_calls, speed)
+            peers[('mirror', 80)].mirror = True
+        
+        self.peers = peers
+        tmpfile = FilePath('/tmp/.apt-p2p-test-download')
+        download = FileDownload(SimulatedManager(peers, hedge), hash, mirror, compact_peers, tmpfile)
+        self.download = download
+        start = time.time()
+        received = []
+        def gotResp(resp):
+            d = stream.readStream(resp.stream, received.append)
+            d.addCallback(checkData)
+            return d
+        def checkData(result):
+            self.failUnlessEqual(''.join(received), data)
+            return time.time() - start
+        d = download.run()
+        d.addCallback(gotResp)
+        return d
+    
+    def test_peer_windows(self):
+        """Tests pipelining requests to a fast peer with a long response time."""
+        data = os.urandom(8*PIECE_SIZE)
+        self.timeout = 30
+        
+        def checkRequests(result):
+            peer = self.peers[('10.0.0.1', 9977)]
+            self.failUnless(peer.maxOutstanding > PIECE_SIZE,
+                            "Only %d bytes were requested at once" % peer.maxOutstanding)
+            self.failUnless(peer.requests <= 8)
+        
+        d = self.simulateDownload(data, [0.2], 20*1024*1024)
+        d.addCallback(checkRequests)
+        return d
+    
+    def test_add_peers(self):
+        """Tests adding a fast peer found after the download has started."""
+        data = os.urandom(4*PIECE_SIZE)
+        self.timeout = 30
+        
+        def addPeer():
+            site = ('10.0.0.9', 9977)
+            self.peers[site] = SimulatedPeer(data, 0.05, 1.0, self.pending_calls)
+            self.download.addPeers([{'c': compact(site[0], site[1])}])
+        
+        def checkRequests(result):
+            late = self.peers[('10.0.0.9', 9977)]
+            slow = self.peers[('10.0.0.1', 9977)]
+            self.failUnless(late.requests > 0, "The late peer was not used")
+            self.failUnless(late.sent > slow.sent,
+                            "The late peer sent less than the slow one: %d" % late.sent)
+        
+        d = self.simulateDownload(data, [2.0])
+        self.pending_calls.append(reactor.callLater(0.5, addPeer))
+        d.addCallback(checkRequests)
+        return d
+    
+    def test_hedging(self):
+        """Tests requesting the first piece from the mirror when the peer is slow."""
+        data = os.urandom(60*1024)
+        self.timeout = 30
+        
+        def checkTime(result):
+            log.msg('Hedged download took %r' % result)
+            self.failUnless(result < 3.0)
+            self.failUnlessEqual(self.peers[('mirror', 80)].requests, 1)
+        
+        d = self.simulateDownload(data, [5.0, 5.0, 5.0], mirrorDelay = 0.1, hedge = 100)
+        d.addCallback(checkTime)
+        return d
+    
+    def test_hedging_blocks(self):
+        """Tests hedging the blocks of a small file that a slow peer is sending."""
+        data = os.urandom(400*1024)
+        self.timeout = 30
+        old_endgame = config.get('DEFAULT', 'ENDGAME')
+        config.set('DEFAULT', 'ENDGAME', 'no')
+        
+        def restore(result):
+            config.set('DEFAULT', 'ENDGAME', old_endgame)
+            return result
+        
+        def checkRequests(result):
+            self.failUnless(self.peers[('mirror', 80)].requests > 0,
+                            "The slow peer's blocks were not hedged")
+            self.failUnlessEqual(self.peers[('10.0.0.3', 9977)].sent, 0)
+        
+        d = defer.succeed(None)
+        d.addCallback(lambda result: self.simulateDownload(data, [0.01, 0.01, 5.0],
+                                                           pieceInfo = False, mirrorDelay = 0.05,
+                                                           hedge = 100))
+        d.addBoth(restore)
+        d.addCallback(checkRequests)
+        return d
+    
+    def test_coalesced_ranges(self):
+        """Tests requesting several pieces from a fast peer at once."""
+        data = os.urandom(6*PIECE_SIZE + 1000)
+        self.timeout = 30
+        
+        def checkRequests(result):
+            requests = sum([peer.requests for peer in self.peers.values()])
+            self.failUnless(requests < 7, "Expected fewer than one request per piece: %d" % requests)
+        
+        d = self.simulateDownload(data, [0.05, 0.05], 4*1024*1024)
+        d.addCallback(checkRequests)
+        return d
+    
+    def test_resume(self):
+        """Tests resuming a download from the pieces of a previous one."""
+        data = os.urandom(6*PIECE_SIZE + 1000)
+        self.timeout = 30
+        
+        # Save the first 4 pieces, with the last of them corrupted
+        tmpfile = FilePath('/tmp/.apt-p2p-test-download')
+        tmpfile.setContent(data[:3*PIECE_SIZE] + '\0' * PIECE_SIZE)
+        tmpfile.siblingExtension('.pieces').setContent('1111000')
+        
+        def checkRequests(result):
+            requests = sum([peer.requests for peer in self.peers.values()])
+            self.failUnlessEqual(requests, 4)
+            self.failIf(tmpfile.siblingExtension('.pieces').exists())
+        
+        d = self.simulateDownload(data, [0.01])
+        d.addCallback(checkRequests)
+        return d
+    
+    def test_partial_peers(self):
+        """Tests downloading the verified pieces of a peer still downloading the file."""
+        data = os.urandom(6*PIECE_SIZE + 1000)
+        self.timeout = 30
+        
+        def checkRequests(result):
+            partial = self.peers[('10.0.0.1', 9977)]
+            self.failUnless(partial.requests > 1, "No pieces were requested from the partial peer")
+            self.failUnlessEqual(partial.missing, 0)
+            self.failUnlessEqual(self.download.availability(0), 2)
+            self.failUnlessEqual(self.download.availability(6), 1)
+        
+        d = self.simulateDownload(data, [0.01, 0.5], partial = {0: '1110000'})
+        d.addCallback(checkRequests)
+        return d
+    
+    def test_blocks(self):
+        """Tests downloading the blocks of a small file from several peers."""
+        data = os.urandom(400*1024)
+        bandwidth = 1024*1024
+        self.timeout = 30
+        
+        def checkRequests(result):
+            used = [peer for peer in self.peers.values() if peer.requests]
+            self.failUnlessEqual(len(used), 3, "Only %d peers were used" % len(used))
+            for peer in used:
+                self.failUnless(peer.sent < len(data),
+                                "One peer sent all of the file: %d" % peer.sent)
+        
+        d = self.simulateDownload(data, [0.01, 0.01, 0.01], bandwidth = bandwidth,
+                                  pieceInfo = False)
+        d.addCallback(checkRequests)
+        return d
+    
+    def test_pool(self):
+        """Tests forgetting the least recently used peers, and restoring them."""
+        self.manager = PeerManager(FilePath('/tmp/.apt-p2p-test-peers'), None, None)
+        self.manager.maxClients = 2
+        sites = [('10.0.0.%d' % i, 9977) for i in xrange(1, 5)]
+        for i in xrange(len(sites)):
+            peer = self.manager.getPeer(sites[i])
+            peer.lastActivity = monotonic() - (10 - i)*86400
+        self.manager.getPeer(sites[0])._errors = 3
+        self.manager.getPeer(sites[0])._completed = 4
+        
+        self.manager.cleanup()
+        self.failUnlessEqual(len(self.manager.clients), 2)
+        self.failIf(sites[0] in self.manager.clients)
+        self.failIf(sites[1] in self.manager.clients)
+        
+        peer = self.manager.getPeer(sites[0])
+        self.failUnlessEqual(peer._errors, 3)
+        self.failUnlessEqual(peer._completed, 4)
+        
+        # The performance of peers not seen for a long time is forgotten
+        saved, summary = self.manager.summaries['%s:%d' % sites[1]]
+        self.manager.summaries['%s:%d' % sites[1]] = (saved - SUMMARY_EXPIRE - 1, summary)
+        self.manager.cleanup()
+        self.failIf(self.manager.summaries.has_key('%s:%d' % sites[1]))
+        self.failUnless(self.manager.summaries.has_key('%s:%d' % sites[0]))
+    
+    def test_pool_downloads(self):
+        """Tests keeping the peers used by active downloads in the pool."""
+        self.manager = PeerManager(FilePath('/tmp/.apt-p2p-test-peers'), None, None)
+        self.manager.maxClients = 2
+        sites = [('10.0.0.%d' % i, 9977) for i in xrange(1, 5)]
+        for i in xrange(len(sites)):
+            peer = self.manager.getPeer(sites[i])
+            peer.lastActivity = monotonic() - (10 - i)*86400
+        class Download:
+            peers = {sites[0]: {'peer': self.manager.getPeer(sites[0])}}
+        self.manager.downloads['hash'] = Download()
+        
+        self.manager.cleanup()
+        self.failUnlessEqual(len(self.manager.clients), 2)
+        self.failUnless(sites[0] in self.manager.clients)
+        self.failIf(sites[1] in self.manager.clients)
+        self.failIf(sites[2] in self.manager.clients)
+        del self.manager.downloads['hash']
+    
+    def test_write_error(self):
+        """Tests failing the download without blaming the peers when writing fails."""
+        data = os.urandom(8*PIECE_SIZE)
+        self.timeout = 30
+        
+        def failWrite(fd, batch):
+            raise IOError(28, 'No space left on device')
+        
+        def waitForPeers(result):
+            # Let the requests still outstanding finish
+            d = defer.Deferred()
+            self.pending_calls.append(reactor.callLater(1.0, d.callback, None))
+            return d
+        
+        def checkPeers(result):
+            self.flushLoggedErrors(IOError)
+            self.failUnless(self.download.writer.closed)
+            for site in self.download.peers:
+                self.failIf(self.download.peers[site].get('errors', 0),
+                            "Peer %r was blamed for the write error" % (site, ))
+            self.failIf(('mirror', 80) in self.peers and self.peers[('mirror', 80)].requests)
+        
+        d = self.simulateDownload(data, [0.1, 0.1, 0.1], mirrorDelay = 0.1)
+        self.download.writer._write = failWrite
+        d.addBoth(waitForPeers)
+        d.addCallback(checkPeers)
+        return d
+    
+    def test_uploaded_recently(self):
+        """Tests preferring the peers that recently sent us data."""
+        self.manager = PeerManager(FilePath('/tmp/.apt-p2p-test-peers'), None, None)
+        peer = self.manager.getPeer(('10.0.0.1', 9977))
+        mirror = self.manager.getPeer(('10.0.0.2', 80), mirror = True)
+        self.failIf(self.manager.uploadedRecently('10.0.0.1'))
+        
+        peer.lastData = monotonic() - RECIPROCATE_TIME - 1
+        self.failIf(self.manager.uploadedRecently('10.0.0.1'))
+        peer.lastData = monotonic()
+        self.failUnless(self.manager.uploadedRecently('10.0.0.1'))
+        mirror.lastData = monotonic()
+        self.failIf(self.manager.uploadedRecently('10.0.0.2'))
+    
+    def test_partial_download(self):
+        """Tests finding a shared download by its hash or its piece hashes."""
+        class Download:
+            sharing = True
+            piecesKey = 'p' * 20
+        self.manager = PeerManager(FilePath('/tmp/.apt-p2p-test-peers'), None, None)
+        download = Download()
+        self.manager.downloads['f' * 20] = download
+        self.failUnless(self.manager.partialDownload('f' * 20) is download)
+        self.failUnless(self.manager.partialDownload('p' * 20) is download)
+        self.failUnless(self.manager.partialDownload('x' * 20) is None)
+        download.sharing = False
+        self.failUnless(self.manager.partialDownload('p' * 20) is None)
+        del self.manager.downloads['f' * 20]
+    
+    def test_close(self):
+        """Tests saving the state of the active downloads when closing."""
+        class Download:
+            def __init__(self, downloading):
+                self.downloading = downloading
+                self.saved = False
+            def saveState(self):
+                self.saved = True
+        manager = PeerManager(FilePath('/tmp/.apt-p2p-test-peers'), None, None)
+        manager.downloads = {'a' * 20: Download(True), 'b' * 20: Download(False)}
+        manager.close()
+        self.failUnless(manager.downloads['a' * 20].saved)
+        self.failIf(manager.downloads['b' * 20].saved)
+    
+    def test_own_peers(self):
+        """Tests ignoring this peer's own values found in the DHT."""
+        class DHT:
+            my_contact = compact('10.0.0.1', 9977)
+        self.manager = PeerManager(FilePath('/tmp/.apt-p2p-test-peers'), DHT(), None)
+        peers = [{'c': compact('10.0.0.1', 9977), 'p': 1}, {'c': compact('10.0.0.2', 9977)}]
+        self.failUnlessEqual(self.manager._otherPeers(peers), peers[1:])
+        self.failUnlessEqual(self.manager._otherPeers(peers[:1]), [])
+    
+    def test_stale_downloads(self):
+        """Tests removing the old partial downloads that weren't resumed."""
+        cache_dir = FilePath('/tmp/.apt-p2p-test-peers')
+        cache_dir.restat(False)
+        if cache_dir.exists():
+            cache_dir.remove()
+        cache_dir.makedirs()
+        old = cache_dir.child('0123456789abcdef0123456789abcdef01234567')
+        new = cache_dir.child('89abcdef0123456789abcdef0123456789abcdef')
+        for f in (old, old.siblingExtension('.pieces'), new, new.siblingExtension('.pieces')):
+            f.setContent('data')
+        for f in (old, old.siblingExtension('.pieces')):
+            os.utime(f.path, (time.time() - STALE_DOWNLOAD - 60, time.time() - STALE_DOWNLOAD - 60))
+        
+        self.manager = PeerManager(cache_dir, None, None)
+        for f in (old, old.siblingExtension('.pieces'), new, new.siblingExtension('.pieces')):
+            f.restat(False)
+        self.failIf(old.exists())
+        self.failIf(old.siblingExtension('.pieces').exists())
+        self.failUnless(new.exists())
+        self.failUnless(new.siblingExtension('.pieces').exists())
+    
+    def test_scheduling_overhead(self):
+        """Benchmarks choosing peers to send requests to from 200 peers."""
+        peers = {}
+        for i in xrange(200):
+            site = ('10.0.%d.%d' % (i / 250, i % 250 + 1), 9977)
+            peer = Peer(site[0], site[1])
+            peer._downloadSpeed.add(random() * 1000000.0)
+            peer._responseTime.add(random())
+            peer.rerank()
+            peers[site] = {'peer': peer}
+        sitelist = PeerQueue(peers, peers.keys())
+        
+        passes = 1000
+        start = time.time()
+        for i in xrange(passes):
+            # Some responses arrive, then a scheduling pass sends 8 requests
+            for site in peers.keys()[i % 20::20]:
+                peer = peers[site]['peer']
+                peer._responseTime.add(random())
+                peer.rerank()
+            sitelist.rerank()
+            chosen = []
+            for j in xrange(8):
+                chosen.append(sitelist.best())
+                sitelist.demote(chosen[-1])
+            
+            # Each request goes to a different peer
+            self.failUnlessEqual(len(dict.fromkeys(chosen)), 8)
+        elapsed = time.time() - start
+        log.msg('Scheduling overhead with 200 peers: %0.1f us per pass' % (elapsed * 1000000.0 / passes))
+        self.failUnlessEqual(len(sitelist), 200)
+        
+        # The peers are chosen in order of their rank
+        sitelist.rerank()
+        best = max([(peers[site]['peer'].rank, site) for site in peers])[1]
+        ranks = []
+        while sitelist:
+            ranks.append(peers[sitelist.pop()]['peer'].rank)
+        self.failUnlessEqual(len(ranks), 200)
+        self.failUnlessEqual(ranks[0], peers[best]['peer'].rank)
+        self.failUnlessEqual(ranks, sorted(ranks, reverse = True))
+    
+    def test_piece_pickers(self):
+        """Tests the order the piece pickers pick in, and duplicating requests in the endgame."""
+        class Download:
+            nextFinish = 1
+            completePieces = [True] + [False] * 6
+            def availability(self, piece):
+                return [0, 9, 9, 3, 1, 2, 5][piece]
+        download = Download()
+        self.failUnlessEqual(StreamingPicker(download, 2).order(), [1, 2, 3, 4, 5, 6])
+        self.failUnlessEqual(RarestFirstPicker(download, 2).order(), [1, 2, 4, 5, 3, 6])
+        
+        data = os.urandom(5*PIECE_SIZE + PIECE_SIZE/2)
+        delays = [1.0, 0.01, 0.02, 0.05]
+        times = {}
+        duplicated = {}
+        old_settings = (config.get('DEFAULT', 'PIECE_PICKER'), config.get('DEFAULT', 'ENDGAME'))
+        
+        def runPicker(result, picker, endgame):
+            config.set('DEFAULT', 'PIECE_PICKER', picker)
+            config.set('DEFAULT', 'ENDGAME', endgame)
+            d = self.simulateDownload(data, delays)
+            d.addCallback(done, picker + '/' + endgame)
+            return d
+        
+        def done(result, name):
+            times[name] = result
+            duplicated[name] = sum([peer.requested for peer in self.peers.values()]) - len(data)
+        
+        def restore(result):
+            config.set('DEFAULT', 'PIECE_PICKER', old_settings[0])
+            config.set('DEFAULT', 'ENDGAME', old_settings[1])
+            return result
+        
+        def check(result):
+            log.msg('Simulated download times: %r' % times)
+            log.msg('Duplicated bytes requested: %r' % duplicated)
+            self.failUnlessEqual(duplicated['streaming/no'], 0)
+            # The slow peer's piece is also requested from a fast one
+            self.failUnless(duplicated['streaming/yes'] > 0)
+            self.failUnless(duplicated['rarest/yes'] > 0)
+        
+        self.timeout = 30
+        d = defer.succeed(None)
+        d.addCallback(runPicker, 'streaming', 'no')
+        d.addCallback(runPicker, 'streaming', 'yes')
+        d.addCallback(runPicker, 'rarest', 'yes')
+        d.addBoth(restore)
+        d.addCallback(check)
+        return d
+    
     def tearDown(self):
         for p in self.pending_calls:
             if p.active():
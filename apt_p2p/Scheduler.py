@@ -0,0 +1,249 @@
+
+"""Share the requests to peers between all the downloads.
+
+@type PRIORITY_INDEX: C{int}
+@var PRIORITY_INDEX: the priority of index files (and anything else that
+    isn't a package), the most urgent
+@type PRIORITY_SMALL: C{int}
+@var PRIORITY_SMALL: the priority of small packages
+@type PRIORITY_LARGE: C{int}
+@var PRIORITY_LARGE: the priority of large packages, the least urgent
+@type SMALL_PACKAGE: C{int}
+@var SMALL_PACKAGE: the largest size of a package that is considered small
+"""
+
+from twisted.internet import reactor
+from twisted.python import log
+from twisted.trial import unittest
+
+PRIORITY_INDEX = 0
+PRIORITY_SMALL = 1
+PRIORITY_LARGE = 2
+SMALL_PACKAGE = 1024*1024
+
+def downloadPriority(url, size = None):
+    """Determine the priority of a download.
+
+    Index files are needed by apt before it can do anything else, and
+    small packages can be finished quickly, so both of those are ahead of
+    large packages.
+
+    @type url: C{string}
+    @param url: the URI of the file on the mirror
+    @type size: C{int}
+    @param size: the expected size of the file (optional, defaults to unknown)
+    @rtype: C{int}
+    """
+    if not (url.endswith('.deb') or url.endswith('.udeb')):
+        return PRIORITY_INDEX
+    if size is not None and size >= 0 and size <= SMALL_PACKAGE:
+        return PRIORITY_SMALL
+    return PRIORITY_LARGE
+
+class Scheduler:
+    """Share the requests to peers between all the active downloads.
+
+    There is a limit on the number of requests outstanding to peers for all
+    the downloads together. Once it is reached, downloads that want to send
+    more requests wait their turn. When a request completes, the waiting
+    downloads with the highest priority are given the freed requests first,
+    and downloads of the same priority take turns between the apt clients
+    that requested them.
+
+    Downloads must have a C{priority}, a C{client}, and a C{getPieces}
+    method that is called when it is their turn to send more requests.
+
+    @type maxRequests: C{int}
+    @ivar maxRequests: the maximum number of requests to have outstanding
+        for all the downloads together
+    @type outstanding: C{int}
+    @ivar outstanding: the number of requests currently outstanding
+    @type waiting: C{dictionary}
+    @ivar waiting: the downloads waiting to send requests, keys are the
+        priorities, values are lists of (client, list of downloads) in the
+        order the clients take turns in
+    @type wake_later: L{twisted.internet.interfaces.IDelayedCall}
+    @ivar wake_later: the delayed call to wake up the waiting downloads
+    @ivar woken: the download that has been woken up and is taking its turn
+    """
+
+    def __init__(self, maxRequests):
+        self.maxRequests = maxRequests
+        self.outstanding = 0
+        self.waiting = {}
+        self.wake_later = None
+        self.woken = None
+
+    def acquire(self, download):
+        """Try to get a request to send for a download.
+
+        @param download: the download that wants to send a request
+        @rtype: C{boolean}
+        @return: whether the request can be sent now, if not the download
+            will be woken up when it's its turn
+        """
+        if self.outstanding < self.maxRequests and (download is self.woken or
+                                                    not self._waitingAhead(download)):
+            self.outstanding += 1
+            return True
+
+        self._wait(download)
+        if self.outstanding < self.maxRequests:
+            self._scheduleWake()
+        return False
+
+    def release(self, download):
+        """A request of a download has completed."""
+        self.outstanding -= 1
+        assert self.outstanding >= 0
+        if self.waiting:
+            self._scheduleWake()
+
+    def remove(self, download):
+        """Stop a (complete or failed) download from waiting for requests."""
+        for priority in self.waiting.keys():
+            clients = self.waiting[priority]
+            for client, downloads in clients[:]:
+                if download in downloads:
+                    downloads.remove(download)
+                    if not downloads:
+                        clients.remove((client, downloads))
+            if not clients:
+                del self.waiting[priority]
+
+    def close(self):
+        """Stop waking up the waiting downloads."""
+        if self.wake_later and self.wake_later.active():
+            self.wake_later.cancel()
+        self.wake_later = None
+        self.waiting = {}
+
+    #{ Waiting downloads
+    def _waitingAhead(self, download):
+        """Check if another download should get the next request first."""
+        for priority, clients in self.waiting.items():
+            if priority < download.priority:
+                return True
+            if priority == download.priority:
+                for client, downloads in clients:
+                    if client != download.client:
+                        return True
+        return False
+
+    def _wait(self, download):
+        """Add a download to the end of its client's queue of waiting downloads."""
+        clients = self.waiting.setdefault(download.priority, [])
+        for client, downloads in clients:
+            if client == download.client:
+                if download not in downloads:
+                    downloads.append(download)
+                return
+        clients.append((download.client, [download]))
+
+    def _next(self):
+        """Remove and return the next waiting download to get requests."""
+        priority = min(self.waiting.keys())
+        clients = self.waiting[priority]
+        client, downloads = clients.pop(0)
+        download = downloads.pop(0)
+        if downloads:
+            # Let the other clients have a turn first
+            clients.append((client, downloads))
+        if not clients:
+            del self.waiting[priority]
+        return download
+
+    def _scheduleWake(self):
+        """Wake up the waiting downloads after the current processing is done."""
+        if self.wake_later is None or not self.wake_later.active():
+            self.wake_later = reactor.callLater(0, self._wake)
+
+    def _wake(self):
+        """Give the free requests to the waiting downloads in turn."""
+        if self.wake_later and self.wake_later.active():
+            self.wake_later.cancel()
+        self.wake_later = None
+        woken = []
+        while self.waiting and self.outstanding < self.maxRequests:
+            download = self._next()
+            if download in woken:
+                # It's still waiting after using all that it could
+                self._wait(download)
+                break
+            woken.append(download)
+            self.woken = download
+            try:
+                download.getPieces()
+            finally:
+                self.woken = None
+
+class TestScheduler(unittest.TestCase):
+    """Unit tests for the download scheduler."""
+
+    class Download:
+        """A fake download that sends requests whenever it can."""
+
+        def __init__(self, scheduler, name, priority, client, wanted, sent):
+            self.scheduler = scheduler
+            self.name = name
+            self.priority = priority
+            self.client = client
+            self.wanted = wanted
+            self.sent = sent
+
+        def getPieces(self):
+            while self.wanted > 0 and self.scheduler.acquire(self):
+                self.wanted -= 1
+                self.sent.append(self.name)
+
+    scheduler = None
+
+    def test_priority(self):
+        """Tests that requests go to the most urgent downloads first."""
+        self.scheduler = Scheduler(2)
+        sent = []
+        large = self.Download(self.scheduler, 'large', PRIORITY_LARGE, 1, 4, sent)
+        large.getPieces()
+        self.failUnlessEqual(sent, ['large', 'large'])
+
+        index = self.Download(self.scheduler, 'index', PRIORITY_INDEX, 1, 2, sent)
+        small = self.Download(self.scheduler, 'small', PRIORITY_SMALL, 1, 1, sent)
+        small.getPieces()
+        index.getPieces()
+
+        for i in xrange(5):
+            self.scheduler.release(None)
+            self.scheduler._wake()
+        self.failUnlessEqual(sent, ['large', 'large', 'index', 'index', 'small', 'large', 'large'])
+
+    def test_fairness(self):
+        """Tests that downloads of the same priority take turns between clients."""
+        self.scheduler = Scheduler(1)
+        sent = []
+        a1 = self.Download(self.scheduler, 'a1', PRIORITY_SMALL, 'a', 2, sent)
+        a2 = self.Download(self.scheduler, 'a2', PRIORITY_SMALL, 'a', 2, sent)
+        b = self.Download(self.scheduler, 'b', PRIORITY_SMALL, 'b', 2, sent)
+        a1.getPieces()
+        a2.getPieces()
+        b.getPieces()
+
+        for i in xrange(5):
+            self.scheduler.release(None)
+            self.scheduler._wake()
+        self.failUnlessEqual(sent, ['a1', 'a1', 'b', 'a2', 'b', 'a2'])
+
+    def test_downloadPriority(self):
+        """Tests determining the priority of files."""
+        self.failUnlessEqual(downloadPriority('http://mirror/debian/dists/sid/main/binary-i386/Packages.bz2'),
+                             PRIORITY_INDEX)
+        self.failUnlessEqual(downloadPriority('http://mirror/debian/pool/main/a/apt/apt_0.7_i386.deb', 500000),
+                             PRIORITY_SMALL)
+        self.failUnlessEqual(downloadPriority('http://mirror/debian/pool/main/a/apt/apt-dbg_0.7_i386.deb', 50000000),
+                             PRIORITY_LARGE)
+        self.failUnlessEqual(downloadPriority('http://mirror/debian/pool/main/a/apt/apt_0.7_i386.deb'),
+                             PRIORITY_LARGE)
+
+    def tearDown(self):
+        if self.scheduler:
+            self.scheduler.close()
+            self.scheduler = None
@@ -1,86 +1,242 @@
 
-"""Modified streams that are used by Apt-P2P."""
+"""Modified streams that are used by Apt-P2P.
+
+@type UNTHROTTLED_CHUNK_SIZE: C{int}
+@var UNTHROTTLED_CHUNK_SIZE: the size of chunks of data to send at a time
+    when uploads are not throttled
+"""
 
 from bz2 import BZ2Decompressor
 from zlib import decompressobj, MAX_WBITS
 from gzip import FCOMMENT, FEXTRA, FHCRC, FNAME, FTEXT
-import os
+from functools import partial
+import mmap, os, time
 
 from twisted.web2 import stream
-from twisted.internet import defer
-from twisted.python import log, filepath
+from twisted.internet import defer, reactor
+from twisted.python import log, filepath, failure
+from twisted.trial import unittest
+
+from util import adviseSequential
+
+UNTHROTTLED_CHUNK_SIZE = 256*1024
 
 class StreamsError(Exception):
     """An error occurred in the streaming."""
 
+class GrowingFileMap:
+    """A memory map of a file that is still being written.
+    
+    The map is extended as more of the file becomes available, and is shared
+    by all the streams reading the file, so however many streams there are
+    the data is only read from the disk once, and without seeking in the
+    file that is being written.
+    
+    @type f: C{file}
+    @ivar f: the file being written
+    @type map: L{mmap.mmap}
+    @ivar map: the current map of the file, or None if none of it is mapped
+    @type size: C{int}
+    @ivar size: the number of bytes of the file that are mapped
+    """
+    
+    def __init__(self, f):
+        """Initialize the map.
+        
+        @type f: C{file}
+        @param f: the file being written
+        """
+        self.f = f
+        self.map = None
+        self.size = 0L
+    
+    def read(self, start, length, available):
+        """Read some of the data that is available from the file.
+        
+        @type start: C{int}
+        @param start: the position in the file to read from
+        @type length: C{int}
+        @param length: the amount of data to read
+        @type available: C{int}
+        @param available: the number of bytes at the start of the file that
+            have been written to it
+        @rtype: C{string}
+        @return: the data, which may be shorter than the length requested
+            if less of the file is available
+        """
+        if start + length > self.size:
+            self.extend(available)
+        if self.map is None:
+            return ''
+        return self.map[start:start + length]
+    
+    def extend(self, available):
+        """Map more of the file, if it is still open.
+        
+        @type available: C{int}
+        @param available: the number of bytes at the start of the file that
+            have been written to it
+        """
+        if self.f is None or self.f.closed or available <= self.size:
+            return
+        
+        # The written data may still be buffered in the file object
+        self.f.flush()
+        size = min(available, os.fstat(self.f.fileno()).st_size)
+        if size <= self.size:
+            return
+        
+        newMap = mmap.mmap(self.f.fileno(), size, access = mmap.ACCESS_READ)
+        if self.map is not None:
+            self.map.close()
+        self.map = newMap
+        self.size = size
+        
 class GrowingFileStream(stream.SimpleStream):
     """Modified to stream data from a file as it becomes available.
     
+    The data is read from a memory map of the file. Other streams of (parts
+    of) the same file can be opened with L{reader}, they share the map, but
+    each reads from its own position and is told of the data as it becomes
+    available. This is also how the stream is split, so that ranges of the
+    file can be sent before all of it is available.
+    
     @ivar CHUNK_SIZE: the maximum size of chunks of data to send at a time
+    @ivar f: the open file, if this stream is the one to close it
+    @type fileMap: L{GrowingFileMap}
+    @ivar fileMap: the map of the file to read from, or None once the stream
+        is closed
     @ivar deferred: waiting for the result of the last read attempt
     @ivar available: the number of bytes that are currently available to read
     @ivar position: the current position in the file where the next read will begin
+    @ivar end: the position in the file to stop reading at, or None to
+        read until no more data will be coming available
     @ivar closed: True if the reader has closed the stream
     @ivar finished: True when no more data will be coming available
     @ivar remove: whether to remove the file when streaming is complete
+    @type readers: C{list} of L{GrowingFileStream}
+    @ivar readers: the other streams of the file that are waiting for more
+        data to become available
     """
 
     CHUNK_SIZE = 32*1024
 
-    def __init__(self, f, length = None):
+    def __init__(self, f, length = None, position = 0L, fileMap = None):
+        """Initialize the stream.
+        
+        @type f: C{file}
+        @param f: the open file to stream, which will be closed when the
+            streaming is complete
+        @type length: C{int}
+        @param length: the amount of data to stream (optional, defaults to
+            streaming until no more data will be coming available)
+        @type position: C{int}
+        @param position: the position in the file to start streaming from
+            (optional, defaults to the start of the file)
+        @type fileMap: L{GrowingFileMap}
+        @param fileMap: the map of the file to read from, in which case the
+            file is left for another stream to close (optional, defaults to
+            mapping the file)
+        """
         self.f = f
+        if fileMap is None:
+            fileMap = GrowingFileMap(f)
+        self.fileMap = fileMap
         self.length = length
         self.deferred = None
         self.available = 0L
-        self.position = 0L
+        self.position = position
+        self.end = None
+        if length is not None:
+            self.end = position + length
         self.closed = False
         self.finished = False
         self.remove = False
+        self.readers = []
 
     #{ Stream interface
     def read(self, sendfile=False):
         assert not self.deferred, "A previous read is still deferred."
 
-        if self.f is None:
+        if self.fileMap is None:
             return None
 
-        length = self.available - self.position
-        readSize = min(length, self.CHUNK_SIZE)
-
-        # If we don't have any available, we're done or deferred
-        if readSize <= 0:
-            if self.finished:
-                self._close()
-                return None
-            else:
-                self.deferred = defer.Deferred()
-                return self.deferred
+        if self.end is not None and self.position >= self.end:
+            # All of this part of the file has been read
+            self._close()
+            return None
 
-        # Try to read some data from the file
-        self.f.seek(self.position)
-        b = self.f.read(readSize)
-        bytesRead = len(b)
-        if not bytesRead:
-            # End of file was reached, we're done or deferred
+        b = self._read()
+        if not b:
+            # No more data is available yet, we're done or deferred
             if self.finished:
                 self._close()
                 return None
             else:
                 self.deferred = defer.Deferred()
                 return self.deferred
-        else:
-            self.position += bytesRead
-            return b
+        return b
     
     def split(self, point):
-        raise StreamsError, "You can not split a GrowingFileStream"
+        """Split the stream into new readers of the two parts of the file.
+        
+        The file is kept open until all the data is available, so that it
+        can still be written to while the parts are read.
+        """
+        if self.fileMap is None or self.deferred:
+            raise StreamsError, "You can not split a GrowingFileStream that is closed or being read"
+
+        rest = None
+        if self.end is not None:
+            rest = self.end - self.position - point
+        first = self.reader(self.position, point)
+        second = self.reader(self.position + point, rest)
+        self.detach()
+        return first, second
     
     def close(self):
+        if self.readers:
+            # The other readers still need the file
+            self.detach()
+            return
         self.length = 0
         self.closed = True
         self._close()
 
     #{ Growing functions
+    def reader(self, position = 0L, length = None):
+        """Open another stream of the file that reads it as it becomes available.
+        
+        @type position: C{int}
+        @param position: the position in the file to start reading from
+            (optional, defaults to the start of the file)
+        @type length: C{int}
+        @param length: the amount of data to read (optional, defaults to
+            reading until no more data will be coming available)
+        @rtype: L{GrowingFileStream}
+        """
+        if self.fileMap is None:
+            raise StreamsError, "The GrowingFileStream has been closed"
+
+        reader = GrowingFileStream(None, length, position, self.fileMap)
+        reader.available = self.available
+        if self.finished:
+            reader.finished = True
+        else:
+            self.readers.append(reader)
+        return reader
+
+    def detach(self):
+        """Stop reading the stream, leaving it to the other L{reader}s of the file.
+        
+        Unlike L{close}, the file is kept open until all the data is
+        available, as it may still be being written to.
+        """
+        self.length = 0
+        self.closed = True
+        if self.finished:
+            self._close()
+
     def updateAvailable(self, newlyAvailable):
         """Update the number of bytes that are available.
         
@@ -91,18 +247,17 @@ class GrowingFileStream(stream.SimpleStream):
         if not self.finished:
             self.available += newlyAvailable
         
+        # Let the other readers of the file know too
+        if self.readers:
+            self.readers = [reader for reader in self.readers
+                            if reader.fileMap is not None or reader.readers]
+            for reader in self.readers:
+                reader.updateAvailable(newlyAvailable)
+        
         # If a read is pending, let it go
-        if self.deferred and self.position < self.available:
-            # Try to read some data from the file
-            length = self.available - self.position
-            readSize = min(length, self.CHUNK_SIZE)
-            self.f.seek(self.position)
-            b = self.f.read(readSize)
-            bytesRead = len(b)
-            
-            # Check if end of file was reached
-            if bytesRead:
-                self.position += bytesRead
+        if self.deferred:
+            b = self._read()
+            if b:
                 deferred = self.deferred
                 self.deferred = None
                 deferred.callback(b)
@@ -114,41 +269,53 @@ class GrowingFileStream(stream.SimpleStream):
         """
         self.finished = True
         self.remove = remove
+        if self.f is not None and self.fileMap is not None:
+            # Map all of the file while it's still open
+            self.fileMap.extend(self.available)
+
+        # The other readers can finish, but only this stream removes the file
+        readers = self.readers
+        self.readers = []
+        for reader in readers:
+            reader.allAvailable()
 
         # If a read is pending, let it go
         if self.deferred:
-            if self.position < self.available:
-                # Try to read some data from the file
-                length = self.available - self.position
-                readSize = min(length, self.CHUNK_SIZE)
-                self.f.seek(self.position)
-                b = self.f.read(readSize)
-                bytesRead = len(b)
-    
-                # Check if end of file was reached
-                if bytesRead:
-                    self.position += bytesRead
-                    deferred = self.deferred
-                    self.deferred = None
-                    deferred.callback(b)
-                else:
-                    # We're done
-                    self._close()
-                    deferred = self.deferred
-                    self.deferred = None
-                    deferred.callback(None)
-            else:
+            b = self._read()
+            if not b:
                 # We're done
                 self._close()
-                deferred = self.deferred
-                self.deferred = None
-                deferred.callback(None)
+                b = None
+            deferred = self.deferred
+            self.deferred = None
+            deferred.callback(b)
                 
-        if self.closed:
+        if self.closed or self.fileMap is None:
+            # Already read to the end (or closed), so remove the file now
             self._close()
         
+    def _readable(self):
+        """Get the position in the file that data can currently be read up to."""
+        if self.end is not None:
+            return min(self.available, self.end)
+        return self.available
+
+    def _read(self):
+        """Read the next chunk of the available data from the map of the file."""
+        readSize = min(self._readable() - self.position, self.CHUNK_SIZE)
+        if readSize <= 0:
+            return ''
+        b = self.fileMap.read(self.position, readSize, self.available)
+        self.position += len(b)
+        return b
+        
     def _close(self):
-        """Close the temporary file and maybe remove it."""
+        """Stop reading, close the file and maybe remove it.
+        
+        The file is kept until it is removed, as the request to remove it
+        may come after it has been read to the end.
+        """
+        self.fileMap = None
         if self.f:
             self.f.close()
             if self.remove:
@@ -156,8 +323,9 @@ class GrowingFileStream(stream.SimpleStream):
                 file.restat(False)
                 if file.exists():
                     file.remove()
-            self.f = None
+                self.f = None
         
+
 class StreamToFile:
     """Save a stream to a partial file and hash it.
     
@@ -187,10 +355,15 @@ class StreamToFile:
     @ivar notify: a method that will be notified of the length of received data
     @type doneDefer: L{twisted.internet.defer.Deferred}
     @ivar doneDefer: the deferred that will fire when done writing
+    @type cancelled: C{boolean}
+    @ivar cancelled: whether the rest of the stream should be discarded
+    @type writer: L{DiskWriter.DiskWriter}
+    @ivar writer: the writer to write to the file with, or None to write to
+        the file directly
     """
     
     def __init__(self, hasher, inputStream, outFile, start = 0, length = None,
-                 notify = None, decompress = None, decFile = None):
+                 notify = None, decompress = None, decFile = None, writer = None):
         """Initializes the files.
         
         @type hasher: hashing object, e.g. C{sha1}
@@ -212,6 +385,10 @@ class StreamToFile:
             (currently only '.gz' and '.bz2' are supported)
         @type decFile: C{twisted.python.FilePath}
         @param decFile: the file to write the decompressed data to
+        @type writer: L{DiskWriter.DiskWriter}
+        @param writer: the writer to write to the file with, the received
+            data is only notified once it has been written (optional,
+            defaults to writing to the file directly)
         """
         self.stream = inputStream
         self.outFile = outFile
@@ -231,19 +408,67 @@ class StreamToFile:
             self.length = start + length
         self.notify = notify
         self.doneDefer = None
+        self.cancelled = False
+        self.writer = writer
         
     def run(self):
         """Start the streaming.
 
         @rtype: L{twisted.internet.defer.Deferred}
         """
-        self.doneDefer = stream.readStream(self.stream, self._gotData)
+        self.doneDefer = defer.Deferred()
+        self._read()
         self.doneDefer.addCallbacks(self._done, self._error)
         return self.doneDefer
 
+    def _read(self, result = None):
+        """Read the next data from the stream, unless the writer is full."""
+        if self.writer and self.writer.failure:
+            # Writing failed, so stop now
+            self.writer.flush().chainDeferred(self.doneDefer)
+            return
+        if self.writer and self.writer.isFull():
+            # Stop reading from the network until the disk catches up
+            self.writer.whenReady().addCallback(self._read)
+            return
+        
+        try:
+            data = self.stream.read()
+        except:
+            self.doneDefer.errback(failure.Failure())
+            return
+        if isinstance(data, defer.Deferred):
+            data.addCallbacks(self._gotRead, self.doneDefer.errback)
+        else:
+            self._gotRead(data)
+
+    def _gotRead(self, data):
+        """Process the data read from the stream, then read some more."""
+        if data is None:
+            if self.writer:
+                # Done once all the data is on the disk
+                self.writer.flush().chainDeferred(self.doneDefer)
+            else:
+                self.doneDefer.callback(None)
+            return
+        
+        try:
+            self._gotData(data)
+        except:
+            self.doneDefer.errback(failure.Failure())
+            return
+        reactor.callLater(0, self._read)
+
+    def cancel(self):
+        """Stop writing to the file, the rest of the stream will be discarded."""
+        self.cancelled = True
+
     def _gotData(self, data):
         """Process the received data."""
-        if self.outFile.closed:
+        if self.cancelled:
+            return
+        
+        if self.outFile.closed or (self.writer and self.writer.closed):
             raise StreamsError, "outFile was unexpectedly closed"
         
         # Make sure we don't go too far
@@ -251,8 +476,14 @@ class StreamToFile:
             data = data[:(self.length - self.position)]
         
         # Write and hash the streamed data
-        self.outFile.seek(self.position)
-        self.outFile.write(data)
+        if self.writer:
+            written = None
+            if self.notify:
+                written = partial(self.notify, len(data))
+            self.writer.write(self.position, data, written)
+        else:
+            self.outFile.seek(self.position)
+            self.outFile.write(data)
         self.hasher.update(data)
         self.position += len(data)
         
@@ -271,7 +502,7 @@ class StreamToFile:
             dec_data = self.bz2dec.decompress(data)
             self.bz2file.write(dec_data)
             
-        if self.notify:
+        if self.notify and not self.writer:
             self.notify(len(data))
 
     def _remove_gzip_header(self, data):
@@ -341,6 +572,72 @@ class StreamToFile:
         self._close()
         return err
     
+class PiecesStreamToFile(StreamToFile):
+    """Save a stream of several consecutive pieces to a file.
+    
+    Each piece is hashed separately, so they can be checked individually.
+    
+    @ivar newHasher: the method to call to get a hash object for a piece
+    @type pieceSize: C{int}
+    @ivar pieceSize: the size of the pieces
+    @type pieceEnd: C{int}
+    @ivar pieceEnd: the file position the current piece ends at
+    @type hashers: C{list} of hashing objects
+    @ivar hashers: the hash objects for the pieces, in order
+    @type skipped: C{list} of C{int}
+    @ivar skipped: the pieces (numbered from 0) that should not be written
+    """
+    
+    def __init__(self, newHasher, inputStream, outFile, start, length, pieceSize,
+                 writer = None):
+        """Initializes the files.
+        
+        @param newHasher: the method to call to get a hash object for a piece
+        @type pieceSize: C{int}
+        @param pieceSize: the size of the pieces
+        @see: L{StreamToFile.__init__}
+        """
+        StreamToFile.__init__(self, newHasher(), inputStream, outFile, start, length,
+                              writer = writer)
+        self.newHasher = newHasher
+        self.pieceSize = pieceSize
+        self.pieceEnd = start + pieceSize
+        self.hashers = [self.hasher]
+        self.skipped = []
+        
+    def cancelPiece(self, index):
+        """Stop writing one of the pieces to the file.
+        
+        @type index: C{int}
+        @param index: the piece to not write (numbered from 0)
+        """
+        self.skipped.append(index)
+
+    def _gotData(self, data):
+        """Split the received data into the pieces."""
+        if self.cancelled:
+            return
+        
+        while data and (self.length is None or self.position < self.length):
+            if self.position >= self.pieceEnd:
+                # Start the next piece
+                self.hasher = self.newHasher()
+                self.hashers.append(self.hasher)
+                self.pieceEnd += self.pieceSize
+            
+            piece_data = data[:self.pieceEnd - self.position]
+            data = data[len(piece_data):]
+            if len(self.hashers) - 1 in self.skipped:
+                self.hasher.update(piece_data)
+                self.position += len(piece_data)
+            else:
+                StreamToFile._gotData(self, piece_data)
+
+    def _done(self, result):
+        """Return the hash objects of the pieces."""
+        self._close()
+        return self.hashers
+    
 class UploadStream:
     """Identifier for streams that are uploaded to peers."""
     
@@ -351,14 +648,28 @@ class FileUploadStream(stream.FileStream, UploadStream):
     """Modified to make it suitable for streaming to peers.
     
     Streams the file in small chunks to make it easier to throttle the
-    streaming to peers.
+    streaming to peers. If the uploads are not being throttled, the file is
+    instead streamed in large (memory mapped) chunks, as the original
+    FileStream does.
     
     @ivar CHUNK_SIZE: the size of chunks of data to send at a time
+    @type throttle: C{boolean}
+    @ivar throttle: whether the upload will be throttled
     """
 
     CHUNK_SIZE = 4*1024
     
+    def __init__(self, f, start = 0, length = None, throttle = True):
+        stream.FileStream.__init__(self, f, start, length)
+        self.throttle = throttle
+        if not throttle:
+            self.CHUNK_SIZE = UNTHROTTLED_CHUNK_SIZE
+            adviseSequential(f, self.start, self.length)
+    
     def read(self, sendfile=False):
+        if not self.throttle:
+            return stream.FileStream.read(self, sendfile)
+        
         if self.f is None:
             return None
 
@@ -380,3 +691,149 @@ class FileUploadStream(stream.FileStream, UploadStream):
             self.length -= bytesRead
             self.start += bytesRead
             return b
+
+class TestFileUploadStream(unittest.TestCase):
+    """Unit tests for streaming files to peers."""
+    
+    length = 8*1024*1024
+    
+    def setUp(self):
+        self.file = filepath.FilePath(self.mktemp())
+        f = self.file.open('w')
+        for i in xrange(self.length / 1024):
+            f.write(chr(i % 256) * 1024)
+        f.close()
+    
+    def readAll(self, throttle):
+        """Read the whole file, returning the sizes of the chunks read.
+        
+        The CPU time used to read it is logged, as the rate one core can
+        upload at.
+        """
+        f = self.file.open()
+        start = time.clock()
+        upload = FileUploadStream(f, 0, self.length, throttle)
+        sizes = []
+        data = upload.read()
+        while data is not None:
+            sizes.append(len(data))
+            data = upload.read()
+        elapsed = max(time.clock() - start, 0.000001)
+        f.close()
+        log.msg('%s upload read %d bytes in %0.3f seconds of CPU, %0.1f MB/s per core' %
+                ((throttle and 'Throttled') or 'Unthrottled', self.length, elapsed,
+                 self.length / elapsed / 1024 / 1024))
+        self.failUnlessEqual(sum(sizes), self.length)
+        return sizes
+    
+    def test_unthrottled(self):
+        """Tests the sizes of the chunks streamed for throttled and unthrottled uploads."""
+        sizes = self.readAll(True)
+        fastSizes = self.readAll(False)
+        log.msg('Throttled uploads read %d chunks, unthrottled %d' % (len(sizes), len(fastSizes)))
+        self.failUnlessEqual(sizes, [FileUploadStream.CHUNK_SIZE] * (self.length / FileUploadStream.CHUNK_SIZE))
+        # Large enough reads may be memory mapped in even bigger chunks
+        self.failUnless(len(fastSizes) <= self.length / UNTHROTTLED_CHUNK_SIZE)
+        for size in fastSizes[:-1]:
+            self.failUnless(size >= UNTHROTTLED_CHUNK_SIZE,
+                            "Unthrottled upload read a small chunk: %d" % size)
+    
+    def test_split(self):
+        """Tests reading the data from part of a file unthrottled."""
+        f = self.file.open()
+        upload = FileUploadStream(f, 1000, 5000, False)
+        before, after = upload.split(1000)
+        before.close()
+        self.failUnlessEqual(after.read()[:], self.file.getContent()[2000:6000])
+        self.failUnlessEqual(after.read(), None)
+        f.close()
+
+class TestGrowingFileStream(unittest.TestCase):
+    """Unit tests for streaming files as they are downloaded."""
+    
+    def setUp(self):
+        self.file = filepath.FilePath(self.mktemp())
+        self.f = self.file.open('w+')
+        self.stream = GrowingFileStream(self.f, 100)
+    
+    def write(self, data):
+        """Write some data to the end of the file and make it available."""
+        self.f.seek(0, 2)
+        self.f.write(data)
+        self.f.flush()
+        self.stream.updateAvailable(len(data))
+    
+    def readAvailable(self, stream):
+        """Read all the data that is currently available from a stream.
+        
+        @return: the data read, and the deferred waiting for more data (or
+            None if the stream is done)
+        """
+        data = []
+        result = stream.read()
+        while isinstance(result, str):
+            data.append(result)
+            result = stream.read()
+        return ''.join(data), result
+    
+    def test_reader(self):
+        """Tests reading a file from the start while it is being downloaded."""
+        self.write('a' * 60)
+        reader = self.stream.reader(0, self.stream.length)
+        data, d = self.readAvailable(reader)
+        self.failUnlessEqual(data, 'a' * 60)
+        self.failUnless(isinstance(d, defer.Deferred))
+        results = []
+        d.addCallback(results.append)
+        self.write('b' * 40)
+        self.stream.allAvailable()
+        self.failUnlessEqual(results, ['b' * 40])
+        self.failUnlessEqual(self.readAvailable(reader), ('', None))
+    
+    def test_split(self):
+        """Tests reading ranges of a file before all of it is available."""
+        self.write('a' * 30)
+        first, rest = self.stream.split(20)
+        middle, last = rest.split(50)
+        last.close()
+        self.failUnlessEqual(self.readAvailable(first), ('a' * 20, None))
+        data, d = self.readAvailable(middle)
+        self.failUnlessEqual(data, 'a' * 10)
+        results = []
+        d.addCallback(results.append)
+        
+        # The range is complete before the rest of the file is
+        self.write('b' * 40)
+        self.failUnlessEqual(results, ['b' * 40])
+        self.failUnlessEqual(self.readAvailable(middle), ('', None))
+        
+        # The file is kept open for writing until it's all available
+        self.failIf(self.f.closed)
+        self.write('c' * 30)
+        self.stream.allAvailable()
+        self.failUnless(self.f.closed)
+    
+    def test_shared_map(self):
+        """Tests that many readers of a file all share one map of it."""
+        self.write('a' * 50)
+        readers = [self.stream.reader(i * 10, 10) for i in xrange(5)]
+        self.failUnlessEqual([reader.read() for reader in readers], ['a' * 10] * 5)
+        fileMap = self.stream.fileMap
+        self.failUnlessEqual(fileMap.size, 50)
+        
+        # All the readers waiting for more are woken by the new data
+        results = []
+        for i in xrange(3):
+            d = self.stream.reader(50, 50).read()
+            self.failUnless(isinstance(d, defer.Deferred))
+            d.addCallback(results.append)
+        mapped = fileMap.map
+        self.write('b' * 50)
+        self.failUnlessEqual(results, ['b' * 50] * 3)
+        self.failIf(fileMap.map is mapped)
+        self.failUnlessEqual(fileMap.size, 100)
+        for reader in self.stream.readers:
+            self.failUnless(reader.fileMap is fileMap)
+        
+    def tearDown(self):
+        self.stream.close()
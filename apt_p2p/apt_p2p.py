@@ -6,9 +6,10 @@
 """
 
 from urllib import unquote
+from datetime import datetime
 
 from twisted.internet import defer, reactor, protocol
-from twisted.web2 import static
+from twisted.web2 import static, http, responsecode
 from twisted.python import log, failure
 from twisted.python.filepath import FilePath
 
@@ -20,6 +21,8 @@ from MirrorManager import MirrorManager
 from CacheManager import CacheManager
 from Hash import HashObject
 from db import DB
+from HotCache import HotCache
+from Freshness import FreshnessPolicy
 from stats import StatsLogger
 
 download_dir = 'cache'
@@ -51,6 +54,13 @@ class AptP2P(protocol.Factory):
         can be queried to get hashes from file names
     @type cache: L{CacheManager.CacheManager}
     @ivar cache: the manager of all downloaded files
+    @type freshness: L{Freshness.FreshnessPolicy}
+    @ivar freshness: the policy for how long cached files without hashes
+        can be returned without checking them with the mirror
+    @type freshnessChecks: C{dictionary}
+    @ivar freshnessChecks: the requests waiting for the freshness check of
+        a file that is in progress, keys are the URLs of the files, values
+        are lists of (request, cached response, deferred)
     @type my_addr: C{string}, C{int}
     @ivar my_addr: the IP address and port of this peer
     """
@@ -76,7 +86,11 @@ class AptP2P(protocol.Factory):
             self.cache_dir.child(download_dir).makedirs()
         if not self.cache_dir.child(peer_dir).exists():
             self.cache_dir.child(peer_dir).makedirs()
-        self.db = DB(self.cache_dir.child('apt-p2p.db'))
+        fileCache = None
+        if config.getint('DEFAULT', 'HOT_CACHE_SIZE') > 0:
+            fileCache = HotCache(config.getint('DEFAULT', 'HOT_CACHE_SIZE')*1024,
+                                 config.getint('DEFAULT', 'HOT_CACHE_FILE_SIZE')*1024)
+        self.db = DB(self.cache_dir.child('apt-p2p.db'), fileCache)
         self.dht = DHT(self.dhtClass, self.db)
         df = self.dht.start()
         df.addCallback(self._dhtStarted)
@@ -85,6 +99,12 @@ class AptP2P(protocol.Factory):
         self.http_server.getHTTPFactory().startFactory()
         self.peers = PeerManager(self.cache_dir.child(peer_dir), self.dht, self.stats)
         self.mirrors = MirrorManager(self.cache_dir)
+        self.freshness = FreshnessPolicy(config.gettime('DEFAULT', 'FRESHNESS_TIME'))
+        self.freshnessChecks = {}
+        if config.get('DEFAULT', 'APT_LISTS_DIR'):
+            d = self.mirrors.importAptLists(FilePath(config.get('DEFAULT', 'APT_LISTS_DIR')),
+                                            config.getint('DEFAULT', 'PORT'))
+            d.addErrback(log.err)
         self.cache = CacheManager(self.cache_dir.child(download_dir), self.db, self)
     
     def _dhtStarted(self, result):
@@ -95,6 +115,7 @@ class AptP2P(protocol.Factory):
     def stopFactory(self):
         log.msg('Stoppping the main apt_p2p application')
         self.http_server.getHTTPFactory().stopFactory()
+        self.peers.close()
         self.mirrors.cleanup()
         self.stats.save()
         self.db.close()
@@ -132,6 +153,8 @@ class AptP2P(protocol.Factory):
         @return: a deferred that will be called back with the response
         """
         d = defer.Deferred()
+        if url.endswith('.deb') or url.endswith('.udeb'):
+            d.addCallback(self._package_response, url, datetime.now())
         
         log.msg('Trying to find hash for %s' % url)
         findDefer = self.mirrors.findHash(unquote(url))
@@ -141,6 +164,14 @@ class AptP2P(protocol.Factory):
                                errbackArgs=(req, url, orig_resp, d))
         return d
     
+    def _package_response(self, resp, url, started):
+        """Record how long it took to start sending a package to apt."""
+        elapsed = datetime.now() - started
+        seconds = elapsed.days*86400.0 + elapsed.seconds + elapsed.microseconds/1000000.0
+        log.msg('Started response to %s after %0.3f seconds' % (url, seconds))
+        self.stats.packageResponse(seconds)
+        return resp
+    
     def findHash_error(self, failure, req, url, orig_resp, d):
         """Process the error in hash lookup by returning an empty L{HashObject}."""
         log.msg('Hash lookup for %s resulted in an error: %s' %
@@ -174,50 +205,118 @@ class AptP2P(protocol.Factory):
     def check_freshness(self, req, url, orig_resp, d):
         """Send a HEAD to the mirror to check if the response from the cache is still valid.
         
+        The HEAD is skipped if the file is still fresh from the last check,
+        and only one check of a file is done at a time.
+        
         @type req: L{twisted.web2.http.Request}
         @param req: the initial request sent to the HTTP server by apt
         @param url: the URI of the actual mirror request
         @type orig_resp: L{twisted.web2.http.Response}
         @param orig_resp: the response from the cache to be sent to apt
         """
+        if self.freshness.isFresh(url):
+            log.msg('Still fresh without checking, returning: %s' % url)
+            d.callback(self.fresh_response(req, orig_resp))
+            return
+        
+        if url in self.freshnessChecks:
+            log.msg('Already checking if %s is still fresh' % url)
+            self.freshnessChecks[url].append((req, orig_resp, d))
+            return
+        
         log.msg('Checking if %s is still fresh' % url)
+        self.freshnessChecks[url] = [(req, orig_resp, d)]
         modtime = orig_resp.headers.getHeader('Last-Modified')
         headDefer = self.peers.get(HashObject(), url, method = "HEAD",
                                    modtime = modtime)
         headDefer.addCallbacks(self.check_freshness_done,
                                self.check_freshness_error,
-                               callbackArgs = (req, url, orig_resp, d),
-                               errbackArgs = (req, url, d))
+                               callbackArgs = (url, modtime),
+                               errbackArgs = (url, ))
     
-    def check_freshness_done(self, resp, req, url, orig_resp, d):
-        """Return the fresh response, if stale start to redownload.
+    def check_freshness_done(self, resp, url, modtime):
+        """Return the fresh responses, if stale start to redownload.
         
         @type resp: L{twisted.web2.http.Response}
         @param resp: the response from the mirror to the HEAD request
-        @type req: L{twisted.web2.http.Request}
-        @param req: the initial request sent to the HTTP server by apt
         @param url: the URI of the actual mirror request
-        @type orig_resp: L{twisted.web2.http.Response}
-        @param orig_resp: the response from the cache to be sent to apt
+        @type modtime: C{int}
+        @param modtime: the modification time of the cached file
         """
+        waiting = self.freshnessChecks.pop(url, [])
         if resp.code == 304:
             log.msg('Still fresh, returning: %s' % url)
-            d.callback(orig_resp)
+            self.freshness.validated(url, resp.headers, modtime)
+            for req, orig_resp, d in waiting:
+                d.callback(self.fresh_response(req, orig_resp))
         else:
             log.msg('Stale, need to redownload: %s' % url)
-            self.startDownload([], req, HashObject(), url, d)
+            self.freshness.expire(url)
+            self.redownload(url, waiting)
     
-    def check_freshness_error(self, err, req, url, d):
+    def check_freshness_error(self, err, url):
         """Mirror request failed, continue with download.
         
         @param err: the response from the mirror to the HEAD request
-        @type req: L{twisted.web2.http.Request}
-        @param req: the initial request sent to the HTTP server by apt
         @param url: the URI of the actual mirror request
         """
         log.err(err)
+        self.redownload(url, self.freshnessChecks.pop(url, []))
+    
+    def redownload(self, url, waiting):
+        """Download the file from the mirror for the requests that checked its freshness.
+        
+        Only the first request starts a download, the others are sent the
+        file as it is downloaded.
+        
+        @param url: the URI of the actual mirror request
+        @type waiting: C{list} of (L{twisted.web2.http.Request},
+            L{twisted.web2.http.Response}, L{twisted.internet.defer.Deferred})
+        @param waiting: the requests waiting for the file
+        """
+        if not waiting:
+            return
+        req, orig_resp, d = waiting[0]
+        if len(waiting) > 1:
+            first = defer.Deferred()
+            first.addBoth(self.redownload_started, url, waiting[1:])
+            first.chainDeferred(d)
+            d = first
         self.startDownload([], req, HashObject(), url, d)
     
+    def redownload_started(self, result, url, waiting):
+        """Send the other waiting requests the file being downloaded.
+        
+        If the download failed, or is already complete, the next request
+        tries again.
+        """
+        for i in xrange(len(waiting)):
+            resp = self.cache.get_downloading(url)
+            if resp is None:
+                self.redownload(url, waiting[i:])
+                break
+            log.msg('Streaming the file still being downloaded: %s' % url)
+            waiting[i][2].callback(resp)
+        return result
+    
+    def fresh_response(self, req, orig_resp):
+        """Answer apt with the fresh cached file, or that it is not modified.
+        
+        @type req: L{twisted.web2.http.Request}
+        @param req: the initial request sent to the HTTP server by apt
+        @type orig_resp: L{twisted.web2.http.Response}
+        @param orig_resp: the response from the cache to be sent to apt
+        """
+        modtime = orig_resp.headers.getHeader('Last-Modified')
+        since = req.headers.getHeader('If-Modified-Since')
+        if modtime is not None and since is not None and modtime <= since:
+            log.msg('Not modified since %r, returning 304: %s' % (since, req.uri))
+            if orig_resp.stream is not None:
+                orig_resp.stream.close()
+            return http.Response(responsecode.NOT_MODIFIED,
+                                 {'last-modified': modtime})
+        return orig_resp
+    
     def getCachedFile(self, hash, req, url, d, locations):
         """Try to return the file from the cache, otherwise move on to a DHT lookup.
         
@@ -260,11 +359,43 @@ class AptP2P(protocol.Factory):
             self.getCachedFile(hash, req, url, d, locations)
 
     def lookupHash(self, req, hash, url, d):
-        """Lookup the hash in the DHT."""
+        """Lookup the hash in the DHT.
+        
+        The download from peers is started as soon as the first ones are
+        found, and later ones are added to it as the lookup continues.
+        """
         log.msg('Looking up hash in DHT for file: %s' % url)
         key = hash.expected()
-        lookupDefer = self.dht.get(key)
-        lookupDefer.addBoth(self.startDownload, req, hash, url, d)
+        started = []
+        def foundValues(values, self = self, req = req, hash = hash, url = url,
+                        d = d, started = started):
+            self.foundValues(values, req, hash, url, d, started)
+        lookupDefer = self.dht.get(key, foundValues)
+        lookupDefer.addBoth(self.lookupHash_done, req, hash, url, d, started)
+
+    def foundValues(self, values, req, hash, url, d, started):
+        """Start or add to the download from peers with new values from the DHT.
+        
+        @type values: C{list} of C{dictionary}
+        @param values: the new values found in the DHT
+        @type started: C{list}
+        @param started: empty until the download has been started
+        """
+        if not values:
+            return
+        if not started:
+            started.append(True)
+            self.startDownload(values, req, hash, url, d)
+        else:
+            self.peers.addPeers(hash, values)
+
+    def lookupHash_done(self, values, req, hash, url, d, started):
+        """Start the download if the lookup didn't find any peers as it went."""
+        if not started:
+            started.append(True)
+            self.startDownload(values, req, hash, url, d)
+        elif not isinstance(values, list):
+            log.msg('DHT lookup for %s failed after finding peers: %r' % (url, values))
 
     def startDownload(self, values, req, hash, url, d):
         """Start the download of the file.
@@ -276,10 +407,9 @@ class AptP2P(protocol.Factory):
         @param values: the returned values from the DHT containing peer
             download information
         """
-        # Remove some headers Apt sets in the request
+        # Remove some headers Apt sets in the request (ranges of the
+        # downloaded file can be sent as it becomes available)
         req.headers.removeHeader('If-Modified-Since')
-        req.headers.removeHeader('Range')
-        req.headers.removeHeader('If-Range')
         
         if not isinstance(values, list) or not values:
             if not isinstance(values, list):
@@ -288,18 +418,27 @@ class AptP2P(protocol.Factory):
                 log.msg('Peers for %s were not found' % url)
             getDefer = self.peers.get(hash, url)
 #            getDefer.addErrback(self.final_fallback, hash, url)
+            if hash.expected() is None:
+                getDefer.addCallback(self.downloaded_fresh, url)
             getDefer.addCallback(self.cache.save_file, hash, url)
             getDefer.addErrback(self.cache.save_error, url)
             getDefer.addCallbacks(d.callback, d.errback)
         else:
             log.msg('Found peers for %s: %r' % (url, values))
             # Download from the found peers
-            getDefer = self.peers.get(hash, url, values)
+            client = (req.remoteAddr.host, req.remoteAddr.port)
+            getDefer = self.peers.get(hash, url, values, client = client)
             getDefer.addCallback(self.check_response, hash, url)
             getDefer.addCallback(self.cache.save_file, hash, url)
             getDefer.addErrback(self.cache.save_error, url)
             getDefer.addCallbacks(d.callback, d.errback)
             
+    def downloaded_fresh(self, response, url):
+        """Record the freshness of a file without a hash downloaded from the mirror."""
+        if response.code == 200:
+            self.freshness.validated(url, response.headers)
+        return response
+        
     def check_response(self, response, hash, url):
         """Check the response from peers, and download from the mirror if it is not."""
         if response.code < 200 or response.code >= 300:
@@ -341,6 +480,7 @@ class AptP2P(protocol.Factory):
         """
         if url:
             self.mirrors.updatedFile(url, file_path)
+            self.freshness.releaseFile(url, file_path)
         
         if self.my_addr and hash and new_hash and (hash.expected() is not None or forceDHT):
             return self.dht.store(hash)
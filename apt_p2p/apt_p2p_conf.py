@@ -55,6 +55,39 @@ DEFAULTS = {
     # The rate to limit sending data to peers to, in KBytes/sec.
     # Set this to 0 to not limit the upload bandwidth.
     'UPLOAD_LIMIT': '0',
+    
+    # The amount of memory to use to keep small files that are served often
+    # to apt and peers, in KBytes. Set this to 0 to not keep any.
+    'HOT_CACHE_SIZE': '16384',
+    
+    # The size of the largest file to keep in memory, in KBytes.
+    'HOT_CACHE_FILE_SIZE': '512',
+    
+    # The amount of data that can be sent to peers at once when the upload
+    # bandwidth is limited, in KBytes. Set this to 0 to use a tenth of a
+    # second of uploading at the limit.
+    'UPLOAD_BURST': '0',
+    
+    # The number of uploads to peers to send at once. Peers waiting for
+    # one take turns getting them. Set this to 0 to not limit them.
+    'UPLOAD_SLOTS': '4',
+    
+    # Whether to give upload slots to peers that have recently uploaded
+    # to us first.
+    'UPLOAD_RECIPROCATE': 'yes',
+    
+    # The maximum number of connections to accept from a single peer.
+    'UPLOAD_PEER_CONNECTIONS': '2',
+
+    # The rate to limit downloading data from peers and mirrors to, in
+    # KBytes/sec. Set this to 0 to not limit the download bandwidth.
+    'DOWNLOAD_LIMIT': '0',
+    
+    # The rates to limit downloading from all peers and from all mirrors
+    # to, in KBytes/sec. Both are also limited by DOWNLOAD_LIMIT.
+    # Set these to 0 to not limit them separately.
+    'PEER_DOWNLOAD_LIMIT': '0',
+    'MIRROR_DOWNLOAD_LIMIT': '0',
 
     # The minimum number of peers before the mirror is not used.
     # If there are fewer peers than this for a file, the mirror will also be
@@ -62,6 +95,53 @@ DEFAULTS = {
     # there are peers.
     'MIN_DOWNLOAD_PEERS': '3',
 
+    # The order to download the pieces of a file from peers in, either
+    # 'streaming' (in order) or 'rarest' (the pieces fewest peers have first).
+    'PIECE_PICKER': 'streaming',
+
+    # The number of pieces after the next one needed that are always
+    # downloaded first and in order, so the file can be streamed to apt.
+    'PRIORITY_WINDOW': '4',
+
+    # Whether to also request the last outstanding pieces of a download from
+    # the fastest idle peers, using whichever finishes first.
+    'ENDGAME': 'yes',
+
+    # Whether to share the pieces of files with peers while they are still
+    # being downloaded from peers, as soon as each piece is verified.
+    'PARTIAL_SEEDING': 'yes',
+
+    # The maximum number of piece requests to have outstanding for a
+    # download, and to a single peer. The requests to a peer are pipelined,
+    # and the number of them is set by the peer's bandwidth and response time.
+    'MAX_DOWNLOAD_REQUESTS': '8',
+    'MAX_PEER_REQUESTS': '4',
+
+    # The maximum number of piece requests to have outstanding for all the
+    # downloads together. Index files get them first, then small packages,
+    # then large ones, and apt clients take turns.
+    'MAX_TOTAL_REQUESTS': '16',
+
+    # If no peer starts to send the piece a download needs next within this
+    # percentile of the recent peer response times, also request it from the
+    # mirror, as long as that adds no more than HEDGE_PERCENT of the bytes
+    # downloaded from peers. Set HEDGE_PERCENT to 0 to disable this.
+    'HEDGE_PERCENTILE': '95',
+    'HEDGE_PERCENT': '5',
+
+    # The number of connections to peers and mirrors to try to stay below.
+    # The least recently used idle connections are closed to make room, but
+    # new connections are still opened when all of them are busy.
+    'TARGET_CONNECTIONS': '50',
+
+    # Close connections to peers and mirrors that have been idle this long.
+    'CONNECTION_IDLE': '5m',
+
+    # The longest time to return cached files that aren't in any index
+    # (e.g. Release files) without checking them with the mirror again.
+    # Set this to 0 to always check them.
+    'FRESHNESS_TIME': '5m',
+
     # Directory to store the downloaded files in
     'CACHE_DIR': home + '/.apt-p2p/cache',
     
@@ -81,6 +161,16 @@ DEFAULTS = {
     # to reload when a new request arrives.
     'UNLOAD_PACKAGES_CACHE': '5m',
 
+    # Load the packages cache in the background this long after the last
+    # index file for a mirror was updated, so it is ready before the first
+    # package request arrives. Set this to 0 to only load it on demand.
+    'PREWARM_PACKAGES_CACHE': '10s',
+
+    # The directory apt stores its downloaded index files in. The index files
+    # found here are added to the mirrors at startup, so package hashes are
+    # known before apt next updates. Leave blank to disable.
+    'APT_LISTS_DIR': '/var/lib/apt/lists',
+
     # Refresh the DHT keys after this much time has passed.
     # This should be a time slightly less than the DHT's KEY_EXPIRE value.
     'KEY_REFRESH': '2.5h',
@@ -32,15 +32,21 @@ class DB:
     @ivar db: the database file to use
     @type conn: L{pysqlite2.dbapi2.Connection}
     @ivar conn: an open connection to the sqlite database
+    @type fileCache: L{HotCache.HotCache}
+    @ivar fileCache: the contents of files kept in memory, which are
+        invalidated when the files are stored
     """
     
-    def __init__(self, db):
+    def __init__(self, db, fileCache = None):
         """Load or create the database file.
         
         @type db: L{twisted.python.filepath.FilePath}
         @param db: the database file to use
+        @type fileCache: L{HotCache.HotCache}
+        @param fileCache: the contents of files kept in memory (optional)
         """
         self.db = db
+        self.fileCache = fileCache
         self.db.restat(False)
         if self.db.exists():
             self._loadDB()
@@ -145,6 +151,8 @@ class DB:
 
         # Add the file to the database
         file.restat()
+        if self.fileCache:
+            self.fileCache.invalidate(file.path)
         c.execute("INSERT OR REPLACE INTO files (path, hashID, dht, size, mtime) VALUES (?, ?, ?, ?, ?)",
                   (file.path, hashID, dht, file.getsize(), file.getmtime()))
         self.conn.commit()
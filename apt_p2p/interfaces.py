@@ -27,11 +27,14 @@ class IDHT(Interface):
         @return: a deferred that will fire when the node has left
         """
         
-    def getValue(self, key):
+    def getValue(self, key, callback = None):
         """Get a value from the DHT for the specified key.
         
         The length of the key may be adjusted for use with the DHT.
 
+        @type callback: C{method}
+        @param callback: the method to call with each list of new values as
+            they are found, before the lookup is complete (optional)
         @rtype: C{Deferred}
         @return: a deferred that will fire with the stored values
         """
@@ -6,14 +6,17 @@ Resource limiting policies.
 """
 
 # system imports
-import sys, operator
+import sys, operator, time
 
 # twisted imports
 from twisted.internet.protocol import ServerFactory, Protocol, ClientFactory
 from twisted.internet import reactor, error
 from twisted.python import log
+from twisted.trial import unittest
 from zope.interface import providedBy, directlyProvides
 
+from util import monotonic
+
 
 class ProtocolWrapper(Protocol):
     """Wraps protocol instances and acts as their transport as well."""
@@ -110,8 +113,36 @@ class WrappingFactory(ClientFactory):
         del self.protocols[p]
 
 
+class _ThrottledProducer:
+    """Sits between a transport and the producer writing to a ThrottlingProtocol.
+    
+    The transport resumes its producer whenever its own buffer has been
+    written, which would also resume a producer that has been paused
+    because the protocol has buffered too much throttled data.
+    """
+
+    def __init__(self, protocol, producer):
+        self.protocol = protocol
+        self.producer = producer
+
+    def pauseProducing(self):
+        self.protocol.transportPaused = True
+        self.producer.pauseProducing()
+
+    def resumeProducing(self):
+        self.protocol.transportPaused = False
+        self.protocol._resumeProducer()
+
+    def stopProducing(self):
+        self.producer.stopProducing()
+
+
 class ThrottlingProtocol(ProtocolWrapper):
-    """Protocol for ThrottlingFactory."""
+    """Protocol for ThrottlingFactory.
+    
+    Writes that are throttled are buffered, and the producer is paused
+    once the buffer reaches the factory's MAX_BUFFER.
+    """
 
     # wrap API for tracking bandwidth
 
@@ -120,6 +151,8 @@ class ThrottlingProtocol(ProtocolWrapper):
         self._tempDataBuffer = []
         self._tempDataLength = 0
         self.throttled = False
+        self.producer = None
+        self.transportPaused = False
 
     def write(self, data):
         # Check if we can write
@@ -128,18 +161,18 @@ class ThrottlingProtocol(ProtocolWrapper):
             if not paused:
                 ProtocolWrapper.write(self, data)
                 
-                if paused is not None and hasattr(self, "producer") and self.producer and not self.producer.paused:
+                if paused is not None and self.producer and not self.producer.paused:
                     # Interrupt the flow so that others can can have a chance
                     # We can only do this if it's not already paused otherwise we
                     # risk unpausing something that the Server paused
                     self.producer.pauseProducing()
-                    reactor.callLater(0, self.producer.resumeProducing)
+                    self.factory.callLater(0, self._resumeProducer)
+                return
 
-        if self.throttled or paused:
-            # Can't write, buffer the data
-            self._tempDataBuffer.append(data)
-            self._tempDataLength += len(data)
-            self._throttleWrites()
+        # Can't write, buffer the data
+        self._tempDataBuffer.append(data)
+        self._tempDataLength += len(data)
+        self._throttleWrites()
 
     def writeSequence(self, seq):
         i = 0
@@ -162,10 +195,11 @@ class ThrottlingProtocol(ProtocolWrapper):
     def registerProducer(self, producer, streaming):
         assert streaming, "You can only use the ThrottlingProtocol with streaming (push) producers."
         self.producer = producer
-        ProtocolWrapper.registerProducer(self, producer, streaming)
+        self.transportPaused = False
+        ProtocolWrapper.registerProducer(self, _ThrottledProducer(self, producer), streaming)
 
     def unregisterProducer(self):
-        del self.producer
+        self.producer = None
         ProtocolWrapper.unregisterProducer(self)
 
 
@@ -181,27 +215,50 @@ class ThrottlingProtocol(ProtocolWrapper):
             self.throttled = True
             self.factory.throttledWrites(self)
 
-        if hasattr(self, "producer") and self.producer:
+        # Only keep a limited amount of data buffered
+        if self._tempDataLength >= self.factory.MAX_BUFFER and self.producer and not self.producer.paused:
             self.producer.pauseProducing()
 
-    def unthrottleWrites(self):
-        # Write some data
-        if self._tempDataBuffer:
-            assert not self.factory.registerWritten(len(self._tempDataBuffer[0]))
-            self._tempDataLength -= len(self._tempDataBuffer[0])
-            ProtocolWrapper.write(self, self._tempDataBuffer.pop(0))
+    def _resumeProducer(self):
+        """Resume the producer, unless too much data is buffered or the transport paused it."""
+        if (self.producer and self.producer.paused and not self.transportPaused and
+            self._tempDataLength < self.factory.MAX_BUFFER / 2):
+            self.producer.resumeProducing()
+
+    def unthrottleWrites(self, maxLength):
+        """Write some of the buffered data.
+        
+        The buffered writes are combined into a single write of up to
+        maxLength bytes (but at least one of them is written).
+        
+        @return: the number of bytes written
+        """
+        pieces = []
+        written = 0
+        while self._tempDataBuffer and (not pieces or
+                                        written + len(self._tempDataBuffer[0]) <= maxLength):
+            data = self._tempDataBuffer.pop(0)
+            pieces.append(data)
+            written += len(data)
+
+        if pieces:
+            self._tempDataLength -= written
             assert self._tempDataLength >= 0
+            if len(pieces) == 1:
+                ProtocolWrapper.write(self, pieces[0])
+            else:
+                ProtocolWrapper.write(self, ''.join(pieces))
 
-        # If we wrote it all, start producing more
+        # If we wrote it all, stop throttling
         if not self._tempDataBuffer:
             assert self._tempDataLength == 0
             self.throttled = False
-            if hasattr(self, "producer") and self.producer:
-                # This might unpause something the Server has also paused, but
-                # it will get paused again on first write anyway
-                reactor.callLater(0, self.producer.resumeProducing)
+
+        # Produce more if there's room in the buffer
+        if self.producer and self._tempDataLength < self.factory.MAX_BUFFER / 2:
+            self.factory.callLater(0, self._resumeProducer)
         
-        return self._tempDataLength
+        return written
 
 
 class ThrottlingFactory(WrappingFactory):
@@ -210,25 +267,48 @@ class ThrottlingFactory(WrappingFactory):
 
     Write bandwidth will only be throttled if there is a producer
     registered.
+    
+    Writes are limited by a token bucket that is refilled continuously
+    at the write limit, up to the write burst. The protocols with
+    throttled writes take turns writing, each writing enough to be
+    rescheduled about every WRITE_INTERVAL.
+    
+    @cvar CHUNK_SIZE: the minimum number of bytes to write in a turn
+    @cvar MAX_CHUNK_SIZE: the maximum number of bytes to write in a turn
+    @cvar WRITE_INTERVAL: the number of seconds that all the throttled
+        protocols should take to each get a turn to write
+    @cvar MIN_INTERVAL: the minimum number of seconds between turns
+    @cvar BURST_TIME: the number of seconds of writes at the limit that can
+        be written at once, if not otherwise specified
+    @cvar MAX_BUFFER: the maximum number of bytes to buffer for each
+        protocol before pausing its producer
     """
 
     protocol = ThrottlingProtocol
     CHUNK_SIZE = 4*1024
+    MAX_CHUNK_SIZE = 64*1024
+    WRITE_INTERVAL = 0.02
+    MIN_INTERVAL = 0.001
+    BURST_TIME = 0.1
+    MAX_BUFFER = 64*1024
 
     def __init__(self, wrappedFactory, maxConnectionCount=sys.maxint,
-                 readLimit=None, writeLimit=None):
+                 readLimit=None, writeLimit=None, writeBurst=None):
         WrappingFactory.__init__(self, wrappedFactory)
         self.connectionCount = 0
         self.maxConnectionCount = maxConnectionCount
         self.readLimit = readLimit # max bytes we should read per second
         self.writeLimit = writeLimit # max bytes we should write per second
         self.readThisSecond = 0
-        self.writeAvailable = writeLimit
+        if writeLimit is not None and not writeBurst:
+            writeBurst = max(self.CHUNK_SIZE, int(writeLimit * self.BURST_TIME))
+        self.writeBurst = writeBurst # max bytes we can write at once
+        self.writeAvailable = writeBurst
+        self.writeUpdated = self.seconds()
         self._writeQueue = []
         self.unthrottleReadsID = None
         self.checkReadBandwidthID = None
         self.unthrottleWritesID = None
-        self.checkWriteBandwidthID = None
 
 
     def callLater(self, period, func):
@@ -238,6 +318,23 @@ class ThrottlingFactory(WrappingFactory):
         return reactor.callLater(period, func)
 
 
+    def seconds(self):
+        """
+        Wrapper around L{util.monotonic} for test purpose.
+        """
+        return monotonic()
+
+
+    def _refillWrites(self):
+        """
+        Add the bytes for the time since the last refill to the bucket.
+        """
+        now = self.seconds()
+        self.writeAvailable = min(self.writeBurst,
+                                  self.writeAvailable + (now - self.writeUpdated) * self.writeLimit)
+        self.writeUpdated = now
+
+
     def registerWritten(self, length):
         """
         Called by protocol to tell us more bytes were written.
@@ -246,7 +343,9 @@ class ThrottlingFactory(WrappingFactory):
         # Check if there are bytes available to write
         if self.writeLimit is None:
             return None
-        elif self.writeAvailable > 0:
+        
+        self._refillWrites()
+        if self.writeAvailable > 0 and not self._writeQueue:
             self.writeAvailable -= length
             return False
         
@@ -259,6 +358,27 @@ class ThrottlingFactory(WrappingFactory):
         """
         assert p not in self._writeQueue
         self._writeQueue.append(p)
+        self._scheduleWrites()
+
+
+    def writeChunkSize(self):
+        """
+        Determine the number of bytes each throttled protocol writes in a turn.
+        """
+        chunk = self.writeLimit * self.WRITE_INTERVAL / max(1, len(self._writeQueue))
+        return int(max(self.CHUNK_SIZE, min(self.MAX_CHUNK_SIZE, self.writeBurst, chunk)))
+
+
+    def _scheduleWrites(self):
+        """
+        Schedule the next turn for the throttled protocols to write.
+        """
+        if self.unthrottleWritesID is not None and self.unthrottleWritesID.active():
+            return
+        self._refillWrites()
+        needed = min(self.writeChunkSize(), self.writeBurst) - self.writeAvailable
+        delay = max(self.MIN_INTERVAL, needed / float(self.writeLimit))
+        self.unthrottleWritesID = self.callLater(delay, self.checkWriteBandwidth)
 
 
     def registerRead(self, length):
@@ -283,28 +403,24 @@ class ThrottlingFactory(WrappingFactory):
 
     def checkWriteBandwidth(self):
         """
-        Add some new available bandwidth, and check for protocols to unthrottle.
+        Add the newly available bandwidth, and let the queued protocols write.
         """
-        # Increase the available write bytes, but not higher than the limit
-        self.writeAvailable = min(self.writeLimit, self.writeAvailable + self.writeLimit)
+        self.unthrottleWritesID = None
+        self._refillWrites()
+        chunk = self.writeChunkSize()
         
         # Write from the queue until it's empty or we're throttled again
         while self.writeAvailable > 0 and self._writeQueue:
             # Get the first queued protocol
             p = self._writeQueue.pop(0)
-            _tempWriteAvailable = self.writeAvailable
-            bytesLeft = 1
-            
-            # Unthrottle writes until CHUNK_SIZE is reached or the protocol is unbuffered
-            while self.writeAvailable > 0 and _tempWriteAvailable - self.writeAvailable < self.CHUNK_SIZE and bytesLeft > 0:
-                # Unthrottle a single write (from the protocol's buffer)
-                bytesLeft = p.unthrottleWrites()
+            self.writeAvailable -= p.unthrottleWrites(min(chunk, int(self.writeAvailable)))
                 
             # If the protocol is not done, requeue it
-            if bytesLeft > 0:
+            if p.throttled:
                 self._writeQueue.append(p)
 
-        self.checkWriteBandwidthID = self.callLater(1, self.checkWriteBandwidth)
+        if self._writeQueue:
+            self._scheduleWrites()
 
 
     def throttleReads(self):
@@ -330,8 +446,6 @@ class ThrottlingFactory(WrappingFactory):
         if self.connectionCount == 0:
             if self.readLimit is not None:
                 self.checkReadBandwidth()
-            if self.writeLimit is not None:
-                self.checkWriteBandwidth()
 
         if self.connectionCount < self.maxConnectionCount:
             self.connectionCount += 1
@@ -343,16 +457,17 @@ class ThrottlingFactory(WrappingFactory):
 
     def unregisterProtocol(self, p):
         WrappingFactory.unregisterProtocol(self, p)
+        if p in self._writeQueue:
+            self._writeQueue.remove(p)
         self.connectionCount -= 1
         if self.connectionCount == 0:
             if self.unthrottleReadsID is not None:
                 self.unthrottleReadsID.cancel()
             if self.checkReadBandwidthID is not None:
                 self.checkReadBandwidthID.cancel()
-            if self.unthrottleWritesID is not None:
+            if self.unthrottleWritesID is not None and self.unthrottleWritesID.active():
                 self.unthrottleWritesID.cancel()
-            if self.checkWriteBandwidthID is not None:
-                self.checkWriteBandwidthID.cancel()
+            self.unthrottleWritesID = None
 
 
 
@@ -373,23 +488,42 @@ class SpewingFactory(WrappingFactory):
 
 
 class LimitConnectionsByPeer(WrappingFactory):
-    """Stability: Unstable"""
+    """Factory that limits the number of simultaneous connections from each host.
+
+    Stability: Unstable
+
+    @type maxConnectionsPerPeer: C{int}
+    @cvar maxConnectionsPerPeer: maximum number of connections from a host.
+    @type unlimitedHosts: C{tuple} of C{string}
+    @cvar unlimitedHosts: the hosts whose connections are not limited.
+    """
 
     maxConnectionsPerPeer = 5
+    unlimitedHosts = ()
+
+    def __init__(self, wrappedFactory):
+        WrappingFactory.__init__(self, wrappedFactory)
+        self.peerConnections = {}
 
     def startFactory(self):
         self.peerConnections = {}
 
     def buildProtocol(self, addr):
-        peerHost = addr[0]
+        peerHost = addr.host
+        if peerHost in self.unlimitedHosts:
+            return WrappingFactory.buildProtocol(self, addr)
         connectionCount = self.peerConnections.get(peerHost, 0)
         if connectionCount >= self.maxConnectionsPerPeer:
+            log.msg("Max connection count reached for %s" % peerHost)
             return None
         self.peerConnections[peerHost] = connectionCount + 1
         return WrappingFactory.buildProtocol(self, addr)
 
     def unregisterProtocol(self, p):
-        peerHost = p.getPeer()[1]
+        WrappingFactory.unregisterProtocol(self, p)
+        peerHost = p.getPeer().host
+        if peerHost not in self.peerConnections:
+            return
         self.peerConnections[peerHost] -= 1
         if self.peerConnections[peerHost] == 0:
             del self.peerConnections[peerHost]
@@ -698,3 +832,122 @@ class TimeoutMixin:
         Override to define behavior other than dropping the connection.
         """
         self.transport.loseConnection()
+
+
+class TestThrottlingFactory(unittest.TestCase):
+    """Unit tests for throttling the writes of protocols."""
+
+    class Transport:
+        """A fake transport that records when data is written."""
+
+        def __init__(self, clock):
+            self.clock = clock
+            self.writes = []
+
+        def write(self, data):
+            self.writes.append((self.clock.seconds(), len(data)))
+
+        def registerProducer(self, producer, streaming):
+            self.producer = producer
+
+        def unregisterProducer(self):
+            self.producer = None
+
+        def getPeer(self):
+            return None
+
+    class Producer:
+        """A fake producer that writes a chunk of data whenever it's resumed."""
+
+        def __init__(self, proto, length):
+            self.proto = proto
+            self.length = length
+            self.paused = False
+            self.produced = 0
+
+        def pauseProducing(self):
+            self.paused = True
+
+        def resumeProducing(self):
+            self.paused = False
+            while not self.paused and self.produced < self.length:
+                self.produced += 4096
+                self.proto.write('x' * 4096)
+
+        def stopProducing(self):
+            self.paused = True
+
+    def setUp(self):
+        from twisted.internet import task
+        self.clock = task.Clock()
+        self.factory = ThrottlingFactory(None, writeLimit = 100*1024)
+        self.factory.callLater = self.clock.callLater
+        self.factory.seconds = self.clock.seconds
+        self.factory.writeUpdated = self.clock.seconds()
+
+    def connect(self):
+        """Create a new throttled protocol connected to a fake transport."""
+        p = ThrottlingProtocol(self.factory, Protocol())
+        p.makeConnection(self.Transport(self.clock))
+        return p
+
+    def test_smoothness(self):
+        """Benchmark how smoothly and efficiently writes are throttled."""
+        protos = [self.connect() for i in xrange(3)]
+        for p in protos:
+            producer = self.Producer(p, 1024*1024)
+            p.registerProducer(producer, True)
+            producer.resumeProducing()
+            self.failUnless(p._tempDataLength <= self.factory.MAX_BUFFER)
+
+        start = time.clock()
+        for i in xrange(10000):
+            self.clock.advance(0.001)
+        log.msg('Throttling 10 seconds of writes took %0.3f seconds of CPU' % (time.clock() - start))
+
+        # After the initial burst, each second should be about the same,
+        # and no tenth of a second should get much more than its share
+        for p in protos:
+            self.failUnless(p._tempDataLength <= self.factory.MAX_BUFFER)
+            writes = [w for w in p.transport.writes if w[0] >= 1.0]
+            log.msg('Throttled protocol used %d writes' % len(writes))
+            self.failUnless(len(writes) <= 9.0 * 100*1024 / 3 / self.factory.CHUNK_SIZE + 2)
+            for i in xrange(1, 10):
+                sent = sum([length for t, length in writes if t >= i and t < i + 1])
+                self.failUnless(abs(sent - 100*1024 / 3) < 0.15 * 100*1024 / 3,
+                                "Wrote %d bytes between %d and %d seconds" % (sent, i, i + 1))
+            for i in xrange(10, 100):
+                sent = sum([length for t, length in writes if t >= i / 10.0 and t < (i + 1) / 10.0])
+                self.failUnless(sent <= 2 * self.factory.CHUNK_SIZE,
+                                "Wrote %d bytes between %0.1f and %0.1f seconds" % (sent, i / 10.0, (i + 1) / 10.0))
+
+        total = sum([length for p in protos for t, length in p.transport.writes])
+        self.failUnless(abs(total - 10*100*1024) < self.factory.writeBurst + 3*self.factory.MAX_CHUNK_SIZE)
+
+    def test_buffer_limit(self):
+        """Tests that the producer is paused when too much data is buffered."""
+        p = self.connect()
+        producer = self.Producer(p, 1024*1024)
+        p.registerProducer(producer, True)
+        producer.resumeProducing()
+        self.clock.advance(0)
+        self.failUnless(producer.paused)
+        self.failUnless(p._tempDataLength >= self.factory.MAX_BUFFER)
+        self.failUnless(p._tempDataLength < self.factory.MAX_BUFFER + 4096)
+
+        # The transport resuming the producer can't overfill the buffer
+        p.transport.producer.pauseProducing()
+        p.transport.producer.resumeProducing()
+        self.failUnless(producer.paused)
+        self.failUnless(p._tempDataLength < self.factory.MAX_BUFFER + 4096)
+
+        # Producing resumes as the buffered data is written
+        produced = producer.produced
+        for i in xrange(1000):
+            self.clock.advance(0.001)
+            self.failUnless(p._tempDataLength < self.factory.MAX_BUFFER + 4096)
+        self.failUnless(producer.produced > produced)
+
+    def tearDown(self):
+        for p in self.factory.protocols.keys():
+            self.factory.unregisterProtocol(p)
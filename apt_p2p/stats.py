@@ -45,6 +45,8 @@ class StatsLogger:
         self.mirrorDown = 0L
         self.peerDown = 0L
         self.peerUp = 0L
+        self.mirrorRequests = 0
+        self.peerRequests = 0
         
         # Transport All-Time
         stats = self.db.getStats()
@@ -52,6 +54,11 @@ class StatsLogger:
         self.peerAllDown = long(stats.get('peer_down', 0L))
         self.peerAllUp = long(stats.get('peer_up', 0L))
         
+        # Apt requests
+        self.packageRequests = 0
+        self.packageResponseTime = 0.0
+        self.lastPackageResponseTime = None
+        
     def save(self):
         """Save the persistent statistics to the DB."""
         stats = {'mirror_down': self.mirrorAllDown,
@@ -86,6 +93,23 @@ class StatsLogger:
         out.write("<tr><th><h3>Database</h3></th><th>Value</th></tr>\n")
         out.write("<tr title='Number of distinct files in the database'><td>Distinct Files</td><td>" + str(self.hashes) + '</td></tr>\n')
         out.write("<tr title='Total number of files being shared'><td>Total Files</td><td>" + str(self.files) + '</td></tr>\n')
+        fileCache = self.db.fileCache
+        if fileCache:
+            out.write("<tr title='Amount of small files kept in memory'><td>In Memory</td><td>" + byte_format(fileCache.size) + '</td></tr>\n')
+            out.write("<tr title='Number of times a small file was served from memory'><td>Memory Hits</td><td>" + str(fileCache.hits) + '</td></tr>\n')
+            out.write("<tr title='Number of times a small file had to be read from disk'><td>Memory Misses</td><td>" + str(fileCache.misses) + '</td></tr>\n')
+        out.write("</table>\n")
+        out.write('</td><td>\n')
+        
+        # Apt requests
+        out.write("<table border='1' cellpadding='4px'>\n")
+        out.write("<tr><th><h3>Apt Requests</h3></th><th>Value</th></tr>\n")
+        out.write("<tr title='Number of package files requested by apt'><td>Packages</td><td>" + str(self.packageRequests) + '</td></tr>\n')
+        out.write("<tr title='Average time from a package request to the first byte of the response'><td>Average Response</td><td>%0.3f s</td></tr>\n" %
+                  (self.packageResponseTime / max(self.packageRequests, 1), ))
+        if self.lastPackageResponseTime is not None:
+            out.write("<tr title='Time from the last package request to the first byte of the response'><td>Last Response</td><td>%0.3f s</td></tr>\n" %
+                      (self.lastPackageResponseTime, ))
         out.write("</table>\n")
         out.write("</td></tr><tr><td colspan='3'>\n")
         
@@ -96,6 +120,10 @@ class StatsLogger:
         out.write("<td title='Amount downloaded from mirrors'>" + byte_format(self.mirrorDown) + '</td>')
         out.write("<td title='Amount downloaded from peers'>" + byte_format(self.peerDown) + '</td>')
         out.write("<td title='Amount uploaded to peers'>" + byte_format(self.peerUp) + '</td></tr>\n')
+        out.write("<tr><td title='Since the program was last restarted'>Session Requests</td>")
+        out.write("<td title='Number of requests sent to mirrors'>" + str(self.mirrorRequests) + '</td>')
+        out.write("<td title='Number of requests sent to peers'>" + str(self.peerRequests) + '</td>')
+        out.write("<td></td></tr>\n")
         out.write("<tr><td title='Since the program was last restarted'>Session Ratio</td>")
         out.write("<td title='Percent of download from mirrors'>%0.2f%%</td>" %
                   (100.0 * float(self.mirrorDown) / float(max(self.mirrorDown + self.peerDown, 1)), ))
@@ -141,3 +169,25 @@ class StatsLogger:
         else:
             self.peerDown += bytes
             self.peerAllDown += bytes
+
+    def sentRequest(self, mirror = False):
+        """Record that a request was sent.
+        
+        @param mirror: whether the request was sent to a mirror
+        """
+        if mirror:
+            self.mirrorRequests += 1
+        else:
+            self.peerRequests += 1
+
+    #{ Apt requests
+    def packageResponse(self, seconds):
+        """Record the time taken to start responding to apt's package request.
+        
+        @type seconds: C{float}
+        @param seconds: the time from receiving the request to sending the
+            response headers
+        """
+        self.packageRequests += 1
+        self.packageResponseTime += seconds
+        self.lastPackageResponseTime = seconds
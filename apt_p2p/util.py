@@ -3,9 +3,17 @@
 
 @var isLocal: a compiled regular expression suitable for testing if an
     IP address is from a known local or private range
+@var monotonic: get the number of seconds since an arbitrary point in the
+    past, from a clock that is not affected by changes to the system time
+@var adviseSequential: tell the kernel that part of an open file will be
+    read sequentially, so it reads ahead more aggressively
+@var preallocate: reserve the disk space for an open file that is about to
+    be written, without changing the size of the file
+@var pwrite: write all of some data to a file descriptor at a position,
+    without using (or changing) the position of the file descriptor
 """
 
-import os, re
+import os, re, errno
 
 from twisted.python import log
 from twisted.trial import unittest
@@ -17,6 +25,128 @@ isLocal = re.compile('^(192\.168\.[0-9]{1,3}\.[0-9]{1,3})|'+
                      '(172\.0?3[0-1]\.[0-9]{1,3}\.[0-9]{1,3})|'+
                      '(127\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3})$')
 
+def _monotonicClock():
+    """Find the best available monotonic clock.
+    
+    Uses clock_gettime(CLOCK_MONOTONIC) if it can be found, otherwise the
+    elapsed real time from os.times() (which only has a resolution of the
+    clock ticks).
+    """
+    try:
+        import ctypes, ctypes.util
+        
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1')
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        t = timespec()
+        CLOCK_MONOTONIC = 1
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            raise OSError, "clock_gettime failed"
+
+        def monotonic():
+            clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t))
+            return t.tv_sec + t.tv_nsec / 1000000000.0
+        return monotonic
+    except Exception:
+        return lambda: os.times()[4]
+
+monotonic = _monotonicClock()
+
+def _fileAdvice():
+    """Find posix_fadvise to give the kernel readahead hints.
+    
+    If it can't be found, the hints are silently skipped.
+    """
+    try:
+        import ctypes, ctypes.util
+        
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+        if hasattr(libc, 'posix_fadvise64'):
+            fadvise = libc.posix_fadvise64
+        else:
+            fadvise = libc.posix_fadvise
+        fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int]
+        POSIX_FADV_SEQUENTIAL = 2
+        
+        def adviseSequential(f, offset = 0, length = 0):
+            try:
+                fadvise(f.fileno(), offset, length, POSIX_FADV_SEQUENTIAL)
+            except Exception:
+                pass
+        return adviseSequential
+    except Exception:
+        return lambda f, offset = 0, length = 0: None
+
+adviseSequential = _fileAdvice()
+
+def _fileAllocate():
+    """Find fallocate to reserve the disk space for files before they are written.
+    
+    If it can't be found, the space is silently not reserved.
+    """
+    try:
+        import ctypes, ctypes.util
+        
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+        if hasattr(libc, 'fallocate64'):
+            fallocate = libc.fallocate64
+        else:
+            fallocate = libc.fallocate
+        fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+        FALLOC_FL_KEEP_SIZE = 1
+        
+        def preallocate(f, length, offset = 0):
+            try:
+                fallocate(f.fileno(), FALLOC_FL_KEEP_SIZE, offset, length)
+            except Exception:
+                pass
+        return preallocate
+    except Exception:
+        return lambda f, length, offset = 0: None
+
+preallocate = _fileAllocate()
+
+def _positionalWrite():
+    """Find pwrite to write to files at a position without seeking.
+    
+    If it can't be found, the file descriptor is seeked before writing, so
+    it must not be shared with anything else that uses its position.
+    """
+    def seekWrite(fd, data, offset):
+        os.lseek(fd, offset, 0)
+        while data:
+            data = data[os.write(fd, data):]
+        
+    try:
+        import ctypes, ctypes.util
+        
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+        if hasattr(libc, 'pwrite64'):
+            cpwrite = libc.pwrite64
+        else:
+            cpwrite = libc.pwrite
+        cpwrite.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_longlong]
+        cpwrite.restype = ctypes.c_ssize_t
+        
+        def pwrite(fd, data, offset):
+            while data:
+                written = cpwrite(fd, data, len(data), offset)
+                if written < 0:
+                    err = ctypes.get_errno()
+                    if err == errno.EINTR:
+                        continue
+                    raise OSError, (err, os.strerror(err))
+                data = data[written:]
+                offset += written
+        return pwrite
+    except Exception:
+        return seekWrite
+
+pwrite = _positionalWrite()
+
 def findMyIPAddr(addrs, intended_port, local_ok = False):
     """Find the best IP address to use from a list of possibilities.
     
@@ -196,6 +326,14 @@ class TestUtil(unittest.TestCase):
     ip = '165.234.1.34'
     port = 61234
 
+    def test_monotonic(self):
+        """Make sure the monotonic clock never goes backwards."""
+        last = monotonic()
+        for i in xrange(1000):
+            now = monotonic()
+            self.failUnless(now >= last)
+            last = now
+
     def test_compact(self):
         """Make sure compacting is reversed correctly by uncompacting."""
         d = uncompact(compact(self.ip, self.port))
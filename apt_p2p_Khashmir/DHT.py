@@ -60,6 +60,9 @@ class DHT:
     @type retrieved: C{dictionary}
     @ivar retrieved: keys are the keys for which getValue requests are active,
         values are list of the values returned so far
+    @type retrieveCallbacks: C{dictionary}
+    @ivar retrieveCallbacks: keys are the keys for which getValue requests
+        are active, values are lists of the methods to call with new values
     @type factory: L{twisted.web2.channel.HTTPFactory}
     @ivar factory: the factory to use to serve HTTP requests for statistics
     @type config_parser: L{apt_p2p.apt_p2p_conf.AptP2PConfigParser}
@@ -90,6 +93,7 @@ class DHT:
         self.storing = {}
         self.retrieving = {}
         self.retrieved = {}
+        self.retrieveCallbacks = {}
         self.factory = None
     
     def loadConfig(self, config, section):
@@ -242,7 +246,7 @@ class DHT:
             key = key[:HASH_LENGTH]
         return key
 
-    def getValue(self, key):
+    def getValue(self, key, callback = None):
         """See L{apt_p2p.interfaces.IDHT}."""
         if self.config is None:
             return defer.fail(DHTError("configuration not loaded"))
@@ -255,13 +259,28 @@ class DHT:
         if key not in self.retrieving:
             self.khashmir.valueForKey(key, self._getValue)
         self.retrieving.setdefault(key, []).append(d)
+        if callback:
+            self.retrieveCallbacks.setdefault(key, []).append(callback)
+            if self.retrieved.get(key, []):
+                # Pass on the values that have already been found
+                self._callback(callback, self.retrieved[key][:])
         return d
         
+    def _callback(self, callback, values):
+        """Pass some new values to a method waiting for them."""
+        try:
+            callback(values)
+        except:
+            log.err()
+        
     def _getValue(self, key, result):
         """Process a returned list of values from the DHT."""
         # Save the list of values to return when it is complete
         if result:
-            self.retrieved.setdefault(key, []).extend([bdecode(r) for r in result])
+            values = [bdecode(r) for r in result]
+            self.retrieved.setdefault(key, []).extend(values)
+            for callback in self.retrieveCallbacks.get(key, []):
+                self._callback(callback, values[:])
         else:
             # Empty list, the get is complete, return the result
             final_result = []
@@ -272,6 +291,7 @@ class DHT:
                 d = self.retrieving[key].pop(0)
                 d.callback(final_result)
             del self.retrieving[key]
+            self.retrieveCallbacks.pop(key, None)
 
     def storeValue(self, key, value):
         """See L{apt_p2p.interfaces.IDHT}."""
@@ -416,6 +436,12 @@ class TestSimpleDHT(unittest.TestCase):
         if self.checked == 0:
             self.lastDefer.callback(1)
     
+    def check_found(self, result, found):
+        self.failUnlessEqual(len(found), len(result))
+        for v in result:
+            self.failUnless(v in found)
+        return result
+    
     def get_values(self):
         self.checked = 4
         d = self.a.getValue(sha.new('4044').digest())
@@ -424,7 +450,9 @@ class TestSimpleDHT(unittest.TestCase):
         d.addCallback(self.check_values, [str(4044*2)])
         d = self.a.getValue(sha.new('4045').digest())
         d.addCallback(self.check_values, [str(4045*2), str(4045*3)])
-        d = self.b.getValue(sha.new('4045').digest())
+        found = []
+        d = self.b.getValue(sha.new('4045').digest(), found.extend)
+        d.addCallback(self.check_found, found)
         d.addCallback(self.check_values, [str(4045*2), str(4045*3)])
 
     def test_store(self):